@@ -2,10 +2,28 @@
 
 This package exports the following classes:
 
+HTTP:
+    - WhoisSession: Keep-alive HTTP session with a connection pool
+        - CassetteSession: Records lookups to, or replays them from, a file
+    - RateLimiter: Per-host token bucket scheduler with AIMD rate control
+
 Data Stores:
+    - LRUCache: Bounded in-memory cache with LRU eviction
     - GenericStore: No caching data store (base class)
         - HashStore: Data store with hash backend
         - DBStore: Data store with MongoDB as the backend
+        - FileStore: Data store with an embedded SQLite file as the backend
+    - BulkImporter: Loads ARIN bulk whois dumps into a data store
+
+Crawl Engine:
+    - WorkerPool: Pool of worker threads fed by a work queue
+    - SingleFlight: Coalesces concurrent lookups of the same object
+    - Prefetcher: Runs association lookups ahead of the crawl
+    - CrawlBudget: Limits on the lookups, depth and duration of a crawl
+    - CrawlCheckpoint: Periodic snapshot from which a crawl can resume
+    - DisjointSet: Union-find grouping of linked handles into clusters
+    - GraphIndex: Links, resources and tooltips discovered by a crawl
+    - WhoisCrawler: Schedules the lookups of a collection tree
 
 Whois Collection Objects:
     - WhoisCollection: Base class
@@ -16,6 +34,7 @@ Whois Collection Objects:
             - IPCollection: IP address collection (Ephemeral Class)
             - CIDRCollection: CIDR block Collection (Ephemeral Class)
         - ASNCollection: Autonomous System Number Collection
+        - WorklistCollection: Level-by-level crawl of any collection type
 
 Analysis and reporting:
     - WhoisAnalyzer: Cluster analyzer
@@ -24,6 +43,10 @@ Analysis and reporting:
 CLI Argument Parser:
     - WhoisOptParser: Parse base command line options
     - AnalyzeOptExtension: Parse analyzer specific command line options
+    - ImportOptExtension: Parse importer specific command line options
+
+Testing:
+    - MockArinServer: Local mock of the ARIN RESTful API
 
 RouteViews Interface:
     - RVFetcher: Fetch route view data from local DB
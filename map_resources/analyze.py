@@ -17,6 +17,8 @@ import matplotlib.pyplot as plt
 from json2html import *
 import StringIO
 import argparse
+import hashlib
+import multiprocessing
 import netaddr
 import community
 from random import randint
@@ -34,14 +36,133 @@ DBPORT = 27017
 # Legacy resource was registered prior to this date 
 LEGACY = '1997-12-22'
 
+# Attributes of the parsed command line that determine the data store
+STOREOPTS = ['nostore', 'hashstore', 'dbstore', 'filestore', 'wireformat',
+        'retries', 'negttl', 'cacheentries', 'cachebytes', 'local',
+        'writebehind', 'compact', 'keepraw', 'poolsize', 'timeout', 'rate',
+        'maxrate', 'record', 'replay', 'realtime']
+
+# Components with fewer handles than this are not split into communities
+MINCOMMUNITY = 3
+
 global verbose
 verbose = False
 
+# The data store of a worker process
+global workerstore
+workerstore = None
+
+
+def init_worker(storespec):
+    """Build the data store of a worker process.
+
+    Args:
+        storespec (tuple): A (function, args) pair that returns the store.
+    """
+    global workerstore
+    (fn, args) = storespec
+    workerstore = fn(*args)
+
+
+def crawl_seed(task):
+    """Crawl from a single seed in a worker process.
+
+    Args:
+        task (tuple): The seed type, the seed handle and a dict of
+                      WhoisAnalyzer and budget parameters.
+
+    Returns:
+        The graph of the crawl, as returned by
+        WhoisAnalyzer.get_graph().
+    """
+    (t, h, params) = task
+    a = WhoisAnalyzer(workerstore, params['threshold'], params['whitelist'],
+            params['blacklist'], params['concurrency'], params['prefetch'],
+            worklist=True)
+    a.analyze({h: t}, params['maxqueries'], params['maxdepth'],
+            params['maxtime'])
+    workerstore.flush()
+    return a.get_graph()
+
+
+def component_fingerprint(edges):
+    """Return a key that identifies a component by its edges.
+
+    Args:
+        edges (list): The (handle, handle) edges of the component.
+
+    Returns:
+        A hex digest that does not depend on the order or direction of
+        the edges.
+    """
+    canon = sorted(u"\t".join(sorted((unicode(s), unicode(d))))
+            for (s, d) in edges)
+    return hashlib.sha1(u"\n".join(canon).encode('utf-8')).hexdigest()
+
+
+def partition_component(edges):
+    """Find the Louvain communities of a component.
+
+    Args:
+        edges (list): The (handle, handle) edges of the component.
+
+    Returns:
+        A dict that maps each handle to its community number.
+    """
+    return community.best_partition(net.Graph(edges))
+
+
+def make_store(p):
+    """Build a data store from the parsed store options.
+
+    Args:
+        p(Namespace): Contains the options named in STOREOPTS.
+
+    Returns:
+        A GenericStore object corresponding to the selected data
+        store type.
+    """
+    limiter = None
+    if p.rate > 0:
+        limiter = fetch_whois.RateLimiter(p.rate, p.maxrate)
+    if p.record or p.replay:
+        session = fetch_whois.CassetteSession(p.record or p.replay,
+                bool(p.record), p.realtime, p.poolsize, p.timeout,
+                limiter, p.retries, wireformat=p.wireformat)
+    else:
+        session = fetch_whois.WhoisSession(p.poolsize, p.timeout,
+                limiter, p.retries, wireformat=p.wireformat)
+    if p.nostore:
+        store = fetch_whois.GenericStore(session=session)
+    elif p.hashstore:
+        store = fetch_whois.HashStore(session=session,
+                maxentries=p.cacheentries, maxbytes=p.cachebytes,
+                negttl=p.negttl)
+    elif p.dbstore:
+        dbhost, dbport = p.dbstore
+        store = fetch_whois.DBStore(dbhost, dbport, p.local,
+                session=session, negttl=p.negttl,
+                maxentries=p.cacheentries, maxbytes=p.cachebytes,
+                writebehind=p.writebehind)
+    elif p.filestore:
+        store = fetch_whois.FileStore(p.filestore, p.local,
+                session=session, negttl=p.negttl)
+    else:
+        store = fetch_whois.DBStore(DBHOST, DBPORT, p.local,
+                session=session, negttl=p.negttl,
+                maxentries=p.cacheentries, maxbytes=p.cachebytes,
+                writebehind=p.writebehind)
+    if p.compact:
+        store.set_compact(p.keepraw)
+    return store
+
 
 class WhoisAnalyzer:
     """ Define a class for analyzing a list of collection objects. """
 
-    def __init__(self, store=None, threshold=None, whitelist=None, blacklist=None):
+    def __init__(self, store=None, threshold=None, whitelist=None,
+            blacklist=None, concurrency=None, prefetch=None, worklist=False,
+            checkpoint=None, procs=None, storespec=None, communities=False):
         """Instantiate a WhoisAnalyzer object.
 
         Args:
@@ -56,6 +177,29 @@ class WhoisAnalyzer:
 
             blacklist (list of string): Object handles that are to be
                                         filtered. 
+
+            concurrency (int): The number of lookups to run in
+                               parallel.
+
+            prefetch (int): The number of association lookups to run
+                            ahead of the crawl.
+
+            worklist (boolean): Crawl one level at a time with a
+                                WorklistCollection instead of
+                                recursing through typed collections.
+
+            checkpoint (CrawlCheckpoint): Take periodic snapshots of the
+                                          crawl; implies worklist.
+
+            procs (int): The number of worker processes that crawl
+                         seeds in parallel.
+
+            storespec (tuple): A picklable (function, args) pair that
+                               builds the store of each worker process;
+                               required for more than one process.
+
+            communities (boolean): Split the clusters into Louvain
+                                   communities, used to color the graph.
         """
         self.store = store
         self.threshold = threshold
@@ -64,6 +208,18 @@ class WhoisAnalyzer:
         self.messages = []
         self.starthandles = []
         self.resob = None
+        self.crawler = fetch_whois.WhoisCrawler(concurrency, prefetch)
+        self.worklist = worklist
+        self.checkpoint = checkpoint
+        self.procs = procs
+        self.storespec = storespec
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.communities = communities
+        self.partitions = {}
+        if checkpoint:
+            self.worklist = True
+            self.crawler.set_checkpoint(checkpoint)
 
     def append_message(self, msg):
         """Append a new message to the analyzer object."""
@@ -104,7 +260,7 @@ class WhoisAnalyzer:
         else:
             return None
 
-    def process_new_collection(self, t, h, comment=None):
+    def process_new_collection(self, t, h, comment=None, resume=None):
         """ Process a new collection of given type and handle.
 
         Create a new collection object with the given type. Reuse the
@@ -115,6 +271,9 @@ class WhoisAnalyzer:
         Args:
             t (str): Collection type.
             h (str): The collection handle.
+            comment (str): An initial tooltip.
+            resume (dict): The frontier of the collection saved by a
+                           checkpoint, to resume its crawl from.
 
         Returns:
             None.
@@ -128,66 +287,250 @@ class WhoisAnalyzer:
         else:
             cache = {}
 
-        if t == 'poc':
+        if self.worklist:
+            o = fetch_whois.WorklistCollection(h, t, store=self.store,
+                    cache=cache, tt=tt, threshold=self.threshold,
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
+        elif t == 'poc':
             o = fetch_whois.POCCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'asn':
             o = fetch_whois.ASNCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'org':
             o = fetch_whois.OrgCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'net':
             o = fetch_whois.NetCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'cidr':
             o = fetch_whois.CIDRCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'ip':
             o = fetch_whois.IPCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'url':
             o = fetch_whois.URLCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         elif t == 'orgstr':
             o = fetch_whois.OrgstrCollection(h, store=self.store,
                     cache=cache, tt=tt, threshold=self.threshold,
-                    whitelist=self.whitelist, blacklist=self.blacklist)
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
         if o:
             self.starthandles.append(h)
-            o.do_slurp()
+            if resume:
+                o.resume(resume['level'], resume['depth'])
+            else:
+                o.do_slurp()
             if self.resob:
                 self.resob.subsume(o)
             else:
                 self.resob = o 
+            if self.checkpoint:
+                self.checkpoint.seed_done(t, h)
+                self.checkpoint.update(self.crawler)
 
-    def analyze(self, objlist):
+    def restore(self, state):
+        """ Restore the seeds crawled before a checkpoint was taken.
+
+        Args:
+            state (dict): The snapshot read from the checkpoint.
+
+        Returns:
+            A list of the (type, handle) pairs of the completed seeds.
+        """
+        self.checkpoint.restore(self.crawler, state)
+        done = self.checkpoint.get_done()
+        seeds = list(done)
+        if state['current']:
+            seeds.append((state['current']['ctype'],
+                state['current']['handle']))
+        if seeds:
+            (t, h) = seeds[0]
+            self.resob = fetch_whois.WorklistCollection(h, t,
+                    store=self.store, threshold=self.threshold,
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
+            self.resob.restore_nodes(state['nodes'])
+        self.starthandles.extend(h for (t, h) in done)
+        return done
+
+    def analyze(self, objlist, maxqueries=None, maxdepth=None, maxtime=None,
+            resume=False):
         """ Analyze a list of handles.
 
         Each handle in the list is used as a starting point for the
         collection of resources through the process_new_collection()
-        method. 
+        method. The budgets apply to all handles together; once one
+        runs out, the handles that were not followed are filtered and
+        the crawl winds down.
 
         Args:
             objlist (dict): A dict of handles->type mappings.
 
+            maxqueries (int): The maximum number of store lookups.
+
+            maxdepth (int): The maximum number of hops from a handle
+                            in the list.
+
+            maxtime (float): The maximum crawl time in seconds.
+
+            resume (boolean): Continue from the last snapshot of the
+                              checkpoint, if there is one.
+
         Returns:
             None.
         """
+        if self.procs > 1 and self.storespec:
+            return self.analyze_parallel(objlist, maxqueries, maxdepth,
+                    maxtime)
+        state = None
+        done = []
+        if self.checkpoint and resume:
+            state = self.checkpoint.load()
+        if state:
+            done = self.restore(state)
+        budget = fetch_whois.CrawlBudget(maxqueries, maxdepth, maxtime)
+        self.crawler.set_budget(budget)
+        budget.start()
         for k in objlist.keys():
             # The dict key corresponds to the resource handle
             # The dict value corresponds to the resource 'type'
-            self.process_new_collection(objlist[k], k)
+            if (objlist[k], k) in done:
+                continue
+            current = None
+            if state and state['current'] and \
+                    state['current']['handle'] == k and \
+                    state['current']['ctype'] == objlist[k]:
+                current = state['current']
+            self.process_new_collection(objlist[k], k, resume=current)
+        if self.checkpoint:
+            self.checkpoint.update(self.crawler, force=True)
+
+        reason = budget.get_stats()['exhausted']
+        if reason:
+            self.append_message("Crawl budget exhausted (" + reason +
+                    "): results are partial")
+        return self.resob
+
+    def analyze_parallel(self, objlist, maxqueries=None, maxdepth=None,
+            maxtime=None):
+        """ Analyze a list of handles in a pool of worker processes.
+
+        Each seed is crawled separately, with a worklist crawl, by a
+        worker process that builds its own store from the store
+        specification. Objects are only shared between the workers
+        through a DB or file store; any other store is private to the
+        worker that built it.
+        The graphs of the seeds are then merged in the sorted order of
+        the seeds, so that the result does not depend on scheduling.
+        Budgets apply to each seed separately.
+
+        Args:
+            objlist (dict): A dict of handles->type mappings.
+
+            maxqueries (int): The maximum number of store lookups.
+
+            maxdepth (int): The maximum number of hops from a handle
+                            in the list.
+
+            maxtime (float): The maximum crawl time in seconds.
 
+        Returns:
+            The WhoisCollection object holding the merged graph.
+        """
+        params = {'threshold': self.threshold, 'whitelist': self.whitelist,
+                'blacklist': self.blacklist,
+                'concurrency': self.concurrency, 'prefetch': self.prefetch,
+                'maxqueries': maxqueries, 'maxdepth': maxdepth,
+                'maxtime': maxtime}
+        seeds = sorted((t, h) for (h, t) in objlist.items())
+        pool = multiprocessing.Pool(self.procs, init_worker,
+                (self.storespec,))
+        try:
+            graphs = pool.map(crawl_seed,
+                    [(t, h, params) for (t, h) in seeds], 1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        for ((t, h), graph) in zip(seeds, graphs):
+            self.merge_graph(t, h, graph)
         return self.resob
 
+    def get_graph(self):
+        """ Return the graph found by a worklist crawl.
+
+        Returns:
+            A dict of plain lists and dicts, as returned by
+            GraphIndex.to_state(), along with the analyzer 'messages'.
+        """
+        graph = self.crawler.get_index().to_state()
+        graph['messages'] = self.messages
+        return graph
+
+    def merge_graph(self, t, h, graph):
+        """ Merge the graph of a seed crawled elsewhere.
+
+        Args:
+            t (str): Seed type.
+            h (str): Seed handle.
+            graph (dict): The graph returned by get_graph().
+
+        Returns:
+            None.
+        """
+        if not self.resob:
+            self.resob = fetch_whois.WorklistCollection(h, t,
+                    store=self.store, threshold=self.threshold,
+                    whitelist=self.whitelist, blacklist=self.blacklist,
+                    crawler=self.crawler)
+        self.crawler.get_index().load_state(graph)
+        self.resob.restore_nodes(graph['nodes'])
+        self.starthandles.append(h)
+        for msg in graph['messages']:
+            if msg not in self.messages:
+                self.append_message(msg)
+
+    def index_resources(self, r):
+        """Index resources by their handle.
+
+        Args:
+            r (dict): Lists of (handle, ID string) resources indexed by
+                      resource type.
+
+        Returns:
+            A dict that maps each handle to a list of (type, resource)
+            pairs, holding the first resource of each type listed for
+            the handle.
+        """
+        byhandle = defaultdict(list)
+        for t in r.keys():
+            seen = set()
+            for (handle, idstr) in r[t]:
+                if handle not in seen:
+                    seen.add(handle)
+                    byhandle[handle].append((t, (handle, idstr)))
+        return byhandle
+
     def generate_clusters(self):
         """Group resources according to their subgraphs.
 
@@ -200,39 +543,107 @@ class WhoisAnalyzer:
         r = self.resob.get_resources()
         x = self.resob.get_filtered()
         l = self.resob.get_links()
+        byhandle = self.index_resources(r)
+        starts = set(self.starthandles)
+        xset = set(x)
         communities = defaultdict(int)
         # Filter the links to nodes that are on our filter list 
         lfilt = defaultdict(list)
         for k in l.keys():
-            if k not in x:
-                lfilt[k] = [e for e in l[k] if e not in x and e != None]
-        G = net.from_dict_of_lists(lfilt)
-        graphs = net.connected_component_subgraphs(G)
+            if k not in xset:
+                lfilt[k] = [e for e in l[k] if e not in xset and e != None]
+        # The clusters found during the crawl hold unless links to
+        # filtered handles must be cut
+        if xset:
+            clusters = fetch_whois.DisjointSet()
+            for k in lfilt.keys():
+                for e in lfilt[k]:
+                    clusters.union(k, e)
+        else:
+            clusters = self.resob.get_index().get_clusters()
+        # Group the edges by cluster, each undirected edge once
+        edges = defaultdict(list)
+        seen = set()
+        for k in lfilt.keys():
+            for e in lfilt[k]:
+                if (e, k) not in seen and (k, e) not in seen:
+                    seen.add((k, e))
+                    edges[clusters.find(k)].append((k, e))
+        components = clusters.get_components()
         resources = []
+        relevantedges = []
         links = defaultdict(list)
-        # Just pick the subgraphs and the links that are relevant
-        for g in graphs:
-            if g.size() == 0:
-                continue
+        # Just pick the clusters and the links that are relevant
+        for root in edges.keys():
             c = defaultdict(list)
             relevant = False
-            for n in g.nodes():
-                if n in self.starthandles:
+            for n in components[root]:
+                if n in starts:
                     relevant = True
-                for t in r.keys():
-                    for (handle, idstr) in r[t]:
-                        if n == handle:
-                            c[t].append((handle, idstr))
-                            break
+                for (t, res) in byhandle.get(n, []):
+                    c[t].append(res)
             if relevant:
                 resources.append(c)
-                parts = community.best_partition(g) 
-                for (s, d) in g.edges():
+                relevantedges.append(edges[root])
+                for (s, d) in edges[root]:
                     links[s].append(d)
-                    communities[s] = parts.get(s)
-                    communities[d] = parts.get(d)
+        if self.communities:
+            communities = self.find_communities(relevantedges)
         return (resources, links, x, communities)
 
+    def find_communities(self, components):
+        """Split components into Louvain communities.
+
+        Trivial components form a single community. The partitions of
+        the other components are cached by component fingerprint, and
+        those that are not cached are computed in a pool of worker
+        processes.
+
+        Args:
+            components (list): The list of edges of each component.
+
+        Returns:
+            A dict that maps each handle to its community number within
+            its component.
+        """
+        communities = defaultdict(int)
+        todo = []
+        for edges in components:
+            nodes = set()
+            for (s, d) in edges:
+                nodes.add(s)
+                nodes.add(d)
+            if len(nodes) < MINCOMMUNITY:
+                for n in nodes:
+                    communities[n] = 0
+                continue
+            key = component_fingerprint(edges)
+            if key in self.partitions:
+                communities.update(self.partitions[key])
+            else:
+                todo.append((key, edges))
+        if len(todo) > 1:
+            if self.procs > 1:
+                procs = self.procs
+            else:
+                procs = multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(min(procs, len(todo)))
+            try:
+                parts = pool.map(partition_component,
+                        [edges for (key, edges) in todo], 1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            parts = [partition_component(edges) for (key, edges) in todo]
+        for ((key, edges), part) in zip(todo, parts):
+            self.partitions[key] = part
+            communities.update(part)
+        return communities
+
     def pack(self, resources, links, filtered):
         """Pack resource and links into a dict.
 
@@ -310,6 +721,9 @@ class WhoisAnalyzer:
 
         if verbose:
             r.write_cluster_summary(self.messages)
+            if self.store:
+                r.write_store_summary(self.store)
+            r.write_crawl_summary(self.crawler)
 
         if options['jsonfile']:
             r.write_raw_json(options['jsonfile'])
@@ -608,8 +1022,10 @@ class ResourceReporter:
                     pobj = obj.get_parent()
                     if pobj:
                         pobj.fill_draw_attribs(node_h, n.attr)
-                    n.attr['style'] = 'filled'
-                    n.attr['fillcolor'] = colors[self.communities[node_h]] + ":white"
+                    # Without communities keep the collection colors
+                    if node_h in self.communities:
+                        n.attr['style'] = 'filled'
+                        n.attr['fillcolor'] = colors[self.communities[node_h]] + ":white"
                         
                     # All parent objects in the list will be the same
                     break
@@ -794,6 +1210,78 @@ class ResourceReporter:
                     print "\t\t\t" + h + "\t" + "[" + loc + "]" 
 
 
+    def write_crawl_summary(self, crawler):
+        """Write the crawl engine statistics.
+
+        Args:
+            crawler(WhoisCrawler): The crawler used for the lookups.
+
+        Returns:
+            None.
+        """
+        print "Concurrent lookups: " + str(crawler.get_concurrency())
+        stats = crawler.get_index().get_cluster_stats()
+        print "Linked handles: " + str(stats['handles'])
+        print "\tClusters: " + str(stats['clusters'])
+        print "\tLargest cluster: " + str(stats['largest'])
+        print "\tDuplicate lookups avoided: " + str(crawler.get_flights().get_saved())
+        stats = crawler.get_budget().get_stats()
+        print "Crawl lookups: " + str(stats['queries'])
+        print "\tElapsed time: %.2fs" % stats['elapsed']
+        if stats['exhausted']:
+            print "\tBudget exhausted: " + stats['exhausted']
+        prefetcher = crawler.get_prefetcher()
+        if prefetcher:
+            stats = prefetcher.get_stats()
+            print "Prefetched lookups: " + str(stats['issued'])
+            print "\tUsed: " + str(stats['used'])
+            print "\tUnused: " + str(stats['unused'])
+
+    def write_store_summary(self, store):
+        """Write the data store statistics.
+
+        Args:
+            store(GenericStore): The store used for fetching data.
+
+        Returns:
+            None.
+        """
+        stats = store.get_session_stats()
+        print "HTTP requests: " + str(stats['requests'])
+        print "\tConnections opened: " + str(stats['connections'])
+        print "\tConnections reused: " + str(stats['reused'])
+        print "\tRetries: " + str(stats['retries'])
+        print "\tMean latency (new connection): %.3fs" % stats['newlatency']
+        print "\tMean latency (reused connection): %.3fs" % stats['reuselatency']
+        print "\tEstimated time saved by reuse: %.3fs" % stats['saved']
+        if 'replayed' in stats:
+            print "\tReplayed from cassette: " + str(stats['replayed'])
+            print "\tMissing from cassette: " + str(stats['missing'])
+        stats = store.get_cache_stats()
+        for ctype in sorted(stats.keys()):
+            c = stats[ctype]
+            print "Cache for " + ctype + ":"
+            for k in ('hits', 'misses', 'evictions'):
+                print "\t" + k.capitalize() + ": " + str(c.get(k, 0))
+        stats = store.get_writer_stats()
+        if stats:
+            print "Write-behind DB writes: " + str(stats['written'])
+            print "\tFlushes: " + str(stats['flushes'])
+            print "\tFailed flushes: " + str(stats['failures'])
+            print "\tDropped objects: " + str(stats['dropped'])
+        limiter = store.get_session().get_limiter()
+        if limiter:
+            stats = limiter.get_stats()
+            for host in sorted(stats.keys()):
+                h = stats[host]
+                print "Rate limiting for " + host + ":"
+                print "\tCurrent rate: %.2f/s" % h['rate']
+                print "\tThrottled responses: " + str(h['throttled'])
+                print "\tServer errors: " + str(h['errors'])
+                print "\tBackoffs: " + str(h['backoffs'])
+                print "\tTime spent waiting: %.3fs" % h['waited']
+
+
     def write_report(self, rh, clusterplot=False, clustergraph=False, extended=False, rvf=None):
         """Write cluster info
 
@@ -896,6 +1384,7 @@ class WhoisOptParser:
         parser.add_argument("-j", "--jsonfile", help="Output raw resource information in json format", type=argparse.FileType('w'))
         parser.add_argument("-J", "--cjsonfile", help="Output cluster information in json format", type=argparse.FileType('w'))
         parser.add_argument("-e", "--extended", help="Display detailed information", action='store_true')
+        parser.add_argument("-M", "--metricsfile", help="Output store metrics in json format", type=argparse.FileType('w'))
         self.parser = parser
         self.add_stores()
 
@@ -927,6 +1416,24 @@ class WhoisOptParser:
         group.add_argument("-X", "--nostore", help="Do not use any data store", action="store_true")
         group.add_argument("-H", "--hashstore", help="Use a hash store", action="store_true")
         group.add_argument("-D", "--dbstore", help="Use a DB store", type=self.host_port)
+        group.add_argument("-F", "--filestore", help="Use a file store at the given path", type=str)
+        self.parser.add_argument("--wireformat", help="Representation requested from the whois server", choices=sorted(fetch_whois.ACCEPT.keys()), default=fetch_whois.WIREFORMAT)
+        self.parser.add_argument("--retries", help="Number of times a lookup is retried after a transient error", action='store', type=int, default=fetch_whois.RETRIES)
+        self.parser.add_argument("--negttl", help="Number of seconds for which a cached 'object does not exist' result is valid", action='store', type=int, default=fetch_whois.NEGTTL)
+        self.parser.add_argument("--cacheentries", help="Maximum number of objects kept in memory by the hash or DB store", action='store', type=int)
+        self.parser.add_argument("--cachebytes", help="Maximum size in bytes of the objects kept in memory by the hash or DB store", action='store', type=int)
+        self.parser.add_argument("-l", "--local", help="Only use data already in the DB or file store", action="store_true")
+        self.parser.add_argument("--writebehind", help="Batch DB store writes in the background", action="store_true")
+        self.parser.add_argument("--compact", help="Keep only the whois fields used for mapping in memory", action="store_true")
+        self.parser.add_argument("--keepraw", help="With --compact, also keep the full whois objects", action="store_true")
+        self.parser.add_argument("--poolsize", help="Number of keep-alive connections to pool per host", action='store', type=int, default=fetch_whois.POOLSIZE)
+        self.parser.add_argument("--timeout", help="HTTP request timeout in seconds", action='store', type=float, default=fetch_whois.TIMEOUT)
+        self.parser.add_argument("--rate", help="Initial number of requests per second sent to a host (0 disables rate limiting)", action='store', type=float, default=fetch_whois.RATE)
+        self.parser.add_argument("--maxrate", help="Maximum number of requests per second sent to a host", action='store', type=float, default=fetch_whois.MAXRATE)
+        cassette = self.parser.add_mutually_exclusive_group()
+        cassette.add_argument("--record", help="Record all lookups to the given cassette file", type=str)
+        cassette.add_argument("--replay", help="Answer all lookups from the given cassette file", type=str)
+        self.parser.add_argument("--realtime", help="Replay lookups at their recorded latencies", action="store_true")
 
     def parse_objs_from_file(self, rsrcfile):
         """Extract resource handles from the given file.
@@ -1007,16 +1514,28 @@ class WhoisOptParser:
             A GenericStore object corresponding to the selected data
             store type.
         """
-        if p.nostore:
-            store = fetch_whois.GenericStore()
-        elif p.hashstore:
-            store = fetch_whois.HashStore() 
-        elif p.dbstore:
-            dbhost, dbport = p.dbstore
-            store = fetch_whois.DBStore(dbhost, dbport)
-        else:
-            store = fetch_whois.DBStore(DBHOST, DBPORT)
-        return store
+        return make_store(p)
+
+    def parse_storespec(self, p, procs=1):
+        """Extract a picklable description of the data store.
+
+        Each of the processes that build a store gets an equal share of
+        the per-host request rate, so that together they stay within
+        the rate that was asked for.
+
+        Args:
+            p(Namespace): Contains various command line parameters.
+            procs (int): The number of processes that build the store.
+
+        Returns:
+            A (function, args) pair that builds the store selected by
+            the options, as expected by init_worker().
+        """
+        storeopts = dict((k, getattr(p, k)) for k in STOREOPTS)
+        if procs > 1:
+            storeopts['rate'] = p.rate / procs
+            storeopts['maxrate'] = p.maxrate / procs
+        return (make_store, (argparse.Namespace(**storeopts),))
 
     def parse_opts(self, p):
         """Parse the list of options given in the parser namespace.
@@ -1038,6 +1557,7 @@ class WhoisOptParser:
 
         opts['objlist'] = self.parse_objs(p)
         opts['store'] = self.parse_store(p)
+        opts['storespec'] = self.parse_storespec(p)
 
         if p.extended:
             opts['extended'] = True
@@ -1054,6 +1574,11 @@ class WhoisOptParser:
         else:
             opts['cjsonfile'] = None
 
+        if p.metricsfile:
+            opts['metricsfile'] = p.metricsfile
+        else:
+            opts['metricsfile'] = None
+
         return opts
 
     def parse(self, argv):
@@ -1099,6 +1624,17 @@ class AnalyzeOptExtension():
         self.parser.add_argument("-G", "--clustergraph", help="Include graph image in report", action='store_true')
         self.parser.add_argument("-P", "--clusterplot", help="Include resource plot in report", action='store_true')
         self.parser.add_argument("-R", "--rvdb", help="Check against given Route Views Database file", type=str)
+        self.parser.add_argument("-C", "--concurrency", help="Number of lookups to run in parallel", action='store', type=int, default=fetch_whois.CONCURRENCY)
+        self.parser.add_argument("--prefetch", help="Number of association lookups to run ahead of the crawl", action='store', type=int, default=fetch_whois.PREFETCH)
+        self.parser.add_argument("-W", "--worklist", help="Crawl one level at a time with batched lookups", action='store_true')
+        self.parser.add_argument("--maxqueries", help="Stop the crawl after this many lookups", action='store', type=int)
+        self.parser.add_argument("--maxdepth", help="Do not follow references further than this many hops from a seed", action='store', type=int)
+        self.parser.add_argument("--maxtime", help="Stop the crawl after this many seconds", action='store', type=float)
+        self.parser.add_argument("--checkpoint", help="Periodically save the crawl state to this file (implies --worklist)", type=str)
+        self.parser.add_argument("--checkpointinterval", help="Minimum number of seconds between two checkpoints", action='store', type=float, default=fetch_whois.CHECKPOINTINTERVAL)
+        self.parser.add_argument("--resume", help="Continue the crawl from the last checkpoint", action='store_true')
+        self.parser.add_argument("--procs", help="Number of worker processes that crawl seeds in parallel (requires -D or -F); the --rate and --maxrate of each host are split evenly between them", action='store', type=int, default=1)
+        self.parser.add_argument("--communities", help="Color the graph by Louvain communities", action='store_true')
 
     def parse(self, argv):
         """Parse the list of options.
@@ -1112,6 +1648,10 @@ class AnalyzeOptExtension():
         # First call the main parse routine
         p = self.parser.parse_args(argv)
 
+        # Keep a pooled connection for every concurrent lookup
+        if p.concurrency + p.prefetch > p.poolsize:
+            p.poolsize = p.concurrency + p.prefetch
+
         # Then extract base options
         opts = self.base.parse_opts(p)
 
@@ -1119,6 +1659,28 @@ class AnalyzeOptExtension():
         opts['threshold'] = p.threshold
         opts['whitelist'] = p.whitelist
         opts['blacklist'] = p.blacklist
+        opts['concurrency'] = p.concurrency
+        opts['prefetch'] = p.prefetch
+        opts['worklist'] = p.worklist
+        opts['maxqueries'] = p.maxqueries
+        opts['maxdepth'] = p.maxdepth
+        opts['maxtime'] = p.maxtime
+        if p.resume and not p.checkpoint:
+            self.parser.error("--resume requires --checkpoint")
+        if p.checkpoint:
+            opts['checkpoint'] = fetch_whois.CrawlCheckpoint(p.checkpoint,
+                    p.checkpointinterval)
+        else:
+            opts['checkpoint'] = None
+        opts['resume'] = p.resume
+        if p.procs > 1 and (p.checkpoint or p.record):
+            self.parser.error("--procs cannot be combined with --checkpoint or --record")
+        if p.procs > 1 and not (p.dbstore or p.filestore):
+            self.parser.error("--procs requires a DB store (-D) or a file store (-F)")
+        opts['procs'] = p.procs
+        if p.procs > 1:
+            opts['storespec'] = self.base.parse_storespec(p, p.procs)
+        opts['communities'] = p.communities
         if p.rvdb:
             opts['rvdb'] = p.rvdb
         else:
@@ -1158,3 +1720,43 @@ class AnalyzeOptExtension():
             Str value containing formatted help text.
         """
         return self.parser.format_help()
+
+
+class ImportOptExtension():
+    """Class to parse options related to the bulk whois importer."""
+
+    def __init__(self, base):
+        """Constructor for the ImportOptExtension class.
+
+        Add arguments that are specific to the importer.
+
+        Args:
+            base(WhoisOptParser): The WhoisOptParser object associated with this extension.
+        """
+        self.base = base
+        self.parser = self.base.get_parser()
+        self.parser.add_argument("dumpfile", help="ARIN bulk whois XML dump (optionally gzipped)", nargs='+')
+        self.parser.add_argument("--batchsize", help="Number of objects written to the store at once", action='store', type=int, default=fetch_whois.BATCHSIZE)
+
+    def parse(self, argv):
+        """Parse the list of options.
+
+        Args:
+            A list of arguments provided in argv.
+
+        Returns:
+            A dict structure that contains different importer options.
+        """
+        p = self.parser.parse_args(argv)
+        opts = self.base.parse_opts(p)
+        opts['dumpfiles'] = p.dumpfile
+        opts['batchsize'] = p.batchsize
+        return opts
+
+    def get_help(self):
+        """Return the formatted help text.
+
+        Returns:
+            Str value containing formatted help text.
+        """
+        return self.parser.format_help()
@@ -8,42 +8,1330 @@ Attributes:
   verbose (boolean): Turns on verbosity of log messages.
 
 """
-from pymongo import MongoClient, collection
+from pymongo import MongoClient, ReplaceOne, collection, errors
 from bson.objectid import ObjectId
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from pprint import pprint
+import threading
+import atexit
+import os
+import Queue
+import random
+import time
+import json
+import sqlite3
+import zlib
+import gzip
 import urllib 
+import urlparse
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import xmltodict
 
+# Use the fastest JSON decoder that is available
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = json
+
 ###############################################################
 # Define some constants
 
 # ARIN REST API base URL
 BASE = "http://whois.arin.net/rest" 
 
+# Wire format requested from the REST API ('json' or 'xml')
+WIREFORMAT = 'json'
+
+# Accept headers for each wire format
+ACCEPT = {
+    'json': 'application/json',
+    'xml': 'application/xml',
+}
+
 # Don't follow dependencies when the count is greater
 # than this threshold
 THRESHOLD = 25
 
+# Maximum number of keep-alive connections kept per host
+POOLSIZE = 10
+
+# HTTP request timeout in seconds
+TIMEOUT = 30
+
+# Maximum number of ID strings resolved by a single batched DB lookup
+BATCHSIZE = 1000
+
+# Maximum number of ID strings in a single SQLite lookup (the default
+# SQLite limit on query parameters is 999)
+FILEBATCHSIZE = 900
+
+# Number of lookups the crawler runs in parallel
+CONCURRENCY = 1
+
+# Number of association lookups run ahead of the crawl (0 disables
+# prefetching)
+PREFETCH = 0
+
+# Association sub-resources looked up by the crawl for each collection
+# type
+ASSOCIATIONS = {
+    'poc': ['orgs', 'asns', 'nets'],
+    'org': ['pocs', 'asns', 'nets'],
+    'net': ['pocs'],
+    'asn': ['pocs'],
+}
+
+# Elements of an association list that reference objects of each
+# collection type
+REFKEYS = {
+    'poc': ['pocLinkRef', 'pocRef'],
+    'org': ['orgPocLinkRef', 'orgRef'],
+    'net': ['netPocLinkRef', 'netRef'],
+    'asn': ['asnPocLinkRef', 'asnRef'],
+}
+
+# Ephemeral collection types and the type of the objects they resolve to
+EPHEMERAL = {
+    'url': 'poc',
+    'orgstr': 'org',
+    'cidr': 'net',
+    'ip': 'net',
+}
+
+# Initial and maximum number of requests per second sent to a host
+RATE = 5.0
+MAXRATE = 20.0
+
+# The request rate is never reduced below this value
+MINRATE = 0.5
+
+# AIMD parameters: the rate grows by roughly INCREASE requests per second
+# every second, and is multiplied by DECREASE on throttling or errors
+INCREASE = 1.0
+DECREASE = 0.5
+
+# Number of times a lookup is retried after a transient error, and the
+# base and maximum delay (in seconds) between retries
+RETRIES = 3
+BACKOFF = 1.0
+MAXBACKOFF = 60.0
+
+# Lifetime (in seconds) of a cached "object does not exist" result
+NEGTTL = 7 * 24 * 3600
+
+# Back off when the smoothed latency exceeds the best seen latency by
+# this factor
+SLOWDOWN = 3.0
+
+# Number of queued writes of a collection type, and the maximum number
+# of seconds a write stays queued, before a write-behind buffer flushes
+WRITEBATCH = 500
+WRITEINTERVAL = 2.0
+
+# Minimum number of seconds between two checkpoints of a crawl
+CHECKPOINTINTERVAL = 60.0
+
+# Upper bounds (in seconds) of the store latency histogram buckets
+HISTBOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+        1.0, 2.0, 5.0, 10.0]
+
 ###############################################################
 # Globals
 
 global verbose
 verbose = False
 
+###############################################################
+# Helpers for results that carry no data
+
+def is_transient_status(status):
+    """Return True if a lookup with the given HTTP status may be retried.
+
+    Args:
+        status (int): The HTTP status code, or None if no response was
+                      received.
+    """
+    return status is None or status == 429 or status >= 500
+
+
+def empty_result(idstr, status, now=None):
+    """Build the result recorded for a lookup that returned no data.
+
+    Args:
+        idstr (str): The ID string.
+        status (int): The HTTP status code, or None if no response was
+                      received.
+        now (float): The lookup time. Defaults to the current time.
+
+    Returns:
+        A dict object that only identifies the object, the lookup
+        status and the lookup time.
+    """
+    result = {}
+    result["objID"] = idstr
+    result["objStatus"] = status
+    result["objTime"] = time.time() if now is None else now
+    return result
+
+
+def is_transient(result):
+    """Return True if the result stands for a transient lookup failure.
+
+    Such results must never be persisted.
+    """
+    return bool(result) and "objStatus" in result and \
+            is_transient_status(result["objStatus"])
+
+
+def is_empty(result):
+    """Return True if the result carries no whois data."""
+    if not result:
+        return True
+    for k in result.keys():
+        if k not in ("objID", "objStatus", "objTime", "_id"):
+            return False
+    return True
+
+
+def normalize_json(obj):
+    """Normalize a decoded ARIN JSON document to the xmltodict layout.
+
+    ARIN's JSON representation wraps element text in a '$' key and
+    keeps attributes as '@' keys. Elements that only hold text are
+    collapsed to their text value, '$' becomes '#text' and scalar
+    values become strings, so that the result has the same shape as
+    xmltodict.parse() applied to the XML representation.
+
+    Args:
+        obj: A decoded JSON value.
+
+    Returns:
+        The normalized value.
+    """
+    if isinstance(obj, dict):
+        if not obj:
+            return None
+        if len(obj) == 1 and '$' in obj:
+            return normalize_json(obj['$'])
+        result = {}
+        for (k, v) in obj.iteritems():
+            if k == '$':
+                k = '#text'
+            result[k] = normalize_json(v)
+        return result
+    elif isinstance(obj, list):
+        return [normalize_json(v) for v in obj]
+    elif isinstance(obj, bool):
+        return unicode(obj).lower()
+    elif isinstance(obj, (int, long, float)):
+        return unicode(obj)
+    return obj
+
+
+def parse_response(resp):
+    """Parse the body of a REST API response.
+
+    JSON bodies are decoded with the fastest available decoder and
+    normalized; anything else is parsed as XML.
+
+    Args:
+        resp (Response): The requests Response object.
+
+    Returns:
+        A dict object representing the result.
+    """
+    if 'json' in resp.headers.get('Content-Type', ''):
+        return normalize_json(fastjson.loads(resp.content))
+    return xmltodict.parse(resp.text)
+
+
+###############################################################
+# Compact whois records
+
+class WhoisRecord(object):
+    """Compact record holding the fields of a whois object that the
+    crawl and the reports use.
+
+    Fields are read like dict items, and fields that the object does not
+    have are absent, so a record can stand in for the parsed document.
+    The parsed document itself is only kept on demand.
+    """
+
+    __slots__ = ('_raw',)
+
+    # Fields kept for every collection type
+    fields = ('handle', 'name', 'registrationDate', 'orgRef', 'orgHandle')
+
+    def __init__(self, obj, keepraw=False):
+        """Project a parsed whois object onto a record.
+
+        Args:
+            obj (dict): The parsed object.
+            keepraw (boolean): If true, keep the parsed object as well.
+        """
+        for f in self.fields:
+            if f in obj:
+                v = obj[f]
+                if f == 'orgRef' and isinstance(v, dict):
+                    v = {'@handle': v.get('@handle')}
+                setattr(self, f, v)
+        self._raw = obj if keepraw else None
+
+    def __getitem__(self, key):
+        if key in self.fields and hasattr(self, key):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(" + repr(self.to_dict()) + ")"
+
+    def keys(self):
+        """Return the names of the fields that are set."""
+        return [f for f in self.fields if hasattr(self, f)]
+
+    def items(self):
+        """Return (name, value) tuples for the fields that are set."""
+        return [(f, getattr(self, f)) for f in self.keys()]
+
+    def get(self, key, default=None):
+        """Return the value of a field, or default if it is not set."""
+        if key in self:
+            return self[key]
+        return default
+
+    def to_dict(self):
+        """Return the parsed object if kept, or else the fields as a dict."""
+        if self._raw is not None:
+            return self._raw
+        return dict(self.items())
+
+
+class POCRecord(WhoisRecord):
+    """Compact Point of Contact record."""
+    fields = WhoisRecord.fields + ('companyName', 'firstName', 'lastName',
+            'phones', 'emails')
+    __slots__ = fields
+
+
+class OrgRecord(WhoisRecord):
+    """Compact Organization record."""
+    fields = WhoisRecord.fields
+    __slots__ = fields
+
+
+class NetRecord(WhoisRecord):
+    """Compact Net record."""
+    fields = WhoisRecord.fields + ('startAddress', 'endAddress',
+            'originASes')
+    __slots__ = fields
+
+
+class ASNRecord(WhoisRecord):
+    """Compact ASN record."""
+    fields = WhoisRecord.fields + ('startAsNumber', 'endAsNumber')
+    __slots__ = fields
+
+
+# Record type for each collection type
+RECORDS = {
+    'poc': POCRecord,
+    'org': OrgRecord,
+    'net': NetRecord,
+    'asn': ASNRecord,
+}
+
+
+def compact_refs(refs):
+    """Keep only the handles of a list of link references."""
+    if isinstance(refs, dict):
+        return {'@handle': refs.get('@handle')}
+    return [{'@handle': r.get('@handle')} for r in refs]
+
+
+def compact_result(result, keepraw=False):
+    """Replace the parsed whois data of a result with compact records.
+
+    Objects become WhoisRecord instances. Association lists keep only
+    the handles of their link references, unless the parsed data is
+    kept. Other keys are left as they are, except for database IDs.
+
+    Args:
+        result (dict): The result object.
+        keepraw (boolean): If true, records keep the parsed objects.
+
+    Returns:
+        A new result dict.
+    """
+    compact = {}
+    for (k, v) in result.items():
+        if k in RECORDS and isinstance(v, dict):
+            compact[k] = RECORDS[k](v, keepraw)
+        elif k[:-1] in RECORDS and isinstance(v, dict) and not keepraw:
+            compact[k] = dict((ref, compact_refs(refs)) for (ref, refs)
+                    in v.items() if ref.endswith('Ref'))
+        elif k != '_id':
+            compact[k] = v
+    return compact
+
+
+def expand_result(result):
+    """Turn any records in a result back into plain dicts."""
+    return dict((k, v.to_dict() if isinstance(v, WhoisRecord) else v)
+            for (k, v) in result.items())
+
+
+###############################################################
+# Request rate limiting
+
+class TokenBucket:
+    """Token bucket for a single host with an adaptive refill rate."""
+
+    def __init__(self, rate, maxrate, minrate, now):
+        self.rate = rate
+        self.maxrate = max(rate, maxrate)
+        self.minrate = min(rate, minrate)
+        self.tokens = 1.0
+        self.last = now
+        self.lastdecrease = 0.0
+        self.latency = None
+        self.baseline = None
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0,
+                'slow': 0, 'backoffs': 0, 'waited': 0.0}
+
+    def reserve(self, now):
+        """Take a token and return the time to wait before using it."""
+        self.tokens = min(1.0, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1.0
+        self.stats['requests'] += 1
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        self.stats['waited'] += wait
+        return wait
+
+    def decrease(self, now):
+        """Multiplicatively decrease the rate, at most once per round trip."""
+        if self.latency and now - self.lastdecrease < self.latency:
+            return
+        self.lastdecrease = now
+        self.rate = max(self.minrate, self.rate * DECREASE)
+        self.stats['backoffs'] += 1
+
+    def increase(self):
+        """Additively increase the rate."""
+        self.rate = min(self.maxrate, self.rate + INCREASE / self.rate)
+
+
+class RateLimiter:
+    """Per-host request scheduler with AIMD rate control.
+
+    Each host gets a token bucket that starts at the initial rate. The
+    rate is increased additively after every successful request and
+    halved when the host throttles us (429), fails (5xx or no response)
+    or when the smoothed latency rises well above its best value.
+    """
+
+    def __init__(self, rate=RATE, maxrate=MAXRATE, minrate=MINRATE,
+            clock=time.time, sleep=time.sleep):
+        """Instantiate a rate limiter.
+
+        Args:
+            rate (float): The initial number of requests per second.
+            maxrate (float): The maximum number of requests per second.
+            minrate (float): The minimum number of requests per second.
+            clock (function): Returns the current time in seconds.
+            sleep (function): Waits for the given number of seconds.
+        """
+        self.rate = rate
+        self.maxrate = maxrate
+        self.minrate = minrate
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, host):
+        """Return the token bucket for the given host."""
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.maxrate,
+                    self.minrate, self.clock())
+        return self.buckets[host]
+
+    def acquire(self, host):
+        """Block until a request may be sent to the given host.
+
+        Args:
+            host (str): The host name.
+        """
+        with self.lock:
+            wait = self.get_bucket(host).reserve(self.clock())
+        if wait > 0:
+            self.sleep(wait)
+
+    def update(self, host, status, latency):
+        """Adjust the rate for the given host from a request outcome.
+
+        Args:
+            host (str): The host name.
+            status (int): The HTTP status code, or None if no response
+                          was received.
+            latency (float): The request latency in seconds.
+        """
+        now = self.clock()
+        with self.lock:
+            b = self.get_bucket(host)
+            oldrate = b.rate
+            if status == 429:
+                b.stats['throttled'] += 1
+                b.decrease(now)
+            elif status is None or status >= 500:
+                b.stats['errors'] += 1
+                b.decrease(now)
+            else:
+                if b.latency is None:
+                    b.latency = latency
+                else:
+                    b.latency = 0.8 * b.latency + 0.2 * latency
+                if b.baseline is None or b.latency < b.baseline:
+                    b.baseline = b.latency
+                if b.latency > b.baseline * SLOWDOWN:
+                    b.stats['slow'] += 1
+                    b.decrease(now)
+                else:
+                    b.increase()
+            if verbose and b.rate < oldrate:
+                print "Reducing request rate for %s to %.2f/s" % (host, b.rate)
+
+    def get_stats(self):
+        """Return the live rate limiting statistics.
+
+        Returns:
+            A dict indexed by host. Each value is a dict holding the
+            current rate, smoothed latency and the number of requests,
+            throttled responses, errors, slow responses, backoffs and
+            the total time spent waiting for a token.
+        """
+        stats = {}
+        with self.lock:
+            for host in self.buckets.keys():
+                b = self.buckets[host]
+                stats[host] = dict(b.stats)
+                stats[host]['rate'] = b.rate
+                stats[host]['latency'] = b.latency
+        return stats
+
+
+###############################################################
+# HTTP session shared by the data stores
+
+# The number of connections set up by the request in progress on each
+# thread
+connstate = threading.local()
+
+
+def note_connection():
+    """Count a connection set up on behalf of the current thread."""
+    connstate.opened = getattr(connstate, 'opened', 0) + 1
+
+
+class CountingHTTPConnection(HTTPConnection):
+    """HTTP connection that reports every connection it sets up."""
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        note_connection()
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that reports every connection it sets up."""
+
+    def connect(self):
+        HTTPSConnection.connect(self)
+        note_connection()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class CountingAdapter(HTTPAdapter):
+    """Transport adapter whose pools report new connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+                'http': CountingHTTPConnectionPool,
+                'https': CountingHTTPSConnectionPool}
+
+
+class WhoisSession:
+    """Keep-alive HTTP session with a reusable connection pool."""
+
+    def __init__(self, poolsize=POOLSIZE, timeout=TIMEOUT, limiter=None,
+            retries=RETRIES, backoff=BACKOFF, wireformat=WIREFORMAT,
+            sleep=time.sleep):
+        """Instantiate a session object.
+
+        Args:
+            poolsize (int): The maximum number of connections that are
+                            kept open per host.
+
+            timeout (float or tuple): The request timeout in seconds.
+                                      A (connect, read) tuple sets the
+                                      two timeouts separately.
+
+            limiter (RateLimiter): If not None, schedule requests
+                                   through this rate limiter.
+
+            retries (int): The number of times a request is retried
+                           after a transient error.
+
+            backoff (float): The base delay in seconds between retries.
+
+            wireformat (str): The representation requested from the
+                              server, either 'json' or 'xml'.
+
+            sleep (function): Waits for the given number of seconds.
+        """
+        self.timeout = timeout
+        self.headers = {'Accept': ACCEPT[wireformat]}
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.session = requests.Session()
+        self.adapter = CountingAdapter(pool_connections=poolsize,
+                pool_maxsize=poolsize)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                'retries': 0, 'newtime': 0.0, 'reusetime': 0.0}
+
+    def get(self, url):
+        """Issue a GET request, retrying after transient errors.
+
+        Throttling (429), server errors (5xx) and failed connections are
+        retried with jittered exponential backoff. A Retry-After header
+        sent with a 429 response is honoured, unless it asks us to wait
+        longer than the maximum backoff; the lookup then fails right
+        away so that the worker is not blocked.
+
+        Args:
+            url (str): The URL to fetch.
+
+        Returns:
+            The requests Response object for the last attempt.
+
+        Raises:
+            requests.exceptions.RequestException if the last attempt
+            did not get a response.
+        """
+        attempt = 0
+        while True:
+            # Jittered exponential backoff
+            delay = random.uniform(0.5, 1.0) * \
+                    min(MAXBACKOFF, self.backoff * (2 ** attempt))
+            try:
+                resp = self.send(url)
+                if not is_transient_status(resp.status_code):
+                    return resp
+                retryafter = resp.headers.get('Retry-After')
+                if retryafter and retryafter.isdigit():
+                    if float(retryafter) > MAXBACKOFF:
+                        if verbose:
+                            print "Giving up on %s: asked to retry after %ss" % (url, retryafter)
+                        return resp
+                    delay = max(delay, float(retryafter))
+                reason = str(resp.status_code)
+            except requests.exceptions.RequestException as e:
+                if attempt >= self.retries:
+                    raise
+                resp = None
+                reason = str(e)
+            if attempt >= self.retries:
+                return resp
+            attempt += 1
+            if verbose:
+                print "Retrying %s in %.1fs (%s)" % (url, delay, reason)
+            with self.lock:
+                self.stats['retries'] += 1
+            self.sleep(delay)
+
+    def send(self, url):
+        """Issue a single GET request over a pooled connection.
+
+        Args:
+            url (str): The URL to fetch.
+
+        Returns:
+            The requests Response object.
+        """
+        host = urlparse.urlparse(url).netloc
+        if self.limiter:
+            self.limiter.acquire(host)
+        start = time.time()
+        # Connections are set up on the requesting thread, so this
+        # tells us whether this request needed a new one
+        connstate.opened = 0
+        try:
+            resp = self.session.get(url, headers=self.headers,
+                    timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            if self.limiter:
+                self.limiter.update(host, None, time.time() - start)
+            raise
+        elapsed = resp.elapsed.total_seconds()
+        if self.limiter:
+            self.limiter.update(host, resp.status_code, elapsed)
+        opened = connstate.opened
+        with self.lock:
+            self.stats['requests'] += 1
+            if opened:
+                # A new connection had to be set up for this request
+                self.stats['connections'] += opened
+                self.stats['newtime'] += elapsed
+            else:
+                self.stats['reused'] += 1
+                self.stats['reusetime'] += elapsed
+        return resp
+
+    def get_limiter(self):
+        """Return the rate limiter for this session, if any."""
+        return self.limiter
+
+    def get_stats(self):
+        """Return connection reuse statistics for this session.
+
+        Each request is counted as opening a connection if a connection
+        was set up on its behalf, and as reusing one otherwise. The
+        latency saved is estimated from the difference between the
+        mean latency of requests that opened a new connection and that
+        of requests that reused one.
+
+        Returns:
+            A dict with the number of requests, connections opened,
+            connections reused, mean latencies and the estimated time
+            saved (in seconds).
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        fresh = stats['requests'] - stats['reused']
+        stats['newlatency'] = 0.0
+        stats['reuselatency'] = 0.0
+        stats['saved'] = 0.0
+        if fresh:
+            stats['newlatency'] = stats['newtime'] / fresh
+        if stats['reused']:
+            stats['reuselatency'] = stats['reusetime'] / stats['reused']
+        if fresh and stats['reused']:
+            stats['saved'] = max(0.0, stats['reused'] *
+                    (stats['newlatency'] - stats['reuselatency']))
+        return stats
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+
+class CassetteSession(WhoisSession):
+    """Session that records lookups to, or replays them from, a cassette.
+
+    A cassette is a gzipped file holding one JSON record per lookup,
+    with the URL, the final HTTP status, the content type and body of
+    the response, and the time the lookup took (retries included).
+    Failed lookups are recorded with the error message instead.
+    """
+
+    def __init__(self, path, record=False, realtime=False,
+            poolsize=POOLSIZE, timeout=TIMEOUT, limiter=None,
+            retries=RETRIES, backoff=BACKOFF, wireformat=WIREFORMAT,
+            sleep=time.sleep):
+        """Instantiate a cassette session.
+
+        Args:
+            path (str): The path to the cassette file.
+
+            record (boolean): If true, issue real lookups and record
+                              them to a new cassette; if false, answer
+                              lookups from the cassette only.
+
+            realtime (boolean): If true, replayed lookups take as long
+                                as they did when they were recorded.
+
+            sleep (function): Waits for the given number of seconds
+                              between retries, and when replaying in
+                              real time.
+
+            The remaining arguments are passed on to WhoisSession and
+            only matter when recording.
+        """
+        WhoisSession.__init__(self, poolsize, timeout, limiter, retries,
+                backoff, wireformat, sleep)
+        self.path = path
+        self.recording = record
+        self.realtime = realtime
+        self.sleep = sleep
+        self.tape = {}
+        self.out = None
+        self.stats['replayed'] = 0
+        self.stats['missing'] = 0
+        if record:
+            self.out = gzip.open(path, 'wb')
+            # Make sure the cassette is complete when the process exits
+            atexit.register(self.close)
+        else:
+            f = gzip.open(path, 'rb')
+            try:
+                for line in f:
+                    entry = json.loads(line)
+                    self.tape[entry['url']] = entry
+            finally:
+                f.close()
+
+    def get(self, url):
+        """Look up the given URL, recording or replaying the lookup.
+
+        Args:
+            url (str): The URL to fetch.
+
+        Returns:
+            The requests Response object.
+
+        Raises:
+            requests.exceptions.RequestException if the lookup failed,
+            or if it is not on the cassette when replaying.
+        """
+        if self.recording:
+            return self.record(url)
+        return self.replay(url)
+
+    def record(self, url):
+        """Issue a real lookup and append it to the cassette."""
+        entry = {'url': url}
+        start = time.time()
+        try:
+            resp = WhoisSession.get(self, url)
+        except requests.exceptions.RequestException as e:
+            entry['error'] = str(e)
+            raise
+        else:
+            entry['status'] = resp.status_code
+            entry['type'] = resp.headers.get('Content-Type', '')
+            entry['body'] = resp.text
+        finally:
+            entry['latency'] = time.time() - start
+            line = json.dumps(entry, separators=(',', ':')) + "\n"
+            with self.lock:
+                if self.out:
+                    self.out.write(line)
+        return resp
+
+    def replay(self, url):
+        """Answer a lookup from the cassette."""
+        entry = self.tape.get(url)
+        with self.lock:
+            self.stats['requests'] += 1
+            if entry:
+                self.stats['replayed'] += 1
+            else:
+                self.stats['missing'] += 1
+        if not entry:
+            raise requests.exceptions.ConnectionError(url + " is not on the cassette")
+        if self.realtime:
+            self.sleep(entry['latency'])
+        if 'error' in entry:
+            raise requests.exceptions.ConnectionError(entry['error'])
+        resp = requests.Response()
+        resp.url = url
+        resp.status_code = entry['status']
+        resp.headers['Content-Type'] = entry['type']
+        resp.encoding = 'utf-8'
+        resp._content = entry['body'].encode('utf-8')
+        return resp
+
+    def close(self):
+        """Close the cassette and all pooled connections."""
+        with self.lock:
+            if self.out:
+                self.out.close()
+                self.out = None
+        WhoisSession.close(self)
+
+
+###############################################################
+# Bounded in-memory cache
+
+def sizeof(result):
+    """Estimate the memory footprint of a result object.
+
+    The length of the compact JSON encoding is used as a proxy for the
+    size of the object.
+    """
+    return len(json.dumps(result, separators=(',', ':'), default=encode_default))
+
+
+def encode_default(obj):
+    """Encode objects that JSON does not know about."""
+    if isinstance(obj, WhoisRecord):
+        return obj.to_dict()
+    return str(obj)
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction.
+
+    Lookups, insertions and evictions are all O(1). If neither bound is
+    given the cache grows without limit.
+    """
+
+    def __init__(self, maxentries=None, maxbytes=None):
+        """Instantiate an LRU cache.
+
+        Args:
+            maxentries (int): The maximum number of entries.
+            maxbytes (int): The maximum estimated size of all entries.
+        """
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Look up a key and mark it as most recently used.
+
+        Args:
+            key: The cache key.
+
+        Returns:
+            A tuple of two values: whether the key was found and the
+            cached value.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return (False, None)
+            item = self.entries.pop(key)
+            self.entries[key] = item
+            return (True, item[0])
+
+    def put(self, key, value):
+        """Add or replace an entry, evicting old entries if needed.
+
+        Args:
+            key: The cache key.
+            value: The value to cache.
+
+        Returns:
+            The list of keys that were evicted.
+        """
+        size = 0
+        if self.maxbytes:
+            size = sizeof(value)
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while len(self.entries) > 1 and \
+                    ((self.maxentries and len(self.entries) > self.maxentries) or
+                     (self.maxbytes and self.bytes > self.maxbytes)):
+                (k, item) = self.entries.popitem(last=False)
+                self.bytes -= item[1]
+                evicted.append(k)
+        return evicted
+
+    def remove(self, key):
+        """Drop an entry if it is present."""
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+    def get_size(self):
+        """Return the number of entries and their estimated size."""
+        return (len(self.entries), self.bytes)
+
+
+###############################################################
+# Store metrics
+
+class LatencyHistogram:
+    """Histogram of durations with fixed bucket bounds."""
+
+    def __init__(self, bounds=HISTBOUNDS):
+        """Instantiate an empty histogram.
+
+        Args:
+            bounds (list of float): The upper bounds (in seconds) of all
+                                    buckets but the last, in ascending
+                                    order.
+        """
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """Record a duration."""
+        i = 0
+        while i < len(self.bounds) and seconds > self.bounds[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Estimate a percentile from the bucket bounds.
+
+        Args:
+            p (float): The percentile, between 0 and 100.
+
+        Returns:
+            The upper bound of the bucket holding the percentile (the
+            maximum for the last bucket), or None if empty.
+        """
+        if not self.count:
+            return None
+        rank = p * self.count / 100.0
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        """Return the histogram as a JSON-serializable dict."""
+        buckets = OrderedDict()
+        for (i, n) in enumerate(self.buckets):
+            if i < len(self.bounds):
+                buckets["<=" + str(self.bounds[i])] = n
+            else:
+                buckets[">" + str(self.bounds[-1])] = n
+        h = OrderedDict()
+        h['count'] = self.count
+        h['total'] = self.total
+        h['mean'] = self.total / self.count if self.count else None
+        h['min'] = self.min
+        h['max'] = self.max
+        h['p50'] = self.percentile(50)
+        h['p90'] = self.percentile(90)
+        h['p99'] = self.percentile(99)
+        h['buckets'] = buckets
+        return h
+
+
+class StoreMetrics:
+    """Per collection type counters and latency histograms of a store."""
+
+    def __init__(self):
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.histograms = defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def count(self, ctype, counter, n=1):
+        """Increment a counter for the given collection type."""
+        with self.lock:
+            self.counters[ctype][counter] += n
+
+    def observe(self, ctype, name, seconds):
+        """Record a duration in the named histogram of a collection type."""
+        with self.lock:
+            h = self.histograms[ctype].get(name)
+            if not h:
+                h = self.histograms[ctype][name] = LatencyHistogram()
+            h.add(seconds)
+
+    def get_counters(self, ctype):
+        """Return a copy of the counters of a collection type."""
+        with self.lock:
+            return dict(self.counters.get(ctype, {}))
+
+    def get_metrics(self):
+        """Return all metrics as a JSON-serializable dict.
+
+        Returns:
+            A dict indexed by collection type. Each value holds a dict
+            of counters and a dict of latency histograms.
+        """
+        with self.lock:
+            ctypes = set(self.counters.keys()) | set(self.histograms.keys())
+            metrics = {}
+            for ctype in ctypes:
+                metrics[ctype] = {
+                    'counters': dict(self.counters.get(ctype, {})),
+                    'latency': dict((k, h.to_dict()) for (k, h) in
+                        self.histograms.get(ctype, {}).items()),
+                }
+            return metrics
+
+
+###############################################################
+# Write-behind buffer for persistent stores
+
+class WriteBehind:
+    """Buffer that batches writes to a store and flushes them later.
+
+    New objects are queued per collection type and written in bulk once
+    a batch is full or the oldest queued object has waited long enough.
+    Objects stay visible through get() until they have been written.
+    A batch that fails to be written is queued again. Buffers that are
+    still open when the process exits are closed by close_writers().
+    """
+
+    def __init__(self, write, batchsize=WRITEBATCH, interval=WRITEINTERVAL,
+            retries=RETRIES, backoff=BACKOFF, sleep=time.sleep):
+        """Instantiate a write-behind buffer.
+
+        Args:
+            write (function): Called as write(ctype, results) to store
+                              a list of result objects.
+            batchsize (int): The number of queued objects of a type that
+                             triggers a flush.
+            interval (float): The maximum number of seconds an object
+                              stays queued.
+            retries (int): The number of times the final flush is
+                           retried after a failed write.
+            backoff (float): The base delay in seconds between retries
+                             of the final flush.
+            sleep (function): Waits for the given number of seconds.
+        """
+        self.write = write
+        self.batchsize = batchsize
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self.pending = defaultdict(OrderedDict)
+        self.inflight = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.flushlock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.stats = {'queued': 0, 'written': 0, 'flushes': 0,
+                'failures': 0, 'dropped': 0}
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        with writerslock:
+            writers.append(self)
+
+    def put(self, ctype, result):
+        """Queue a result object for writing.
+
+        Args:
+            ctype (str): The collection type.
+            result (dict): The result object.
+        """
+        with self.lock:
+            self.pending[ctype][result["objID"]] = result
+            self.stats['queued'] += 1
+            full = len(self.pending[ctype]) >= self.batchsize
+        if full:
+            self.wakeup.set()
+
+    def get(self, ctype, idstr):
+        """Return a queued or unwritten object, or None."""
+        with self.lock:
+            result = self.pending[ctype].get(idstr)
+            if result is None:
+                result = self.inflight[ctype].get(idstr)
+            return result
+
+    def run(self):
+        """Flush queued objects in the background."""
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all queued objects.
+
+        The objects of a batch that fails to be written are queued
+        again, unless they have been queued anew in the meantime.
+
+        Returns:
+            True if all batches were written.
+        """
+        ok = True
+        with self.flushlock:
+            with self.lock:
+                batches = [(c, p.values()) for (c, p) in self.pending.items() if p]
+                for (ctype, results) in batches:
+                    self.inflight[ctype] = self.pending[ctype]
+                    self.pending[ctype] = OrderedDict()
+            for (ctype, results) in batches:
+                try:
+                    self.write(ctype, results)
+                    n = len(results)
+                    failed = 0
+                except Exception as e:
+                    print "Write-behind flush failed for " + ctype + ": " + str(e)
+                    n = 0
+                    failed = 1
+                    ok = False
+                with self.lock:
+                    if failed:
+                        # Newer objects win over the ones we failed to write
+                        requeued = self.inflight[ctype]
+                        requeued.update(self.pending[ctype])
+                        self.pending[ctype] = requeued
+                    self.inflight[ctype] = {}
+                    self.stats['written'] += n
+                    self.stats['flushes'] += 1
+                    self.stats['failures'] += failed
+        return ok
+
+    def close(self):
+        """Stop the background thread and write everything still queued.
+
+        Failed writes are retried with exponential backoff. Objects that
+        still cannot be written are dropped.
+
+        Returns:
+            The number of objects that were dropped.
+        """
+        self.stopped = True
+        self.wakeup.set()
+        with writerslock:
+            if self in writers:
+                writers.remove(self)
+        attempt = 0
+        while not self.flush():
+            if attempt >= self.retries:
+                with self.lock:
+                    dropped = sum(len(p) for p in self.pending.values())
+                    self.pending.clear()
+                    self.stats['dropped'] += dropped
+                print "Write-behind dropped %d objects" % dropped
+                return dropped
+            self.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+        return 0
+
+    def get_stats(self):
+        """Return the number of queued, written and dropped objects and
+        of flushes."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['pending'] = sum(len(p) for p in self.pending.values())
+        return stats
+
+
+# Write-behind buffers that have not been closed yet
+writers = []
+writerslock = threading.Lock()
+
+def close_writers():
+    """Close all open write-behind buffers.
+
+    This is run when the process exits, so that queued objects are
+    written.
+
+    Returns:
+        The number of objects that could not be written.
+    """
+    with writerslock:
+        pending = list(writers)
+    return sum(w.close() for w in pending)
+
+atexit.register(close_writers)
+
+
 ###############################################################
 # The following classes implement our data store
 # The store can be one of the following types 
 # 1) Generic: No caching, serves as our base class
 # 2) Hash: Persistent for the process lifetime duration
 # 3) DB: DB-based, therefore persistent on disk
+# 4) File: Embedded SQLite file, persistent on disk without a DB server
 
 class GenericStore:
     """Base class for all data stores with no caching support."""
 
-    def __init__(self, base=BASE):
+    def __init__(self, base=BASE, session=None, negttl=NEGTTL,
+            clock=time.time):
+        """Instantiate a store object.
+
+        Args:
+            base (str): The base URL for lookups.
+
+            session (WhoisSession): The HTTP session used for queries.
+                                    A new session is created if none is
+                                    given.
+
+            negttl (int): The number of seconds for which a cached
+                          "object does not exist" result is valid.
+
+            clock (function): Returns the current time in seconds.
+        """
         self.base = base
+        if session:
+            self.session = session
+        else:
+            self.session = WhoisSession()
+        self.negttl = negttl
+        self.clock = clock
+        self.tier = None
+        self.compacting = False
+        self.keepraw = False
+        self.metrics = StoreMetrics()
+        self.lock = threading.Lock()
+
+    def is_stale(self, result):
+        """Check whether a cached result must be looked up again.
+
+        Results without data expire after the negative cache TTL.
+        Transient failures, and results without data cached before
+        lookup times were recorded, are always stale.
+
+        Args:
+            result (dict): The cached result object.
+
+        Returns:
+            True if the result should be refreshed.
+        """
+        if not is_empty(result):
+            return False
+        if is_transient(result) or "objTime" not in result:
+            return True
+        return self.clock() - result["objTime"] > self.negttl
 
     def get_idstr(self, typepfx, handle):
         """Determine the set of IDs for given type and handle.
@@ -63,28 +1351,40 @@ class GenericStore:
         idstr = self.base + "/" + typepfx + "/" + urllib.quote(str(handle))
         return (handle, [(typepfx, idstr)])
 
-    def query(self, idstr):
+    def query(self, idstr, ctype=None):
         """Query the data store for the given ID string.
 
         This is the common query method for all types of data stores.
 
         Args:
             idstr (str): The ID string.
+            ctype (str): The collection type, under which the lookup
+                         is accounted for in the store metrics.
 
         Returns:
             A dict object representing the result.
         """
         print "Looking up " + idstr
-        resp = requests.get(idstr)
+        self.count(ctype, 'fetches')
+        start = time.time()
+        try:
+            resp = self.session.get(idstr)
+        except requests.exceptions.RequestException as e:
+            print "Lookup failed for " + idstr + ": " + str(e)
+            self.count(ctype, 'failures')
+            return empty_result(idstr, None, self.clock())
+        finally:
+            self.observe(ctype, 'fetch', start)
+        self.count(ctype, 'bytes', len(resp.content))
         if resp.status_code != requests.codes.ok:
             if verbose:
                 print "No data returned for " + idstr
-            result = {}
+            self.count(ctype, 'empty')
             # Remember the fact that we already looked up this data
-            result["objID"] = idstr
-            return result
-        xmltext = resp.text
-        result = xmltodict.parse(xmltext)
+            return empty_result(idstr, resp.status_code, self.clock())
+        start = time.time()
+        result = parse_response(resp)
+        self.observe(ctype, 'parse', start)
         # Use a custom identifier
         result["objID"] = idstr
         return result
@@ -95,108 +1395,1750 @@ class GenericStore:
         No caching is done in this routine. Just query and return.
 
         Args:
-            ctype (str): The collection type.
-            idstr (str): The location reference for the whois object.
+            ctype (str): The collection type.
+            idstr (str): The location reference for the whois object.
+
+        Returns:
+            A dict object representing the result.
+        """
+        result = self.query(idstr, ctype)
+        return self.compact(result)
+
+    def fetch_many(self, ctype, idstrs):
+        """Fetch data for a list of ID strings of the same collection type.
+
+        This default implementation fetches each object in turn. Stores
+        that can resolve several objects at once override it.
+
+        Args:
+            ctype (str): The collection type.
+            idstrs (list of str): The location references for the
+                                  whois objects.
+
+        Returns:
+            A dict of result objects indexed by ID string.
+        """
+        results = {}
+        for idstr in idstrs:
+            if idstr not in results:
+                results[idstr] = self.fetch(ctype, idstr)
+        return results
+
+    def save_many(self, ctype, results):
+        """Store a list of result objects of the same collection type.
+
+        Existing objects with the same ID strings are replaced. The
+        generic store keeps no data, so nothing is done here.
+
+        Args:
+            ctype (str): The collection type.
+            results (list of dict): The result objects.
+
+        Returns:
+            None.
+        """
+        pass
+
+    def flush(self):
+        """Write any queued data.
+
+        Only stores with a write-behind buffer queue data, so nothing is
+        done here.
+        """
+        pass
+
+    def get_writer_stats(self):
+        """Return the write-behind statistics, or None if disabled."""
+        return None
+
+    def fetchAssociated(self, obj, idstr):
+        """Fetch an object's associated data, given an ID string.
+
+        Args:
+            obj (str): The object for which we are seeking associated data.
+            idstr (str): The ID string.
+
+        Returns:
+            A dict object representing the result.
+        """
+        return self.fetch(obj.get_type(), idstr)
+
+    def get_session(self):
+        """Return the HTTP session associated with this store."""
+        return self.session
+
+    def get_session_stats(self):
+        """Return the connection reuse statistics for this store.
+
+        Returns:
+            A dict of statistics as returned by WhoisSession.get_stats().
+        """
+        return self.session.get_stats()
+
+    def set_compact(self, keepraw=False):
+        """Hand out compact records instead of parsed whois objects.
+
+        Data is stored in full, and compacted on its way out of the
+        store, before it is cached in memory.
+
+        Args:
+            keepraw (boolean): If true, records keep the parsed objects.
+        """
+        self.compacting = True
+        self.keepraw = keepraw
+
+    def compact(self, result):
+        """Compact a result object if this store hands out records."""
+        if not self.compacting or not result:
+            return result
+        return compact_result(result, self.keepraw)
+
+    def set_tier(self, maxentries=None, maxbytes=None):
+        """Put an in-memory LRU tier in front of the store.
+
+        Args:
+            maxentries (int): The maximum number of objects in the tier.
+            maxbytes (int): The maximum estimated size of all objects
+                            in the tier.
+        """
+        self.tier = LRUCache(maxentries, maxbytes)
+
+    def tier_get(self, ctype, idstr, local=False):
+        """Look for an object in the in-memory tier.
+
+        Args:
+            ctype (str): The collection type.
+            idstr (str): The ID string.
+            local (boolean): If true, stale results are still used.
+
+        Returns:
+            The result object, or None if the tier holds no usable
+            result.
+        """
+        if self.tier is None:
+            return None
+        (found, result) = self.tier.get((ctype, idstr))
+        if found and (local or not self.is_stale(result)):
+            self.count(ctype, 'hits')
+            return result
+        self.count(ctype, 'misses')
+        return None
+
+    def tier_put(self, ctype, idstr, result):
+        """Add an object to the in-memory tier.
+
+        Transient failures are never kept.
+
+        Args:
+            ctype (str): The collection type.
+            idstr (str): The ID string.
+            result (dict): The result object.
+        """
+        if self.tier is None:
+            return
+        if is_transient(result):
+            self.tier.remove((ctype, idstr))
+            return
+        for (c, i) in self.tier.put((ctype, idstr), result):
+            self.count(c, 'evictions')
+
+    def count(self, ctype, counter, n=1):
+        """Increment a metrics counter for the given collection type."""
+        self.metrics.count(ctype, counter, n)
+
+    def observe(self, ctype, name, start):
+        """Record the time elapsed since start in a latency histogram.
+
+        Args:
+            ctype (str): The collection type.
+            name (str): The histogram name.
+            start (float): The start time, as returned by time.time().
+        """
+        self.metrics.observe(ctype, name, time.time() - start)
+
+    def get_metrics(self):
+        """Return the metrics collected by this store.
+
+        Returns:
+            A dict with the counters and latency histograms indexed by
+            collection type ('ctypes') and the HTTP session statistics
+            ('http').
+        """
+        return {'ctypes': self.metrics.get_metrics(),
+                'http': self.get_session_stats()}
+
+    def get_cache_stats(self):
+        """Return the in-memory cache statistics for this store.
+
+        Returns:
+            A dict indexed by collection type; each value is a dict of
+            hit, miss and eviction counters. Stores without an in-memory
+            cache return an empty dict.
+        """
+        stats = {}
+        for (ctype, m) in self.metrics.get_metrics().items():
+            c = m['counters']
+            cache = dict((k, v) for (k, v) in c.items()
+                    if k in ('hits', 'misses', 'evictions'))
+            if cache:
+                stats[ctype] = cache
+        return stats
+
+class HashStore(GenericStore):
+    """Implementation of a simple hash data store (non-persistent).
+
+    The hash is unbounded by default. If a maximum entry count or byte
+    size is given, the least recently used entries are evicted once the
+    bound is exceeded.
+    """
+
+    def __init__(self, base=BASE, session=None, maxentries=None,
+            maxbytes=None, negttl=NEGTTL, clock=time.time):
+        """Instantiate a hash store object.
+
+        Args:
+            base (str): The base URL for lookups.
+
+            session (WhoisSession): The HTTP session used for queries.
+
+            maxentries (int): The maximum number of cached objects.
+
+            maxbytes (int): The maximum estimated size of all cached
+                            objects.
+
+            negttl (int): The number of seconds for which a cached
+                          "object does not exist" result is valid.
+
+            clock (function): Returns the current time in seconds.
+        """
+        GenericStore.__init__(self, base, session, negttl, clock)
+        self.set_tier(maxentries, maxbytes)
+        self.store = self.tier
+
+    def fetch(self, ctype, idstr):
+        """Fetch data for the given ID string and collection type.
+
+        First look at the hash for any matching data. If found return
+        that data; if not fetch new data.
+        """
+        # Look for data in the hash
+        result = self.tier_get(ctype, idstr)
+        if result:
+            return result
+        result = self.compact(self.query(idstr, ctype))
+        # Store any new data in the hash
+        self.tier_put(ctype, idstr, result)
+        return result
+
+    def save_many(self, ctype, results):
+        """Store a list of result objects of the same collection type.
+
+        Args:
+            ctype (str): The collection type.
+            results (list of dict): The result objects.
+
+        Returns:
+            None.
+        """
+        for result in results:
+            self.tier_put(ctype, result["objID"], result)
+
+
+class DBStore(GenericStore):
+    """Wrapper around a MongoDB data store."""
+
+    def __init__(self, dbhost, dbport, local=False, session=None,
+            negttl=NEGTTL, maxentries=None, maxbytes=None,
+            writebehind=False):
+        """Instantiate a MongoDB store object.
+
+        If a maximum entry count or byte size is given, an in-memory LRU
+        tier is put in front of the database. Reads go through the tier
+        and new data is written to both.
+
+        With write-behind enabled, new data is queued and written to the
+        database in bulk by a background thread instead of on every
+        lookup. Queued data is still returned by lookups.
+
+        Args:
+            dbhost (str): The Database hostname.
+
+            dbport (int): The Database port.
+
+            local (boolean): If true, only use pre-cached values. That
+                             is, issue no new queries.
+
+            session (WhoisSession): The HTTP session used for queries.
+
+            negttl (int): The number of seconds for which a cached
+                          "object does not exist" result is valid.
+
+            maxentries (int): The maximum number of objects in the
+                              in-memory tier.
+
+            maxbytes (int): The maximum estimated size of all objects in
+                            the in-memory tier.
+
+            writebehind (boolean): If true, batch database writes.
+        """
+        GenericStore.__init__(self, session=session, negttl=negttl)
+        if maxentries or maxbytes:
+            self.set_tier(maxentries, maxbytes)
+        # Use default host and port for our DB
+        client = MongoClient(dbhost, dbport) 
+        # DB handle
+        self.db = client.whois
+        # DB collection
+        self.cols = {}
+        self.local = local
+        self.writer = None
+        if writebehind and not local:
+            self.writer = WriteBehind(self.write_many)
+
+    def find_collection(self, ctype):
+        """Find the DB collection associated with the given object type.
+
+        Args:
+            ctype (str): The collection object type.
+
+        Returns:
+            The mongoDB collection object.
+        """
+        if not ctype in self.cols.keys():
+            c = collection.Collection(self.db, ctype)
+            self.ensure_index(c)
+            self.cols[ctype] = c
+        return self.cols[ctype]
+
+    def ensure_index(self, c):
+        """Ensure that the given DB collection is indexed on objID.
+
+        A unique index is used where possible. Caches that were built
+        before the index existed may hold duplicate entries for an
+        object; such collections get a non-unique index instead.
+
+        Args:
+            c (Collection): The mongoDB collection object.
+
+        Returns:
+            None.
+        """
+        try:
+            c.create_index("objID", unique=True)
+        except errors.OperationFailure:
+            if verbose:
+                print "Duplicate objIDs in " + c.name + ", using a non-unique index"
+            c.create_index("objID")
+
+    def fetch(self, ctype, idstr):
+        """Fetch data for the given ID string and collection type.
+
+        First look at the MongoDB store for any matching data. If found return
+        that data; if not, fetch new data but only if we are not
+        limiting lookups to already-cached values. Stale results
+        without data are looked up again; transient failures are never
+        stored.
+        """
+        result = self.tier_get(ctype, idstr, self.local)
+        if result:
+            return result
+        result = self.compact(self.fetch_db(ctype, idstr))
+        self.tier_put(ctype, idstr, result)
+        return result
+
+    def fetch_db(self, ctype, idstr):
+        """Fetch data for the given ID string from MongoDB.
+
+        This is the second tier of DBStore.fetch: new data is queried
+        and written to the database if nothing usable is stored.
+        """
+        # Find an existing element with the given ID
+        if verbose:
+            print "Checking store for " + idstr
+        c = self.find_collection(ctype)
+        cached = None
+        if self.writer:
+            cached = self.writer.get(ctype, idstr)
+        if cached is None:
+            start = time.time()
+            cached = c.find_one({"objID":idstr})
+            self.observe(ctype, 'db', start)
+        self.count(ctype, 'storehits' if cached else 'storemisses')
+        if self.local:
+            if cached:
+                return cached
+            # Don't fetch any data
+            result = {}
+            result["objID"] = idstr
+            return result
+        if cached and not self.is_stale(cached):
+            return cached
+        # Query and add data
+        result = self.query(idstr, ctype)
+        start = time.time()
+        if is_transient(result):
+            pass
+        elif self.writer:
+            self.writer.put(ctype, result)
+        elif cached:
+            c.replace_one({"objID": idstr}, result)
+        else:
+            try:
+                oid = c.insert(result)
+                #pprint(oid)
+            except errors.DuplicateKeyError:
+                # Someone else stored this object in the meantime
+                pass
+        self.observe(ctype, 'db', start)
+        return result
+
+    def fetch_many(self, ctype, idstrs):
+        """Fetch data for a list of ID strings of the same collection type.
+
+        All cached objects are found with a single query per batch of
+        ID strings. Objects that are not in the store, or whose cached
+        results are stale, are then fetched unless we are limiting
+        lookups to already-cached values. New objects are written back
+        with a single bulk insert.
+
+        Args:
+            ctype (str): The collection type.
+            idstrs (list of str): The location references for the
+                                  whois objects.
+
+        Returns:
+            A dict of result objects indexed by ID string.
+        """
+        c = self.find_collection(ctype)
+        results = {}
+        wanted = []
+        for idstr in idstrs:
+            if idstr not in results:
+                results[idstr] = self.tier_get(ctype, idstr, self.local)
+                if results[idstr]:
+                    continue
+                # Queued objects are handled like the stored ones
+                if self.writer:
+                    results[idstr] = self.writer.get(ctype, idstr)
+                wanted.append(idstr)
+        missing = [idstr for idstr in wanted if not results[idstr]]
+        for i in range(0, len(missing), BATCHSIZE):
+            batch = missing[i:i + BATCHSIZE]
+            if verbose:
+                print "Checking store for " + str(len(batch)) + " objects"
+            start = time.time()
+            for result in c.find({"objID": {"$in": batch}}):
+                results[result["objID"]] = result
+            self.observe(ctype, 'db', start)
+        hits = len([idstr for idstr in wanted if results[idstr]])
+        self.count(ctype, 'storehits', hits)
+        self.count(ctype, 'storemisses', len(wanted) - hits)
+        new = []
+        for idstr in wanted:
+            cached = results[idstr]
+            if self.local:
+                if not cached:
+                    # Don't fetch any data
+                    results[idstr] = {"objID": idstr}
+                continue
+            if cached and not self.is_stale(cached):
+                continue
+            results[idstr] = self.query(idstr, ctype)
+            if is_transient(results[idstr]):
+                continue
+            if self.writer:
+                self.writer.put(ctype, results[idstr])
+            elif cached:
+                start = time.time()
+                c.replace_one({"objID": idstr}, results[idstr])
+                self.observe(ctype, 'db', start)
+            else:
+                new.append(results[idstr])
+        if new:
+            start = time.time()
+            try:
+                c.insert_many(new, ordered=False)
+            except errors.BulkWriteError:
+                # Someone else stored some of these objects in the meantime
+                pass
+            self.observe(ctype, 'db', start)
+        for idstr in wanted:
+            results[idstr] = self.compact(results[idstr])
+            self.tier_put(ctype, idstr, results[idstr])
+        return results
+
+    def save_many(self, ctype, results):
+        """Store a list of result objects of the same collection type.
+
+        Objects replace any objects with the same ID strings, either
+        right away or through the write-behind buffer. Transient
+        failures are never stored.
+
+        Args:
+            ctype (str): The collection type.
+            results (list of dict): The result objects.
+
+        Returns:
+            None.
+        """
+        results = [r for r in results if not is_transient(r)]
+        if self.writer:
+            for r in results:
+                self.writer.put(ctype, r)
+        else:
+            self.write_many(ctype, results)
+        for r in results:
+            self.tier_put(ctype, r["objID"], self.compact(r))
+
+    def write_many(self, ctype, results):
+        """Upsert result objects with one unordered bulk write per batch.
+
+        Args:
+            ctype (str): The collection type.
+            results (list of dict): The result objects.
+
+        Returns:
+            None.
+        """
+        c = self.find_collection(ctype)
+        for i in range(0, len(results), BATCHSIZE):
+            batch = results[i:i + BATCHSIZE]
+            ops = [ReplaceOne({"objID": r["objID"]}, r, upsert=True) for r in batch]
+            start = time.time()
+            try:
+                c.bulk_write(ops, ordered=False)
+            except errors.BulkWriteError:
+                # Someone else stored some of these objects in the meantime
+                pass
+            self.observe(ctype, 'db', start)
+
+    def flush(self):
+        """Write any queued data to the database."""
+        if self.writer:
+            self.writer.flush()
+
+    def get_writer_stats(self):
+        """Return the write-behind statistics, or None if disabled."""
+        if self.writer:
+            return self.writer.get_stats()
+        return None
+
+
+class FileStore(GenericStore):
+    """Data store backed by an embedded SQLite file.
+
+    The file is opened in WAL mode so that readers are not blocked by
+    writes. Each object is stored as zlib-compressed JSON, keyed by its
+    collection type and ID string.
+    """
+
+    def __init__(self, path, local=False, session=None, negttl=NEGTTL):
+        """Instantiate a file store object.
+
+        Args:
+            path (str): The path to the SQLite file. The file is created
+                        if it does not exist.
+
+            local (boolean): If true, only use pre-cached values. That
+                             is, issue no new queries.
+
+            session (WhoisSession): The HTTP session used for queries.
+
+            negttl (int): The number of seconds for which a cached
+                          "object does not exist" result is valid.
+        """
+        GenericStore.__init__(self, session=session, negttl=negttl)
+        self.path = path
+        self.local = local
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS whois ("
+                "ctype TEXT NOT NULL, objID TEXT NOT NULL, data BLOB NOT NULL, "
+                "PRIMARY KEY (ctype, objID))")
+        self.db.commit()
+
+    def __del__(self):
+        """FileStore destructor.
+
+        Close the database connection when we're done.
+        """
+        self.close()
+
+    def close(self):
+        """Close the database connection."""
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def encode(self, result):
+        """Serialize and compress a result object."""
+        return sqlite3.Binary(zlib.compress(json.dumps(result, separators=(',', ':'))))
+
+    def decode(self, data):
+        """Decompress and deserialize a stored result object."""
+        return json.loads(zlib.decompress(data))
+
+    def save_many(self, ctype, results):
+        """Write the given result objects to the file.
+
+        Existing objects with the same ID strings are replaced, and
+        transient failures are never stored.
+
+        Args:
+            ctype (str): The collection type.
+            results (list of dict): The result objects.
+
+        Returns:
+            None.
+        """
+        rows = [(ctype, r["objID"], self.encode(r)) for r in results
+                if not is_transient(r)]
+        if not rows:
+            return
+        start = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO whois (ctype, objID, data) VALUES (?, ?, ?)", rows)
+            self.db.commit()
+        self.observe(ctype, 'db', start)
+
+    def fetch(self, ctype, idstr):
+        """Fetch data for the given ID string and collection type.
+
+        First look in the file for any matching data. If found return
+        that data; if not, fetch new data but only if we are not
+        limiting lookups to already-cached values. Stale results
+        without data are looked up again; transient failures are never
+        stored.
+        """
+        if verbose:
+            print "Checking store for " + idstr
+        start = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT data FROM whois WHERE ctype = ? AND objID = ?",
+                    (ctype, idstr)).fetchone()
+        self.observe(ctype, 'db', start)
+        self.count(ctype, 'storehits' if row else 'storemisses')
+        if row:
+            cached = self.decode(row[0])
+            if self.local or not self.is_stale(cached):
+                return self.compact(cached)
+        elif self.local:
+            # Don't fetch any data
+            result = {}
+            result["objID"] = idstr
+            return result
+        # Query and add data
+        result = self.query(idstr, ctype)
+        self.save_many(ctype, [result])
+        return self.compact(result)
+
+    def fetch_many(self, ctype, idstrs):
+        """Fetch data for a list of ID strings of the same collection type.
+
+        Cached objects are found with one query per batch of ID strings.
+        Objects that are not in the file, or whose cached results are
+        stale, are then fetched unless we are limiting lookups to
+        already-cached values, and written back in a single transaction.
+
+        Args:
+            ctype (str): The collection type.
+            idstrs (list of str): The location references for the
+                                  whois objects.
+
+        Returns:
+            A dict of result objects indexed by ID string.
+        """
+        results = {}
+        wanted = []
+        for idstr in idstrs:
+            if idstr not in results:
+                results[idstr] = None
+                wanted.append(idstr)
+        for i in range(0, len(wanted), FILEBATCHSIZE):
+            batch = wanted[i:i + FILEBATCHSIZE]
+            stmt = "SELECT objID, data FROM whois WHERE ctype = ? AND objID IN (" + \
+                    ",".join("?" * len(batch)) + ")"
+            start = time.time()
+            with self.lock:
+                rows = self.db.execute(stmt, [ctype] + batch).fetchall()
+            self.observe(ctype, 'db', start)
+            for (idstr, data) in rows:
+                results[idstr] = self.decode(data)
+        hits = len([idstr for idstr in wanted if results[idstr]])
+        self.count(ctype, 'storehits', hits)
+        self.count(ctype, 'storemisses', len(wanted) - hits)
+        new = []
+        for idstr in wanted:
+            cached = results[idstr]
+            if self.local:
+                if not cached:
+                    # Don't fetch any data
+                    results[idstr] = {"objID": idstr}
+                continue
+            if cached and not self.is_stale(cached):
+                continue
+            results[idstr] = self.query(idstr, ctype)
+            new.append(results[idstr])
+        if new:
+            self.save_many(ctype, new)
+        for idstr in wanted:
+            results[idstr] = self.compact(results[idstr])
+        return results
+
+
+#######################################################################
+# The following class implements the bulk whois importer
+
+class BulkImporter:
+    """Load ARIN bulk whois dumps into a data store.
+
+    The dump is streamed one object at a time, so files of any size can
+    be imported. Objects are keyed exactly as GenericStore.get_idstr
+    keys them, and the association lists normally returned by the
+    /pocs, /orgs, /nets and /asns sub-resources are rebuilt from the
+    links between objects. A store filled this way can then be used in
+    local mode without making any queries.
+
+    Association lists take the shape the REST API gives them: a list
+    with a single entry is stored as that entry alone.
+    """
+
+    def __init__(self, store, batchsize=BATCHSIZE):
+        """Instantiate a bulk importer.
+
+        Args:
+            store (GenericStore): The store that receives the objects.
+            batchsize (int): The number of objects written to the store
+                             at once.
+        """
+        self.store = store
+        self.batchsize = batchsize
+        self.pending = defaultdict(list)
+        self.links = defaultdict(lambda: defaultdict(list))
+        self.stats = defaultdict(int)
+
+    def get_idstr(self, ctype, handle):
+        """Return the ID string of the object with the given handle."""
+        (r_handle, idstrlist) = self.store.get_idstr(ctype, handle)
+        return idstrlist[0][1]
+
+    def get_refs(self, obj, key):
+        """Return the link references held under the given key.
+
+        Args:
+            obj (dict): The object, or a part of it.
+            key (str): The element name of the references.
+
+        Returns:
+            A list of dicts, which is empty if there are no references.
+        """
+        if not isinstance(obj, dict) or key not in obj or not obj[key]:
+            return []
+        refs = obj[key]
+        if isinstance(refs, dict):
+            return [refs]
+        return refs
+
+    def add_link(self, ctype, base, ref, link):
+        """Add an entry to an association list.
+
+        Args:
+            ctype (str): The collection type of the listed objects.
+            base (str): The ID string of the object owning the list.
+            ref (str): The element name of the list entries.
+            link (dict): The list entry.
+        """
+        self.links[(ctype, base + "/" + ctype + "s")][ref].append(link)
+
+    def add_object(self, ctype, obj):
+        """Queue an object and record its associations.
+
+        Args:
+            ctype (str): The collection type.
+            obj (dict): The object as found in the dump.
+
+        Returns:
+            None.
+        """
+        handle = obj.get('handle')
+        if not handle:
+            self.stats['skipped'] += 1
+            return
+        idstr = self.get_idstr(ctype, handle)
+        self.pending[ctype].append({"objID": idstr, ctype: obj})
+        self.stats[ctype] += 1
+        # POCs of an org, net or asn, and the reverse association
+        if ctype != 'poc':
+            pocs = []
+            for key in ('pocLinkRef', 'pocLink'):
+                pocs.extend(self.get_refs(obj.get('pocLinks'), key))
+            for p in pocs:
+                link = dict((k, v) for (k, v) in p.items() if k.startswith('@'))
+                self.add_link('poc', idstr, 'pocLinkRef', link)
+                link = dict(link)
+                link['@handle'] = handle
+                self.add_link(ctype, self.get_idstr('poc', p['@handle']),
+                        ctype + 'PocLinkRef', link)
+        # Nets and ASNs held by an org
+        if ctype in ('net', 'asn'):
+            orgHandle = None
+            if 'orgRef' in obj:
+                orgHandle = obj['orgRef']['@handle']
+            elif 'orgHandle' in obj:
+                orgHandle = obj['orgHandle']
+            if orgHandle:
+                self.add_link(ctype, self.get_idstr('org', orgHandle),
+                        ctype + 'Ref', {'@handle': handle})
+        if len(self.pending[ctype]) >= self.batchsize:
+            self.flush(ctype)
+
+    def flush(self, ctype):
+        """Write the queued objects of the given collection type."""
+        if self.pending[ctype]:
+            self.store.save_many(ctype, self.pending[ctype])
+            self.pending[ctype] = []
+
+    def parse_item(self, path, item):
+        """Handle an object streamed from the dump.
+
+        Args:
+            path (list of tuple): The element path to the object.
+            item (dict): The parsed object.
+
+        Returns:
+            True, to keep streaming.
+        """
+        ctype = path[-1][0]
+        if ctype in ('poc', 'org', 'net', 'asn'):
+            self.add_object(ctype, item)
+        else:
+            self.stats['skipped'] += 1
+        return True
+
+    def load(self, path):
+        """Stream the objects of a dump file into the store.
+
+        Files whose name ends in .gz are decompressed on the fly.
+
+        Args:
+            path (str): The path to the dump file.
+
+        Returns:
+            None.
+        """
+        if verbose:
+            print "Importing " + path
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            xmltodict.parse(f, item_depth=2, item_callback=self.parse_item)
+        finally:
+            f.close()
+        for ctype in self.pending.keys():
+            self.flush(ctype)
+
+    def finish(self):
+        """Write the association lists once all dumps are loaded.
+
+        Returns:
+            A dict with the number of imported objects per collection
+            type, of association lists and of skipped elements.
+        """
+        bytype = defaultdict(list)
+        for ((ctype, idstr), refs) in self.links.items():
+            assoc = {}
+            for (ref, l) in refs.items():
+                if len(l) == 1:
+                    assoc[ref] = l[0]
+                else:
+                    assoc[ref] = l
+            bytype[ctype].append({"objID": idstr, ctype + "s": assoc})
+        for ctype in bytype.keys():
+            for i in range(0, len(bytype[ctype]), self.batchsize):
+                self.store.save_many(ctype, bytype[ctype][i:i + self.batchsize])
+            self.stats['links'] += len(bytype[ctype])
+        self.links.clear()
+        self.store.flush()
+        return dict(self.stats)
+
+
+#######################################################################
+# The following classes implement the crawl engine
+
+class WorkerPool:
+    """Fixed-size pool of worker threads fed by a work queue."""
+
+    def __init__(self, size):
+        """Start the worker threads.
+
+        Args:
+            size (int): The number of worker threads.
+        """
+        self.queue = Queue.Queue()
+        self.errors = []
+        self.threads = []
+        for i in range(size):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        """Process work items until a stop marker is seen."""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (fn, args) = item
+                # Drain the queue without doing any work after a failure
+                if not self.errors:
+                    fn(*args)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args):
+        """Queue a call to fn(*args)."""
+        self.queue.put((fn, args))
+
+    def join(self):
+        """Wait until all queued work, including work queued by other
+        work items, has completed.
+
+        The wait is done in short intervals so that the caller can still
+        be interrupted.
+        """
+        q = self.queue
+        q.all_tasks_done.acquire()
+        try:
+            while q.unfinished_tasks:
+                q.all_tasks_done.wait(0.5)
+        finally:
+            q.all_tasks_done.release()
+
+    def stop(self):
+        """Stop all worker threads."""
+        for t in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+    def get_errors(self):
+        """Return the exceptions raised by work items."""
+        return self.errors
+
+
+class Flight:
+    """A lookup that is in progress."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Wait for the lookup to complete and return its result."""
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Coalesce concurrent lookups of the same key into one."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.saved = 0
+
+    def do(self, key, fn, *args):
+        """Run fn(*args) unless a lookup for key is already in progress.
+
+        If another thread is already running a lookup for the key, wait
+        for it and share its result instead.
+
+        Args:
+            key: The lookup key.
+            fn (function): The lookup function.
+            args: The arguments to the lookup function.
+
+        Returns:
+            A tuple of two values: whether this call ran the lookup and
+            the result of the lookup.
+        """
+        leader = False
+        with self.lock:
+            f = self.flights.get(key)
+            if f:
+                self.saved += 1
+            else:
+                f = Flight()
+                self.flights[key] = f
+                leader = True
+        if not leader:
+            return (False, f.wait())
+        try:
+            f.result = fn(*args)
+        except Exception as e:
+            f.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            f.done.set()
+        return (True, f.result)
+
+    def get_saved(self):
+        """Return the number of lookups that were avoided."""
+        return self.saved
+
+
+class Prefetcher:
+    """Issue lookups ahead of time and park their results.
+
+    Parked results are handed out once, to the first caller that asks
+    for them; lookups that are still in progress are waited for. Results
+    still parked when the prefetcher is closed are counted as unused.
+    """
+
+    def __init__(self, size):
+        """Instantiate a prefetcher.
+
+        Args:
+            size (int): The number of lookups run ahead in parallel.
+        """
+        self.size = size
+        self.pool = None
+        self.parked = {}
+        self.lock = threading.Lock()
+        self.stats = {'issued': 0, 'used': 0, 'unused': 0}
+
+    def prefetch(self, key, fn, *args):
+        """Start fn(*args) in the background unless key is parked.
+
+        Args:
+            key: The lookup key.
+            fn (function): The lookup function.
+            args: The arguments to the lookup function.
+        """
+        with self.lock:
+            if key in self.parked:
+                return
+            if not self.pool:
+                self.pool = WorkerPool(self.size)
+            f = Flight()
+            self.parked[key] = f
+            self.stats['issued'] += 1
+        self.pool.submit(self.resolve, f, fn, *args)
+
+    def resolve(self, f, fn, *args):
+        """Run a prefetched lookup and record its outcome."""
+        try:
+            # Lookups dropped by close() are not run at all
+            if f.error is None:
+                f.result = fn(*args)
+        except Exception as e:
+            f.error = e
+        finally:
+            f.done.set()
+
+    def take(self, key, fn, *args):
+        """Return the parked result for key, or run fn(*args).
+
+        A prefetched lookup that failed is run again.
+
+        Args:
+            key: The lookup key.
+            fn (function): The lookup function.
+            args: The arguments to the lookup function.
+
+        Returns:
+            The result of the lookup.
+        """
+        with self.lock:
+            f = self.parked.pop(key, None)
+            if f:
+                self.stats['used'] += 1
+        if f:
+            f.done.wait()
+            if not f.error:
+                return f.result
+        return fn(*args)
+
+    def close(self):
+        """Stop the worker threads and drop all parked lookups.
+
+        The prefetcher may be used again afterwards.
+        """
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+            for f in self.parked.values():
+                if not f.done.is_set():
+                    f.error = Exception("Prefetch cancelled")
+            self.stats['unused'] += len(self.parked)
+            self.parked = {}
+        if pool:
+            pool.stop()
+
+    def get_stats(self):
+        """Return the number of prefetched, used and unused lookups."""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['unused'] += len(self.parked)
+        return stats
+
+
+class CrawlBudget:
+    """Limits on the number of lookups, depth and duration of a crawl.
+
+    A limit of None is not enforced. Lookups that are already running
+    when the budget runs out are allowed to complete.
+    """
+
+    def __init__(self, maxqueries=None, maxdepth=None, maxtime=None):
+        """Instantiate a crawl budget.
+
+        Args:
+            maxqueries (int): The number of store lookups.
+            maxdepth (int): The number of hops from a seed handle.
+            maxtime (float): The wall-clock time in seconds.
+        """
+        self.maxqueries = maxqueries
+        self.maxdepth = maxdepth
+        self.maxtime = maxtime
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.started = None
+        self.reason = None
+
+    def start(self):
+        """Start the wall-clock, unless it is already running."""
+        with self.lock:
+            if self.started is None:
+                self.started = time.time()
+
+    def charge(self, n=1):
+        """Account for store lookups.
+
+        Args:
+            n (int): The number of lookups.
+        """
+        with self.lock:
+            self.queries += n
+
+    def exhausted(self):
+        """Check whether the crawl must stop.
+
+        Returns:
+            'queries' or 'time' if the corresponding budget ran out,
+            None otherwise.
+        """
+        with self.lock:
+            if self.reason:
+                return self.reason
+            if self.maxqueries is not None and self.queries >= self.maxqueries:
+                self.reason = 'queries'
+            elif (self.maxtime is not None and self.started is not None
+                    and time.time() - self.started >= self.maxtime):
+                self.reason = 'time'
+            return self.reason
+
+    def allows(self, depth):
+        """Check whether objects at the given depth may be looked up.
+
+        Args:
+            depth (int): The number of hops from the seed handle.
+
+        Returns:
+            None if the lookup may proceed, or the reason it may not:
+            'queries', 'time' or 'depth'.
+        """
+        reason = self.exhausted()
+        if not reason and self.maxdepth is not None and depth > self.maxdepth:
+            reason = 'depth'
+        return reason
+
+    def get_stats(self):
+        """Return the lookups made, the elapsed time and the reason the
+        budget ran out, if it did."""
+        with self.lock:
+            elapsed = 0.0
+            if self.started is not None:
+                elapsed = time.time() - self.started
+            return {'queries': self.queries, 'elapsed': elapsed,
+                    'exhausted': self.reason}
+
+
+class CrawlCheckpoint:
+    """Periodic snapshot of a worklist crawl, from which it can resume.
+
+    A checkpoint is a gzipped JSON document holding the seeds that were
+    crawled to completion, the frontier of the seed being crawled, the
+    visited set and the contents of the graph index. Snapshots are only
+    taken between two levels of a crawl, where this state is
+    consistent, and atomically replace the previous one. Fetched
+    objects are not part of the snapshot; they are expected to be kept
+    by a persistent store.
+    """
+
+    def __init__(self, path, interval=CHECKPOINTINTERVAL):
+        """Instantiate a checkpoint.
+
+        Args:
+            path (str): The checkpoint file.
+            interval (float): The minimum number of seconds between two
+                              snapshots.
+        """
+        self.path = path
+        self.interval = interval
+        self.done = []
+        self.last = time.time()
+        self.saved = 0
+
+    def seed_done(self, ctype, handle):
+        """Record that a seed was crawled to completion."""
+        self.done.append([ctype, handle])
+
+    def get_done(self):
+        """Return the (type, handle) pairs of the completed seeds."""
+        return [tuple(d) for d in self.done]
+
+    def update(self, crawler, current=None, force=False):
+        """Take a snapshot if the interval has elapsed.
+
+        Args:
+            crawler (WhoisCrawler): The crawler whose state is saved.
+            current (dict): The seed being crawled, if any, with its
+                            'ctype', 'handle', 'depth' and the worklist
+                            'level' about to be fetched.
+            force (boolean): Take the snapshot regardless of the interval.
+
+        Returns:
+            None.
+        """
+        if force or time.time() - self.last >= self.interval:
+            self.save(crawler, current)
+
+    def save(self, crawler, current=None):
+        """Write a snapshot of the crawl.
+
+        Args:
+            crawler (WhoisCrawler): The crawler whose state is saved.
+            current (dict): The seed being crawled, as for update().
+
+        Returns:
+            None.
+        """
+        state = crawler.get_index().to_state()
+        state['done'] = self.done
+        state['current'] = current
+        state['visited'] = sorted(crawler.get_visited())
+        tmp = self.path + ".tmp"
+        f = gzip.open(tmp, 'wb')
+        try:
+            json.dump(state, f, separators=(',', ':'))
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+        self.last = time.time()
+        self.saved += 1
+        if verbose:
+            print "Saved checkpoint " + self.path
+
+    def load(self):
+        """Read the last snapshot.
+
+        Returns:
+            The snapshot as a dict, or None if there is none.
+        """
+        if not os.path.exists(self.path):
+            return None
+        f = gzip.open(self.path, 'rb')
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        self.done = state['done']
+        return state
+
+    def restore(self, crawler, state):
+        """Restore the visited set and graph index of a crawl.
+
+        The placeholders of the crawled nodes are restored separately,
+        by WorklistCollection.restore_nodes().
+
+        Args:
+            crawler (WhoisCrawler): The crawler to restore.
+            state (dict): A snapshot returned by load().
+
+        Returns:
+            None.
+        """
+        crawler.get_visited().update(tuple(v) for v in state['visited'])
+        crawler.get_index().load_state(state)
+
+    def get_saved(self):
+        """Return the number of snapshots taken."""
+        return self.saved
+
+
+class DisjointSet:
+    """Union-find structure that groups handles into connected clusters.
+
+    Union by size and path halving keep every operation close to
+    constant time.
+    """
+
+    def __init__(self):
+        """Instantiate an empty structure."""
+        self.parent = {}
+        self.size = {}
+        self.count = 0
+
+    def find(self, x):
+        """Return the representative of the cluster of x, adding x if needed."""
+        parent = self.parent
+        if x not in parent:
+            parent[x] = x
+            self.size[x] = 1
+            self.count += 1
+            return x
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        """Merge the clusters of a and b.
+
+        Returns:
+            The representative of the merged cluster.
+        """
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra == rb:
+            return ra
+        if self.size[ra] < self.size[rb]:
+            (ra, rb) = (rb, ra)
+        self.parent[rb] = ra
+        self.size[ra] += self.size.pop(rb)
+        self.count -= 1
+        return ra
+
+    def get_size(self, x):
+        """Return the number of handles in the cluster of x."""
+        return self.size[self.find(x)]
+
+    def get_count(self):
+        """Return the number of clusters."""
+        return self.count
+
+    def get_handle_count(self):
+        """Return the number of handles in all clusters."""
+        return len(self.parent)
+
+    def get_largest(self):
+        """Return the number of handles in the largest cluster."""
+        if not self.size:
+            return 0
+        return max(self.size.values())
+
+    def get_components(self):
+        """Return the handles of each cluster indexed by representative."""
+        components = defaultdict(list)
+        for x in self.parent.keys():
+            components[self.find(x)].append(x)
+        return components
+
+
+class GraphIndex:
+    """Index of the links, resources and tooltips discovered by a crawl.
+
+    Every collection of a crawl writes what it discovers into the index
+    shared through the crawler, so that the aggregate views are
+    available as is instead of being merged from the collection tree.
+    Entries are kept once, in the order they were first added.
+    """
+
+    def __init__(self):
+        """Instantiate an empty index."""
+        self.lock = threading.Lock()
+        self.collections = defaultdict(list)
+        self.links = defaultdict(list)
+        self.resources = defaultdict(list)
+        self.tooltip = defaultdict(list)
+        self.filtered = []
+        self.seen = defaultdict(set)
+        self.clusters = DisjointSet()
+
+    def add(self, name, key, value):
+        """Append a value to a list of the index unless it is there.
+
+        Args:
+            name (str): The name of the index dict holding the list.
+            key: The key of the list within the dict.
+            value: The value to append.
+
+        Returns:
+            None.
+        """
+        with self.lock:
+            if (key, value) not in self.seen[name]:
+                self.seen[name].add((key, value))
+                getattr(self, name)[key].append(value)
+
+    def add_collection(self, handle, col):
+        """Index a collection under the handle of the object it expands."""
+        self.add('collections', handle, col)
+
+    def add_link(self, handle, handle_c):
+        """Index a link between two handles, joining their clusters.
+
+        Links to no handle (None) and to the handle itself are indexed
+        but join no clusters, as such edges are not drawn either.
+        """
+        self.add('links', handle, handle_c)
+        if handle_c is None or handle_c == handle:
+            return
+        with self.lock:
+            self.clusters.union(handle, handle_c)
+
+    def add_resource(self, ctype, handle, idstr):
+        """Index a resource of the given collection type."""
+        self.add('resources', ctype, (handle, idstr))
+
+    def add_tooltip(self, handle, msg):
+        """Index a tooltip message for the given handle."""
+        self.add('tooltip', handle, msg)
+
+    def add_filtered(self, handle):
+        """Index a handle whose references were not followed."""
+        with self.lock:
+            if handle not in self.seen['filtered']:
+                self.seen['filtered'].add(handle)
+                self.filtered.append(handle)
+
+    def merge(self, other):
+        """Add all entries of another index to this one.
+
+        Args:
+            other (GraphIndex): The index to merge.
+
+        Returns:
+            None.
+        """
+        for (h, cols) in other.get_collections().items():
+            for col in cols:
+                self.add_collection(h, col)
+        for (h, hl) in other.get_links().items():
+            for handle_c in hl:
+                self.add_link(h, handle_c)
+        for (ctype, rl) in other.get_resources().items():
+            for (h, idstr) in rl:
+                self.add_resource(ctype, h, idstr)
+        for (h, msgs) in other.get_tooltip().items():
+            for msg in msgs:
+                self.add_tooltip(h, msg)
+        for h in other.get_filtered():
+            self.add_filtered(h)
+
+    def to_state(self):
+        """Return the contents of the index as plain lists and dicts.
+
+        Collections are replaced by [handle, type, root] triples, where
+        root is true for the nodes that started a crawl.
+
+        Returns:
+            A dict with the 'nodes', 'links', 'resources', 'tooltip'
+            and 'filtered' of the index.
+        """
+        with self.lock:
+            nodes = []
+            for (h, cols) in self.collections.items():
+                # The parent collection carries the node type
+                pobj = cols[0].get_parent()
+                nodes.append([h, pobj.get_type(), pobj.get_parent() is None])
+            return {
+                'nodes': nodes,
+                'links': dict((h, list(hl)) for (h, hl) in self.links.items()),
+                'resources': dict((t, list(rl)) for (t, rl) in self.resources.items()),
+                'tooltip': dict((h, list(m)) for (h, m) in self.tooltip.items()),
+                'filtered': list(self.filtered),
+            }
+
+    def load_state(self, state):
+        """Add the contents returned by to_state() to the index.
+
+        The nodes are not added; see WorklistCollection.restore_nodes().
+
+        Args:
+            state (dict): The contents to add.
+
+        Returns:
+            None.
+        """
+        for (h, hl) in state['links'].items():
+            for handle_c in hl:
+                self.add_link(h, handle_c)
+        for (ctype, rl) in state['resources'].items():
+            for (h, idstr) in rl:
+                self.add_resource(ctype, h, idstr)
+        for (h, msgs) in state['tooltip'].items():
+            for msg in msgs:
+                self.add_tooltip(h, msg)
+        for h in state['filtered']:
+            self.add_filtered(h)
+
+    def get(self, name):
+        """Return a copy of a dict of lists of the index.
+
+        Args:
+            name (str): The name of the index dict.
 
         Returns:
-            A dict object representing the result.
+            A new dict of new lists, so that the caller may modify it
+            while the crawl goes on.
         """
-        result = self.query(idstr)
-        return result
+        with self.lock:
+            return dict((k, list(v)) for (k, v) in getattr(self, name).items())
+
+    def get_collections(self):
+        """Return a copy of the collections indexed by handle."""
+        return self.get('collections')
+
+    def get_links(self):
+        """Return a copy of the linked handles indexed by handle."""
+        return self.get('links')
+
+    def get_resources(self):
+        """Return a copy of the (handle, ID string) resources indexed by
+        type."""
+        return self.get('resources')
+
+    def get_tooltip(self):
+        """Return a copy of the tooltip messages indexed by handle."""
+        return self.get('tooltip')
+
+    def get_filtered(self):
+        """Return a copy of the filtered handles."""
+        with self.lock:
+            return list(self.filtered)
+
+    def get_clusters(self):
+        """Return the clusters of the handles linked so far."""
+        return self.clusters
+
+    def get_cluster_stats(self):
+        """Return the number of handles and clusters, and the size of
+        the largest cluster."""
+        with self.lock:
+            return {'handles': self.clusters.get_handle_count(),
+                    'clusters': self.clusters.get_count(),
+                    'largest': self.clusters.get_largest()}
+
+
+class WhoisCrawler:
+    """Crawl engine that schedules the lookups of a collection tree.
+
+    With a concurrency of one, each traversal step is run as soon as it
+    is dispatched, which amounts to the usual depth-first recursion.
+    With a higher concurrency, steps are placed on a frontier work queue
+    and independent references are fetched in parallel by a pool of
+    worker threads.
+
+    Steps running in parallel share the lookup cache and the graph
+    index. The cache is checked and filled under the cache lock, so
+    only one step ever sees a given object as fresh and expands it.
+    Collections, the index and the visited set are likewise only
+    updated under their locks.
+    """
+
+    def __init__(self, concurrency=None, prefetch=None, budget=None):
+        """Instantiate a crawler.
 
-    def fetchAssociated(self, obj, idstr):
-        """Fetch an object's associated data, given an ID string.
+        Args:
+            concurrency (int): The number of lookups to run in parallel.
+            prefetch (int): The number of association lookups to run
+                            ahead of the crawl.
+            budget (CrawlBudget): The limits of the crawl.
+        """
+        if concurrency:
+            self.concurrency = concurrency
+        else:
+            self.concurrency = CONCURRENCY
+        if prefetch is None:
+            prefetch = PREFETCH
+        self.pool = None
+        self.running = False
+        self.deferred = []
+        self.lock = threading.Lock()
+        self.cachelock = threading.Lock()
+        self.flights = SingleFlight()
+        self.ephemeral = {}
+        self.visited = set()
+        self.index = GraphIndex()
+        self.checkpoint = None
+        if budget:
+            self.budget = budget
+        else:
+            self.budget = CrawlBudget()
+        self.prefetcher = None
+        if prefetch > 0:
+            self.prefetcher = Prefetcher(prefetch)
+
+    def dispatch(self, fn, *args):
+        """Schedule a traversal step.
 
         Args:
-            obj (str): The object for which we are seeking associated data.
-            idstr (str): The ID string.
+            fn (function): The step to run.
+            args: The arguments to the step.
+        """
+        if self.pool:
+            self.pool.submit(fn, *args)
+        else:
+            fn(*args)
 
-        Returns:
-            A dict object representing the result.
+    def defer(self, fn, *args):
+        """Schedule a step that must only run after the frontier drains.
+
+        Args:
+            fn (function): The step to run.
+            args: The arguments to the step.
         """
-        return self.fetch(obj.get_type(), idstr)
+        if self.pool:
+            with self.lock:
+                self.deferred.append((fn, args))
+        else:
+            fn(*args)
 
-class HashStore(GenericStore):
-    """Implementation of a simple hash data store (non-persistent)."""
+    def run(self, fn, *args):
+        """Run a traversal step and all steps that it dispatches.
 
-    def __init__(self, base=BASE):
-        GenericStore.__init__(self, base)
-        self.store = defaultdict(dict)
+        Prefetched lookups that the crawl did not use are dropped once
+        the outermost run finishes.
 
-    def fetch(self, ctype, idstr):
-        """Fetch data for the given ID string and collection type.
+        Args:
+            fn (function): The initial step.
+            args: The arguments to the initial step.
 
-        First look at the hash for any matching data. If found return
-        that data; if not fetch new data.
+        Returns:
+            None.
         """
-        # Look for data in the hash
-        if idstr in self.store[ctype].keys():
-            return self.store[ctype][idstr]
-        result = self.query(idstr)
-        # Store any new data in the hash
-        self.store[ctype][idstr] = result
-        return result
+        if self.running:
+            fn(*args)
+            return
+        self.running = True
+        try:
+            if self.concurrency <= 1:
+                fn(*args)
+            else:
+                self.run_pool(fn, *args)
+        finally:
+            self.running = False
+            if self.prefetcher:
+                self.prefetcher.close()
+
+    def run_pool(self, fn, *args):
+        """Run a traversal step and its steps in the worker threads."""
+        self.pool = WorkerPool(self.concurrency)
+        try:
+            self.pool.submit(fn, *args)
+            while True:
+                self.pool.join()
+                errors = self.pool.get_errors()
+                if errors:
+                    raise errors[0]
+                with self.lock:
+                    deferred = self.deferred
+                    self.deferred = []
+                if not deferred:
+                    break
+                for (f, a) in deferred:
+                    f(*a)
+        finally:
+            self.pool.stop()
+            self.pool = None
+            self.deferred = []
+
+    def get_concurrency(self):
+        """Return the number of lookups run in parallel."""
+        return self.concurrency
+
+    def get_flights(self):
+        """Return the single-flight table shared by all lookups."""
+        return self.flights
+
+    def get_cachelock(self):
+        """Return the lock that guards the lookup cache of the crawl."""
+        return self.cachelock
+
+    def get_ephemeral(self):
+        """Return the results of the lookups that bypass the cache.
+
+        The dict is guarded by the cache lock. It keeps such lookups from
+        being repeated, or seen as fresh twice, within one crawl.
+        """
+        return self.ephemeral
 
+    def get_prefetcher(self):
+        """Return the prefetcher, or None if prefetching is disabled."""
+        return self.prefetcher
 
-class DBStore(GenericStore):
-    """Wrapper around a MongoDB data store."""
+    def get_index(self):
+        """Return the index that the collections of the crawl write into."""
+        return self.index
 
-    def __init__(self, dbhost, dbport, local=False):
-        """Instantiate a MongoDB store object.
+    def get_budget(self):
+        """Return the limits of the crawl."""
+        return self.budget
+
+    def set_budget(self, budget):
+        """Replace the limits of the crawl.
 
         Args:
-            dbhost (str): The Database hostname.
+            budget (CrawlBudget): The new limits.
+        """
+        self.budget = budget
 
-            dbport (int): The Database port.
+    def get_checkpoint(self):
+        """Return the checkpoint of the crawl, or None."""
+        return self.checkpoint
 
-            local (boolean): If true, only use pre-cached values. That
-                             is, issue no new queries.
+    def set_checkpoint(self, checkpoint):
+        """Take periodic snapshots of worklist crawls.
+
+        Args:
+            checkpoint (CrawlCheckpoint): The checkpoint to update.
         """
-        GenericStore.__init__(self)
-        # Use default host and port for our DB
-        client = MongoClient(dbhost, dbport) 
-        # DB handle
-        self.db = client.whois
-        # DB collection
-        self.cols = {}
-        self.local = local
+        self.checkpoint = checkpoint
 
-    def find_collection(self, ctype):
-        """Find the DB collection associated with the given object type.
+    def get_visited(self):
+        """Return the set of (type, handle) pairs visited by the crawl."""
+        return self.visited
+
+    def visit(self, ctype, handle):
+        """Mark an object as visited by the crawl.
 
         Args:
-            ctype (str): The collection object type.
+            ctype (string): Collection type of the object.
+            handle (string): Handle of the object.
 
         Returns:
-            The mongoDB collection object.
-        """
-        if not ctype in self.cols.keys():
-            self.cols[ctype] = collection.Collection(self.db, ctype)
-        return self.cols[ctype]
-
-    def fetch(self, ctype, idstr):
-        """Fetch data for the given ID string and collection type.
-
-        First look at the MongoDB store for any matching data. If found return
-        that data; if not, fetch new data but only if we are not
-        limiting lookups to already-cached values.
+            True if the object had not been visited before.
         """
-        # Find an existing element with the given ID
-        if verbose:
-            print "Checking store for " + idstr
-        c = self.find_collection(ctype)
-        result = c.find_one({"objID":idstr})
-        if not result:
-            if self.local:
-                # Don't fetch any data
-                result = {}
-                result["objID"] = idstr
-            else:
-                # Query and add data
-                result = self.query(idstr)
-                oid = c.insert(result)
-                #pprint(oid)
-        return result
+        key = (ctype, handle)
+        with self.lock:
+            if key in self.visited:
+                return False
+            self.visited.add(key)
+            return True
 
 
 #######################################################################
@@ -208,7 +3150,7 @@ class WhoisCollection:
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """Base class constructor.
 
         Args:
@@ -224,6 +3166,8 @@ class WhoisCollection:
                                         to be filtered.
             blacklist (list of string): Object handles that are 
                                         to be filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
 
         """
         self.collections = defaultdict(list)
@@ -231,6 +3175,8 @@ class WhoisCollection:
         self.resources = defaultdict(list)
         self.tooltip = defaultdict(list)
         self.filtered = []
+        # Steps of a concurrent crawl may update the same collection
+        self.lock = threading.Lock()
         self.attrib = {}
         self.attrib['shape'] = 'doublecircle'
         self.attrib['style'] = ""
@@ -239,6 +3185,10 @@ class WhoisCollection:
         self.attrib['penwidth'] = 1
         self.origin_handle = origin_handle
         self.origin = origin
+        if origin:
+            self.depth = origin.get_depth() + 1
+        else:
+            self.depth = 0
 
         # If some value is given directly use it first
         # Else look at the parent object
@@ -279,39 +3229,115 @@ class WhoisCollection:
             self.blacklist = origin.get_blacklist()
         else:
             self.blacklist = []
+        # Set the crawler
+        if crawler:
+            self.crawler = crawler
+        elif origin:
+            self.crawler = origin.get_crawler()
+        else:
+            self.crawler = WhoisCrawler()
+        self.cachelock = self.crawler.get_cachelock()
+        self.index = self.crawler.get_index()
         # Set the initial tooltip
         if tt:
             self.tooltip[self.origin_handle] = tt
+            if not isinstance(tt, list):
+                tt = [tt]
+            for msg in tt:
+                self.index.add_tooltip(self.origin_handle, msg)
 
     def do_slurp(self):
         """Entry point for looking up resource objects. """
         if not isinstance(self.origin_handle, unicode):
-            self.slurp(unicode(self.origin_handle,"utf-8"))
+            self.crawler.run(self.slurp, unicode(self.origin_handle,"utf-8"))
         else:
-            self.slurp(self.origin_handle)
+            self.crawler.run(self.slurp, self.origin_handle)
 
-    def get_data(self, ctype, idstr):
+    def get_data(self, ctype, idstr, cache=False):
         """Get data corresponding to given ID string and collection type.
 
         First check if the data exists in the cache. If it doesn't then
-        look for data in the data store.
+        look for data in the data store. Concurrent requests for the
+        same ID string share a single lookup; only the first requester
+        sees the data as fresh. Data that is not cached is still looked
+        up only once per crawl.
 
         Args:
             ctype (string): Collection type.
             idstr (string): ID string.
+            cache (boolean): If true, fresh data is added to the cache.
 
         Returns:
             A tuple of two values, where the first is a boolean value
             that indicates whether the data was cached or not, and the
             second is the result dict object.
         """
-        if idstr in self.cache.keys():
-           return (False, self.cache[idstr])
-        elif self.store:
-           return (True, self.store.fetch(ctype, idstr))
+        with self.cachelock:
+            result = self.lookup_seen(idstr, cache)
+        if result is not None:
+            return (False, result)
+        if self.store:
+           (leader, (fresh, result)) = self.crawler.get_flights().do(idstr,
+                   self.load, idstr, cache, self.store.fetch, ctype, idstr)
+           return (leader and fresh, result)
         else:
            return (True, None)
 
+    def load(self, idstr, cache, fetch, *args):
+        """Load data from the data store unless it is already cached.
+
+        Args:
+            idstr (string): ID string.
+            cache (boolean): If true, the data is added to the cache.
+            fetch (function): The store method that returns the data.
+            args: The arguments to the store method.
+
+        Returns:
+            A tuple of two values: whether the data was fresh and the
+            result dict object.
+        """
+        # The data may have landed while we were waiting for our turn
+        with self.cachelock:
+            seen = self.lookup_seen(idstr, cache)
+        if seen is not None:
+            return (False, seen)
+        self.crawler.get_budget().charge()
+        prefetcher = self.crawler.get_prefetcher()
+        if prefetcher:
+            result = prefetcher.take(idstr, fetch, *args)
+        else:
+            result = fetch(*args)
+        with self.cachelock:
+            # Only the step that fills the cache expands the object
+            seen = self.lookup_seen(idstr, cache)
+            if seen is not None:
+                return (False, seen)
+            if cache:
+                self.cache[idstr] = result
+            else:
+                self.crawler.get_ephemeral()[idstr] = result
+        return (True, result)
+
+    def lookup_seen(self, idstr, cache):
+        """Return the data already looked up for an ID string.
+
+        The cache lock must be held by the caller.
+
+        Args:
+            idstr (string): ID string.
+            cache (boolean): If false, lookups that bypassed the cache
+                             are considered too.
+
+        Returns:
+            The result dict object, or None if the data was not looked
+            up yet.
+        """
+        if idstr in self.cache:
+            return self.cache[idstr]
+        if not cache:
+            return self.crawler.get_ephemeral().get(idstr)
+        return None
+
 
     def fetchObj(self, typepfx, handle, cache=True):
         """Get data corresponding to given handle and collection type.
@@ -336,16 +3362,74 @@ class WhoisCollection:
             return objs
         (r_handle, idstrlist) = self.store.get_idstr(typepfx, handle)
         if r_handle != handle:
-            self.links[handle].append(r_handle)
+            self.link(handle, r_handle)
+        # Objects that are already cached do not count against the budget
         for (ctype, idstr) in idstrlist:
-            (fresh, result) = self.get_data(ctype, idstr)
-            if cache and fresh:
-                self.cache[idstr] = result
+            if idstr not in self.cache and not self.check_budget(handle):
+                return objs
+        for (ctype, idstr) in idstrlist:
+            (fresh, result) = self.get_data(ctype, idstr, cache)
             if result:
-                self.resources[typepfx].append((handle, idstr))
+                self.add_resource(typepfx, handle, idstr)
                 objs.append((fresh, idstr, result))
+                if fresh and not is_empty(result):
+                    self.prefetch(typepfx, idstr)
         return objs
 
+    def prefetch(self, ctype, idstr):
+        """Start the association lookups that the crawl will make next.
+
+        The lists of POCs, orgs, nets and ASNs associated with a new
+        object are looked up in parallel, and parked until the
+        corresponding slurp_set() call asks for them. Nothing is looked
+        up if the crawl budget would not allow those calls.
+
+        Args:
+            ctype (string): Collection type of the object.
+            idstr (string): ID string of the object.
+
+        Returns:
+            None.
+        """
+        prefetcher = self.crawler.get_prefetcher()
+        if not prefetcher or not self.store or ctype not in ASSOCIATIONS:
+            return
+        # The lists are looked up by the collections one hop further
+        if self.crawler.get_budget().allows(self.depth + 1):
+            return
+        for sub in ASSOCIATIONS[ctype]:
+            subidstr = idstr + "/" + sub
+            if subidstr not in self.cache:
+                prefetcher.prefetch(subidstr, self.store.fetch, sub[:-1],
+                        subidstr)
+
+    def check_budget(self, handle, depth=None, frontier=True):
+        """Check the crawl budget before a lookup for a handle.
+
+        If the budget ran out, the handle gets a tooltip giving the
+        reason. A handle that is left unexplored is also filtered.
+
+        Args:
+            handle (str): The handle the lookup is made for.
+            depth (int): The number of hops from the seed handle, by
+                         default the depth of this collection.
+            frontier (boolean): Whether the lookup is that of the
+                                handle itself, rather than of its
+                                associated objects.
+
+        Returns:
+            True if the lookup may proceed.
+        """
+        if depth is None:
+            depth = self.depth
+        reason = self.crawler.get_budget().allows(depth)
+        if not reason:
+            return True
+        self.add_tooltip(handle, "Crawl budget exhausted: " + reason)
+        if frontier:
+            self.add_filtered(handle)
+        return False
+
     def fetchAssociatedObj(self, idstr):
         """Get associated data for given idstr.
 
@@ -358,11 +3442,13 @@ class WhoisCollection:
             A tuple with two values: the first is whether the data was
             cached or not; and the second is the actual result object.
         """
-        if idstr in self.cache.keys() or not self.store:
+        if idstr in self.cache or not self.store:
             return (False, self.cache[idstr])
-        result = self.store.fetchAssociated(self, idstr)
-        self.cache[idstr] = result
-        return (True, result)
+        if not self.check_budget(self.origin_handle, frontier=False):
+            return (False, None)
+        (leader, (fresh, result)) = self.crawler.get_flights().do(idstr,
+                self.load, idstr, True, self.store.fetchAssociated, self, idstr)
+        return (leader and fresh, result)
 
 
     def slurp_common(self, p, idstr):
@@ -383,20 +3469,20 @@ class WhoisCollection:
         """
         if isinstance(p, dict): # We have a dict
             handle = p['@handle']
-            self.slurp(handle)
+            self.crawler.dispatch(self.slurp, handle)
         else: # We have a list
             if self.origin_handle in self.blacklist:
-                self.filtered.append(self.origin_handle)
+                self.add_filtered(self.origin_handle)
                 return
             elif len(p) > self.threshold and self.origin_handle not in self.whitelist:
                 # Don't follow a very long list
                 # Note that we update the parent object
                 self.origin.set_limit_exceeded(self.origin_handle, idstr, len(p))
-                self.filtered.append(self.origin_handle)
+                self.add_filtered(self.origin_handle)
                 return
             for pi in p:
                 handle = pi['@handle']
-                self.slurp(handle)
+                self.crawler.dispatch(self.slurp, handle)
 
     def add_collection(self, col):
         """Add a new associated ollection to the current object.
@@ -413,9 +3499,14 @@ class WhoisCollection:
             None. 
         """
         h = col.get_parent_handle()
-        self.collections[h].append(col)
+        with self.lock:
+            self.collections[h].append(col)
+        self.index.add_collection(h, col)
         # Update our cache with the given object's
-        self.cache.update(col.get_cache())
+        cache = col.get_cache()
+        if cache is not self.cache:
+            with self.cachelock:
+                self.cache.update(cache)
 
     def get_collections(self, recurse=True):
         """Get list of collections associated with the given object. 
@@ -433,20 +3524,70 @@ class WhoisCollection:
             of the dict are the origin handles that were used in the
             construction of the associated WhoisCollection objects.
         """
+        if recurse:
+            return self.gather('collections')
         ret = {}
         ret.update(self.collections)
-        if recurse:
-            for k in self.collections.keys():
-                # Note that k is the parent handle
-                for o in self.collections[k]:
-                    n = o.get_collections()
-                    for k in n.keys():
-                        if k in ret.keys():
-                            ret[k] = ret[k] + list(set(n[k]) - set(ret[k]))
-                        else:
-                            ret[k] = list(set(n[k]))
         return ret
 
+    def gather(self, name):
+        """Gather the entries of all collections below this one.
+
+        The collection that started a crawl sees everything the crawl
+        found, so its entries are copied from the shared GraphIndex.
+        Other collections walk the collections linked through
+        add_collection(), starting with themselves.
+
+        Args:
+            name (str): The name of the dict of lists to gather:
+                        'collections', 'links', 'resources' or
+                        'tooltip'. The 'filtered' list is gathered
+                        under the key None.
+
+        Returns:
+            A new dict of lists, where each entry is kept once, in the
+            order it was first found.
+        """
+        if self.origin is None:
+            return self.index.get(name)
+        ret = defaultdict(list)
+        seen = set()
+        visited = set()
+        todo = [self]
+        while todo:
+            col = todo.pop()
+            if id(col) in visited:
+                continue
+            visited.add(id(col))
+            with col.lock:
+                entries = getattr(col, name)
+                if isinstance(entries, list):
+                    entries = {None: entries}
+                entries = [(k, list(v)) for (k, v) in entries.items()]
+                children = [o for cl in col.collections.values() for o in cl]
+            for (k, vl) in entries:
+                for v in vl:
+                    if (k, v) not in seen:
+                        seen.add((k, v))
+                        ret[k].append(v)
+            todo.extend(reversed(children))
+        return dict(ret)
+
+    def link(self, handle, handle_c):
+        """Create a link between two handles.
+
+        Args:
+            handle (str): the handle to link from.
+            handle_c (str): the handle to link to.
+
+        Returns:
+            None. 
+        """
+        if handle != handle_c:
+            with self.lock:
+                self.links[handle].append(handle_c)
+            self.index.add_link(handle, handle_c)
+
     def add_link(self, handle):
         """Create a link between the current object and the given handle.
 
@@ -456,8 +3597,7 @@ class WhoisCollection:
         Returns:
             None. 
         """
-        if self.origin_handle != handle:
-            self.links[self.origin_handle].append(handle)
+        self.link(self.origin_handle, handle)
 
     def get_links(self, recurse=True):
         """Get the list of links associated with the given object. 
@@ -475,19 +3615,27 @@ class WhoisCollection:
             origin handles that were used in the construction of the
             associated WhoisCollection objects.
         """
+        if recurse:
+            return self.gather('links')
         ret = {}
         ret.update(self.links)
-        if recurse:
-            for k in self.collections.keys():
-                for o in self.collections[k]:
-                    n = o.get_links()
-                    for k in n.keys():
-                        if k in ret.keys():
-                            ret[k] = ret[k] + list(set(n[k]) - set(ret[k]))
-                        else:
-                            ret[k] = list(set(n[k]))
         return ret
 
+    def add_resource(self, ctype, handle, idstr):
+        """Record a resource found by the current object.
+
+        Args:
+            ctype (str): the resource type.
+            handle (str): the resource handle.
+            idstr (str): the ID string of the resource.
+
+        Returns:
+            None. 
+        """
+        with self.lock:
+            self.resources[ctype].append((handle, idstr))
+        self.index.add_resource(ctype, handle, idstr)
+
     def get_resources(self, recurse=True):
         """Get the list of resources associated with the given object. 
 
@@ -498,19 +3646,13 @@ class WhoisCollection:
 
         Returns:
             A dict of lists of resources. The keys are the
-            resource types.
+            resource types. When recursing, the lists are sorted.
         """
+        if recurse:
+            return dict((k, sorted(v)) for (k, v) in
+                    self.gather('resources').items())
         ret = {}
         ret.update(self.resources)
-        if recurse:
-            for k in self.collections.keys():
-                for o in self.collections[k]:
-                    n = o.get_resources()
-                    for k in n.keys():
-                        if k in ret.keys():
-                            ret[k] = sorted(ret[k] + list(set(n[k]) - set(ret[k])))
-                        else:
-                            ret[k] = sorted(list(set(n[k])))
         return ret
 
 
@@ -526,10 +3668,12 @@ class WhoisCollection:
         Returns:
             None. 
         """
-        if handle in self.tooltip.keys():
-            self.tooltip[handle].append(msg)
-        else:
-            self.tooltip[handle] = [msg]
+        with self.lock:
+            if handle in self.tooltip.keys():
+                self.tooltip[handle].append(msg)
+            else:
+                self.tooltip[handle] = [msg]
+        self.index.add_tooltip(handle, msg)
 
     def get_tooltip(self, recurse=True):
         """Get the list of tooltips associated with the given object. 
@@ -543,17 +3687,10 @@ class WhoisCollection:
             A dict of lists of tooltips. The keys are the
             origin handles.
         """
+        if recurse:
+            return self.gather('tooltip')
         ret = {}
         ret.update(self.tooltip)
-        if recurse:
-            for k in self.collections.keys():
-                for o in self.collections[k]:
-                    n = o.get_tooltip()
-                    for k in n.keys():
-                        if k in ret.keys():
-                            ret[k] = ret[k] + list(set(n[k]) - set(ret[k]))
-                        else:
-                            ret[k] = list(set(n[k]))
         return ret
 
     def set_limit_exceeded(self, handle, idstr, lim):
@@ -573,24 +3710,36 @@ class WhoisCollection:
         msg = "Threshold exceeded for " + idstr + ":" + str(lim)
         self.add_tooltip(handle, msg)
 
+    def add_filtered(self, handle):
+        """Record a handle whose references were not followed.
+
+        Args:
+            handle (str): the filtered handle.
+
+        Returns:
+            None. 
+        """
+        with self.lock:
+            self.filtered.append(handle)
+        self.index.add_filtered(handle)
+
     def get_filtered(self, recurse=True):
         """Get the list of handles that were filtered
 
         Args:
-            recurse (boolean): traverse all collections that are linked
-                               through previous calls to
-                               add_collection().
+            recurse (boolean): return filtered handles by traversing all
+                               collections that are linked through
+                               previous calls to add_collection().
 
         Returns:
             A lists of handles that were filtered.
         """
-        ret = self.filtered
         if recurse:
-            for k in self.collections.keys():
-                for o in self.collections[k]:
-                    n = o.get_filtered()
-                    ret = ret + list(set(n) - set(ret))
-        return ret
+            if self.origin is None:
+                return self.index.get_filtered()
+            return self.gather('filtered').get(None, [])
+        with self.lock:
+            return list(self.filtered)
 
     def get_parent_handle(self):
         """Return the origin (parent) handle for the object.
@@ -642,6 +3791,30 @@ class WhoisCollection:
         """
         return self.blacklist
 
+    def get_crawler(self):
+        """Return the crawl engine for the collection object.
+
+        Returns:
+            The WhoisCrawler object that schedules lookups.
+        """
+        return self.crawler
+
+    def get_depth(self):
+        """Return the number of hops from the seed handle.
+
+        Returns:
+            An integer value; 0 for the collection of the seed handle.
+        """
+        return self.depth
+
+    def get_index(self):
+        """Return the index shared by the collections of the crawl.
+
+        Returns:
+            The GraphIndex object of the crawler.
+        """
+        return self.index
+
     def get_type(self):
         """Get the collection type for the given collection object.
 
@@ -697,17 +3870,23 @@ class WhoisCollection:
             None
         """
         self.cache = col.get_cache()
-        self.collections.update(col.get_collections(False))
-        self.links.update(col.get_links(False))
-        self.tooltip.update(col.get_tooltip(False))
-        # Special logic for resources, since the dict keys can overlap
-        curres = self.resources
+        if col.get_index() is not self.index:
+            self.index.merge(col.get_index())
+        collections = col.get_collections(False)
+        links = col.get_links(False)
+        tooltip = col.get_tooltip(False)
         newres = col.get_resources(False)
-        for k in newres.keys():
-            if k in curres.keys():
-                self.resources[k] = curres[k] + list(set(newres[k]) - set(curres[k]))
-            else:
-                self.resources[k] = newres[k]
+        with self.lock:
+            self.collections.update(collections)
+            self.links.update(links)
+            self.tooltip.update(tooltip)
+            # Special logic for resources, since the dict keys can overlap
+            curres = self.resources
+            for k in newres.keys():
+                if k in curres.keys():
+                    self.resources[k] = curres[k] + list(set(newres[k]) - set(curres[k]))
+                else:
+                    self.resources[k] = newres[k]
 
 
 class POCCollection(WhoisCollection):
@@ -715,7 +3894,7 @@ class POCCollection(WhoisCollection):
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """Point of Contact container class constructor.
 
         Args:
@@ -731,9 +3910,11 @@ class POCCollection(WhoisCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         WhoisCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
         self.attrib['shape'] = 'note'
         self.attrib['ctype'] = 'poc'
         #self.attrib['color'] = 'maroon' 
@@ -774,19 +3955,19 @@ class POCCollection(WhoisCollection):
             # Make all relevant sub-queries
             if fresh and result:
                 org = OrgCollection(handle, self)
-                org.slurp_set(idstr)
+                self.crawler.dispatch(org.slurp_set, idstr)
                 self.add_collection(org)
                 asn = ASNCollection(handle, self)
-                asn.slurp_set(idstr)
+                self.crawler.dispatch(asn.slurp_set, idstr)
                 self.add_collection(asn)
                 net = NetCollection(handle, self)
-                net.slurp_set(idstr)
+                self.crawler.dispatch(net.slurp_set, idstr)
                 self.add_collection(net)
 
 class URLCollection(POCCollection):
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """URL container class constructor (ephemeral).
 
         Args:
@@ -802,9 +3983,11 @@ class URLCollection(POCCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         POCCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
 
     def slurp(self, handle):
         """Look for all objects that can be reached from this URL.
@@ -819,15 +4002,17 @@ class URLCollection(POCCollection):
         for (fresh, idstr, result) in objs:
             if result and 'poc' in result.keys():
                 handle_c = result['poc']['handle']
-                self.links[handle].append(handle_c)
+                self.link(handle, handle_c)
                 if fresh:
                     poc = POCCollection(handle_c,
                             store=self.get_store(), cache=self.cache,
                             threshold=self.threshold,
                             whitelist=self.whitelist,
-                            blacklist=self.blacklist)
+                            blacklist=self.blacklist,
+                            crawler=self.crawler)
                     poc.slurp(handle_c)
-                    self.subsume(poc)
+                    # Merge only once all lookups have completed
+                    self.crawler.defer(self.subsume, poc)
 
 
 class OrgCollection(WhoisCollection):
@@ -835,7 +4020,7 @@ class OrgCollection(WhoisCollection):
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """Org container class constructor.
 
         Args:
@@ -851,9 +4036,11 @@ class OrgCollection(WhoisCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         WhoisCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
         self.attrib['shape'] = 'diamond'
         self.attrib['ctype'] = 'org'
         #self.attrib['color'] = 'blue' 
@@ -895,19 +4082,19 @@ class OrgCollection(WhoisCollection):
             # XXX for a net block
             if fresh and result:
                 poc = POCCollection(handle, self)
-                poc.slurp_set(idstr)
+                self.crawler.dispatch(poc.slurp_set, idstr)
                 self.add_collection(poc)
                 asn = ASNCollection(handle, self)
-                asn.slurp_set(idstr)
+                self.crawler.dispatch(asn.slurp_set, idstr)
                 self.add_collection(asn)
                 net = NetCollection(handle, self)
-                net.slurp_set(idstr)
+                self.crawler.dispatch(net.slurp_set, idstr)
                 self.add_collection(net)
 
 class OrgstrCollection(OrgCollection):
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """Orgstr container class constructor (ephemeral).
 
         Args:
@@ -923,9 +4110,11 @@ class OrgstrCollection(OrgCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         OrgCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
 
     def slurp(self, handle):
         """Look for all objects that can be reached from this OrgName 
@@ -940,22 +4129,24 @@ class OrgstrCollection(OrgCollection):
         for (fresh, idstr, result) in objs:
             if result and 'org' in result.keys():
                 handle_c = result['org']['handle']
-                self.links[handle].append(handle_c)
+                self.link(handle, handle_c)
                 if fresh:
                     org = OrgCollection(handle_c,
                             store=self.get_store(), cache=self.cache,
                             threshold=self.threshold,
                             whitelist=self.whitelist,
-                            blacklist=self.blacklist)
+                            blacklist=self.blacklist,
+                            crawler=self.crawler)
                     org.slurp(handle_c)
-                    self.subsume(org)
+                    # Merge only once all lookups have completed
+                    self.crawler.defer(self.subsume, org)
 
 class NetCollection(WhoisCollection):
     """Net Resource Class."""
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """Net container class constructor.
 
         Args:
@@ -971,9 +4162,11 @@ class NetCollection(WhoisCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         WhoisCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
         self.attrib['shape'] = 'box'
         self.attrib['ctype'] = 'net'
 
@@ -1011,7 +4204,7 @@ class NetCollection(WhoisCollection):
             # Make all relevant sub-queries
             if fresh and result:
                 poc = POCCollection(handle, self)
-                poc.slurp_set(idstr)
+                self.crawler.dispatch(poc.slurp_set, idstr)
                 self.add_collection(poc)
                 orgHandle = None
                 if 'orgRef' in result['net'].keys():
@@ -1020,7 +4213,7 @@ class NetCollection(WhoisCollection):
                     orgHandle = result['net']['orgHandle']
                 if orgHandle:
                     org = OrgCollection(handle, self)
-                    org.slurp(orgHandle)
+                    self.crawler.dispatch(org.slurp, orgHandle)
                     self.add_collection(org)
                 # XXX Not following RDNS links
                 # XXX Not following parent/ and children/ links
@@ -1030,7 +4223,7 @@ class CIDRCollection(NetCollection):
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """CIDR container class constructor (ephemeral).
 
         Args:
@@ -1046,9 +4239,11 @@ class CIDRCollection(NetCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         NetCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
 
     def slurp(self, handle):
         """Look for all objects that can be reached from this CIDR block.
@@ -1063,22 +4258,24 @@ class CIDRCollection(NetCollection):
         for (fresh, idstr, result) in objs:
             if result and 'net' in result.keys():
                 handle_c = result['net']['handle']
-                self.links[handle].append(handle_c)
+                self.link(handle, handle_c)
                 if fresh:
                     net = NetCollection(handle_c,
                             store=self.get_store(), cache=self.cache,
                             threshold=self.threshold,
                             whitelist=self.whitelist,
-                            blacklist=self.blacklist)
+                            blacklist=self.blacklist,
+                            crawler=self.crawler)
                     net.slurp(handle_c)
-                    self.subsume(net)
+                    # Merge only once all lookups have completed
+                    self.crawler.defer(self.subsume, net)
 
 class IPCollection(NetCollection):
     """IP container class (ephemeral)."""
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """IP container class constructor (ephemeral).
 
         Args:
@@ -1094,9 +4291,11 @@ class IPCollection(NetCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         NetCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
 
     def slurp(self, handle):
         """Look for all objects that can be reached from this IP address.
@@ -1111,15 +4310,17 @@ class IPCollection(NetCollection):
         for (fresh, idstr, result) in objs:
             if result and 'net' in result.keys():
                 handle_c = result['net']['handle']
-                self.links[handle].append(handle_c)
+                self.link(handle, handle_c)
                 if fresh:
                     net = NetCollection(handle_c,
                             store=self.get_store(), cache=self.cache,
                             threshold=self.threshold,
                             whitelist=self.whitelist,
-                            blacklist=self.blacklist)
+                            blacklist=self.blacklist,
+                            crawler=self.crawler)
                     net.slurp(handle_c)
-                    self.subsume(net)
+                    # Merge only once all lookups have completed
+                    self.crawler.defer(self.subsume, net)
 
 
 class ASNCollection(WhoisCollection):
@@ -1127,7 +4328,7 @@ class ASNCollection(WhoisCollection):
 
     def __init__(self, origin_handle, origin=None, store=None,
             cache=None, tt=None, threshold=None, whitelist=None,
-            blacklist=None):
+            blacklist=None, crawler=None):
         """ASN container class constructor.
 
         Args:
@@ -1143,9 +4344,11 @@ class ASNCollection(WhoisCollection):
                                         filtered.
             blacklist (list of string): Object handles that are
                                         filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
         """
         WhoisCollection.__init__(self, origin_handle, origin, store,
-                cache, tt, threshold, whitelist, blacklist)
+                cache, tt, threshold, whitelist, blacklist, crawler)
         self.attrib['shape'] = 'ellipse'
         self.attrib['ctype'] = 'asn'
 
@@ -1183,7 +4386,7 @@ class ASNCollection(WhoisCollection):
             # Make all relevant sub-queries
             if fresh and result and 'asn' in result.keys():
                 poc = POCCollection(handle, self)
-                poc.slurp_set(idstr)
+                self.crawler.dispatch(poc.slurp_set, idstr)
                 self.add_collection(poc)
                 orgHandle = None
                 if 'orgRef' in result['asn'].keys():
@@ -1192,7 +4395,304 @@ class ASNCollection(WhoisCollection):
                     orgHandle = result['asn']['orgHandle']
                 if orgHandle:
                     org = OrgCollection(handle, self)
-                    org.slurp(orgHandle)
+                    self.crawler.dispatch(org.slurp, orgHandle)
                     self.add_collection(org)
 
 
+
+
+# Collection class of each collection type
+COLLECTIONS = {
+    'poc': POCCollection,
+    'org': OrgCollection,
+    'net': NetCollection,
+    'asn': ASNCollection,
+    'url': URLCollection,
+    'orgstr': OrgstrCollection,
+    'cidr': CIDRCollection,
+    'ip': IPCollection,
+}
+
+
+class WorklistCollection(WhoisCollection):
+    """Collection that crawls one level of the resource graph at a time.
+
+    Instead of one collection object per hop and one stack frame per
+    reference, the crawl keeps a worklist of (type, handle, parent)
+    items and a visited set shared through the crawler. The objects of
+    each level are fetched in one batch per collection type, and so are
+    their association lists. All links, resources, tooltips and
+    filtered handles are recorded by this collection; the collections
+    returned by get_collections() are shared per-type placeholders that
+    only serve to draw the graph.
+    """
+
+    def __init__(self, origin_handle, ctype, store=None, cache=None,
+            tt=None, threshold=None, whitelist=None, blacklist=None,
+            crawler=None):
+        """Worklist container class constructor.
+
+        Args:
+            origin_handle (str): The handle that identifies the container.
+            ctype (str): The collection type of the origin handle.
+            store (GenericStore): The store associated with this collection object.
+            cache (dict): Any pre-cached values.
+            tt (str): An initial tooltip (message).
+            threshold (int): If the number of node dependencies exceed
+                             this limit the dependencies are not
+                             followed.
+            whitelist (list of string): Object handles that are not
+                                        filtered.
+            blacklist (list of string): Object handles that are
+                                        filtered.
+            crawler (WhoisCrawler): The crawl engine that schedules
+                                    lookups.
+        """
+        WhoisCollection.__init__(self, origin_handle, None, store,
+                cache, tt, threshold, whitelist, blacklist, crawler)
+        self.attrib.update(COLLECTIONS[ctype](origin_handle, self).attrib)
+        # Placeholders through which nodes are drawn: the parent of a
+        # placeholder carries the drawing attributes of the node type,
+        # and has no parent itself if the node started a crawl
+        self.markers = {}
+        self.rootmarkers = {}
+        for t in ASSOCIATIONS.keys():
+            col = COLLECTIONS[t](origin_handle, self)
+            col.tooltip = self.tooltip
+            self.markers[t] = WhoisCollection(origin_handle, col)
+            col = COLLECTIONS[t](origin_handle, store=self.store,
+                    cache=self.cache, crawler=self.crawler)
+            col.tooltip = self.tooltip
+            self.rootmarkers[t] = WhoisCollection(origin_handle, col)
+
+    def want(self, wanted, ctype, idstr):
+        """Queue an object for the next batch unless it is cached.
+
+        Each queued object is charged to the crawl budget.
+
+        Args:
+            wanted (dict): Sets of ID strings indexed by collection type.
+            ctype (str): The collection type of the object.
+            idstr (str): The ID string of the object.
+
+        Returns:
+            None.
+        """
+        if idstr not in self.cache and idstr not in wanted[ctype]:
+            self.crawler.get_budget().charge()
+            wanted[ctype].add(idstr)
+
+    def fetch_batch(self, wanted):
+        """Fetch and cache the given objects, one batch per collection type.
+
+        Args:
+            wanted (dict): Sets of ID strings indexed by collection type.
+
+        Returns:
+            None.
+        """
+        for ctype in wanted.keys():
+            idstrs = [i for i in wanted[ctype] if i not in self.cache]
+            if idstrs:
+                results = self.store.fetch_many(ctype, idstrs)
+                with self.cachelock:
+                    self.cache.update(results)
+
+    def resolve(self, typepfx, handle):
+        """Resolve an ephemeral handle to the objects it designates.
+
+        Args:
+            typepfx (str): The ephemeral collection type.
+            handle (str): The ephemeral handle.
+
+        Returns:
+            The worklist items of the objects to crawl.
+        """
+        items = []
+        ctype = EPHEMERAL[typepfx]
+        for (fresh, idstr, result) in self.fetchObj(typepfx, handle,
+                cache=False):
+            if result and ctype in result.keys():
+                handle_c = result[ctype]['handle']
+                self.link(handle, handle_c)
+                if fresh:
+                    items.append((ctype, handle_c, None))
+        return items
+
+    def fetch_level(self, level, depth):
+        """Fetch the objects of one level of the crawl.
+
+        Args:
+            level (list): Worklist items, each a tuple of the collection
+                          type, the handle and the parent handle (None
+                          for the start of a crawl).
+            depth (int): The number of hops from the seed handle.
+
+        Returns:
+            A list of (type, handle, parent, ID string, result) tuples
+            for the objects that are visited for the first time.
+        """
+        todo = []
+        wanted = defaultdict(set)
+        for (t, h, parent) in level:
+            if parent is not None:
+                self.link(parent, h)
+            (r_handle, idstrlist) = self.store.get_idstr(t, h)
+            if r_handle != h:
+                self.link(h, r_handle)
+            if [i for (c, i) in idstrlist if i not in self.cache] and \
+                    not self.check_budget(h, depth):
+                continue
+            for (ctype, idstr) in idstrlist:
+                todo.append((t, h, parent, ctype, idstr))
+                self.want(wanted, ctype, idstr)
+        self.fetch_batch(wanted)
+        objs = []
+        for (t, h, parent, ctype, idstr) in todo:
+            result = self.cache.get(idstr)
+            if not result:
+                continue
+            self.add_resource(t, h, idstr)
+            if self.crawler.visit(t, h):
+                if parent is None:
+                    marker = self.rootmarkers[t]
+                else:
+                    marker = self.markers[t]
+                with self.lock:
+                    self.collections[h].append(marker)
+                self.index.add_collection(h, marker)
+                objs.append((t, h, parent, idstr, result))
+        return objs
+
+    def follow(self, ctype, p, handle, idstr):
+        """Return the worklist items for a reference in an association list.
+
+        Long lists and the lists of blacklisted objects are not
+        followed, as in slurp_common().
+
+        Args:
+            ctype (str): The collection type of the referenced objects.
+            p (dict or list): The reference(s) to process.
+            handle (str): The handle of the object owning the list.
+            idstr (str): The ID string of the association list.
+
+        Returns:
+            A list of worklist items.
+        """
+        if isinstance(p, dict):
+            return [(ctype, p['@handle'], handle)]
+        if handle in self.blacklist:
+            self.add_filtered(handle)
+            return []
+        elif len(p) > self.threshold and handle not in self.whitelist:
+            self.set_limit_exceeded(handle, idstr, len(p))
+            self.add_filtered(handle)
+            return []
+        return [(ctype, pi['@handle'], handle) for pi in p]
+
+    def expand_level(self, objs, depth):
+        """Find the objects referenced by one level of the crawl.
+
+        Args:
+            objs (list): The objects returned by fetch_level().
+            depth (int): The number of hops from the seed handle to the
+                         referenced objects.
+
+        Returns:
+            The worklist items of the next level.
+        """
+        items = []
+        lists = []
+        wanted = defaultdict(set)
+        for (t, h, parent, idstr, result) in objs:
+            if is_empty(result) or t not in result.keys():
+                continue
+            if self.check_budget(h, depth, frontier=False):
+                for sub in ASSOCIATIONS[t]:
+                    lists.append((sub[:-1], h, idstr + "/" + sub))
+                    self.want(wanted, sub[:-1], idstr + "/" + sub)
+            if t in ('net', 'asn'):
+                orgHandle = None
+                if 'orgRef' in result[t].keys():
+                    orgHandle = result[t]['orgRef']['@handle']
+                elif 'orgHandle' in result[t].keys():
+                    orgHandle = result[t]['orgHandle']
+                if orgHandle:
+                    items.append(('org', orgHandle, h))
+        self.fetch_batch(wanted)
+        for (ctype, h, subidstr) in lists:
+            result = self.cache.get(subidstr)
+            if not result or ctype + 's' not in result.keys():
+                continue
+            refs = result[ctype + 's']
+            for key in REFKEYS[ctype]:
+                if key in refs.keys():
+                    items.extend(self.follow(ctype, refs[key], h, subidstr))
+        return items
+
+    def slurp(self, handle):
+        """Look for all objects that can be reached from the origin handle.
+
+        Args:
+            handle (str): The origin handle for the slurp operation.
+        """
+        if not self.store:
+            return
+        ctype = self.get_type()
+        if ctype in EPHEMERAL:
+            level = self.resolve(ctype, handle)
+        else:
+            level = [(ctype, handle, None)]
+        self.crawl(level, 0)
+
+    def crawl(self, level, depth):
+        """Crawl level by level, starting from the given worklist.
+
+        A checkpoint of the crawl is updated before each level.
+
+        Args:
+            level (list): The worklist items to fetch first.
+            depth (int): Their number of hops from the seed handle.
+        """
+        checkpoint = self.crawler.get_checkpoint()
+        while level:
+            if checkpoint:
+                checkpoint.update(self.crawler, {'ctype': self.get_type(),
+                    'handle': self.origin_handle, 'depth': depth,
+                    'level': level})
+            if verbose:
+                stats = self.index.get_cluster_stats()
+                print "Depth %d: %d handles to fetch, %d clusters (largest: %d handles)" % (
+                        depth, len(level), stats['clusters'], stats['largest'])
+            objs = self.fetch_level(level, depth)
+            depth += 1
+            level = self.expand_level(objs, depth)
+
+    def resume(self, level, depth):
+        """Resume a crawl from a checkpoint.
+
+        Args:
+            level (list): The worklist saved by the checkpoint.
+            depth (int): The depth saved by the checkpoint.
+        """
+        self.crawler.run(self.crawl, [tuple(i) for i in level], depth)
+
+    def restore_nodes(self, nodes):
+        """Restore the placeholders of the nodes saved by a checkpoint.
+
+        Args:
+            nodes (list): [handle, type, root] triples of the crawled
+                          nodes, where root is true for nodes that
+                          started a crawl.
+
+        Returns:
+            None.
+        """
+        for (h, t, root) in nodes:
+            if root:
+                marker = self.rootmarkers[t]
+            else:
+                marker = self.markers[t]
+            with self.lock:
+                self.collections[h].append(marker)
+            self.index.add_collection(h, marker)
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+""" import_whois.py - Import bulk whois data
+
+This script loads ARIN bulk whois dumps into a DB or file store, so
+that map_whois and query_resources can later be run in local mode
+without querying ARIN's RESTful API.
+
+"""
+
+import sys
+from pprint import pprint
+
+from map_resources.analyze import ImportOptExtension, WhoisOptParser
+from map_resources.fetch_whois import BulkImporter
+
+ap = ImportOptExtension(WhoisOptParser("import_whois"))
+__doc__ += ap.get_help()
+
+def main(argv):
+
+    opts = ap.parse(argv)
+    importer = BulkImporter(opts['store'], opts['batchsize'])
+    try:
+        for dumpfile in opts['dumpfiles']:
+            importer.load(dumpfile)
+    except Exception as e:
+        print e
+        sys.exit(2)
+    stats = importer.finish()
+
+    if opts['verbose']:
+        pprint(stats)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -11,8 +11,10 @@ order to detect other resources that the organization may hold.
 """
 
 import sys
+import json
 
 from map_resources.analyze import AnalyzeOptExtension, WhoisOptParser, WhoisAnalyzer
+from map_resources.fetch_whois import close_writers
 from map_resources.whois_rv_cmp import RVComparator, RVFetcher
 
 ap = AnalyzeOptExtension(WhoisOptParser("map_whois"))
@@ -22,9 +24,12 @@ def main(argv):
 
     opts = ap.parse(argv)
     c = WhoisAnalyzer(opts['store'], opts['threshold'],
-            opts['whitelist'], opts['blacklist'])
+            opts['whitelist'], opts['blacklist'], opts['concurrency'],
+            opts['prefetch'], opts['worklist'], opts['checkpoint'],
+            opts['procs'], opts['storespec'], opts['communities'])
     try:
-        resob = c.analyze(opts['objlist'])
+        resob = c.analyze(opts['objlist'], opts['maxqueries'],
+                opts['maxdepth'], opts['maxtime'], opts['resume'])
     except Exception as e:
         print e
         sys.exit(2)
@@ -41,8 +46,16 @@ def main(argv):
             if rvcres:
                 rvcres.process_unknown_resources(c)
 
+    opts['store'].flush()
     c.generate_results(opts, rvf)
 
+    if opts['metricsfile']:
+        json.dump(opts['store'].get_metrics(), opts['metricsfile'], indent=2)
+
+    # Fail if queued objects could not be written to the store
+    if close_writers():
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,253 @@
+#!/usr/bin/python
+
+""" mock_arin.py - Local mock of the ARIN RESTful API
+
+This module serves whois objects over HTTP the way ARIN's RESTful API
+does, so that lookups and crawls can be exercised offline under
+realistic latency, server errors and throttling. Objects come from an
+object store laid out as {ctype: {idstr: object}}, where each ID
+string is the path of the object relative to the base URL. Such a store
+can be loaded from a JSON corpus file.
+
+Attributes:
+  verbose (boolean): Turns on verbosity of log messages.
+
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from pprint import pprint
+import argparse
+import threading
+import random
+import time
+import json
+import urllib
+import sys
+import xmltodict
+
+###############################################################
+# Globals
+
+global verbose
+verbose = False
+
+# Seconds between checks for a shutdown request by the serving thread
+POLLINTERVAL = 0.05
+
+
+def arin_json(obj):
+    """Convert an object in the xmltodict layout to ARIN's JSON layout.
+
+    ARIN's JSON representation wraps element text in a '$' key and
+    keeps attributes as '@' keys, so text-only elements become
+    {'$': text} and '#text' becomes '$'.
+
+    Args:
+        obj: An object as returned by xmltodict.parse().
+
+    Returns:
+        The object as ARIN would send it in JSON.
+    """
+    if isinstance(obj, dict):
+        result = {}
+        for (k, v) in obj.items():
+            if k == '#text':
+                result['$'] = v
+            elif k.startswith('@'):
+                result[k] = v
+            else:
+                result[k] = arin_json(v)
+        return result
+    elif isinstance(obj, list):
+        return [arin_json(v) for v in obj]
+    elif obj is None:
+        return {}
+    return {'$': obj}
+
+
+class MockArinHandler(BaseHTTPRequestHandler):
+    """Request handler answering whois lookups from the object store."""
+
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write; writing the headers line by line
+    # stalls keep-alive clients on delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        """Answer a lookup, possibly after a delay or with an error."""
+        server = self.server
+        path = urllib.unquote(self.path.split('?', 1)[0])
+        if server.latency:
+            time.sleep(server.latency)
+        outcome = server.pick_outcome()
+        if outcome == 'throttled':
+            self.send_body(429, 'text/plain', "Too many requests",
+                    {'Retry-After': str(server.retryafter)})
+            return
+        if outcome == 'errors':
+            self.send_body(503, 'text/plain', "Service unavailable")
+            return
+        obj = server.find(path)
+        if obj is None:
+            server.count('missing')
+            self.send_body(404, 'text/plain', "Not found")
+            return
+        server.count('served')
+        if 'xml' in self.headers.get('Accept', ''):
+            self.send_body(200, 'application/xml', xmltodict.unparse(obj))
+        else:
+            self.send_body(200, 'application/json', json.dumps(arin_json(obj)))
+
+    def send_body(self, status, ctype, body, headers=None):
+        """Send a complete response on the keep-alive connection."""
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        if headers:
+            for (k, v) in headers.items():
+                self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Only log requests when verbose."""
+        if verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class MockArinServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server that mimics the ARIN RESTful API."""
+
+    daemon_threads = True
+
+    def __init__(self, objstore, host='127.0.0.1', port=0, latency=0.0,
+            errorrate=0.0, throttlerate=0.0, retryafter=1, seed=None):
+        """Instantiate a mock server.
+
+        Args:
+            objstore (dict): The objects to serve, indexed by collection
+                             type and ID string.
+            host (str): The address to listen on.
+            port (int): The port to listen on; 0 picks a free port.
+            latency (float): The delay in seconds before each response.
+            errorrate (float): The fraction of requests answered with a
+                               503 error.
+            throttlerate (float): The fraction of requests answered with
+                                  a 429 error.
+            retryafter (int): The Retry-After value sent with 429 errors.
+            seed (int): Seed for the error and throttling decisions.
+        """
+        HTTPServer.__init__(self, (host, port), MockArinHandler)
+        self.objects = {}
+        for ctype in objstore.keys():
+            for (idstr, obj) in objstore[ctype].items():
+                self.objects[idstr] = dict((k, v) for (k, v) in obj.items()
+                        if k not in ('objID', '_id'))
+        self.latency = latency
+        self.errorrate = errorrate
+        self.throttlerate = throttlerate
+        self.retryafter = retryafter
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'served': 0, 'missing': 0,
+                'errors': 0, 'throttled': 0}
+        self.thread = None
+
+    def find(self, path):
+        """Return the object served at the given path, or None."""
+        return self.objects.get(path)
+
+    def count(self, counter):
+        """Increment a request counter."""
+        with self.lock:
+            self.stats[counter] += 1
+
+    def pick_outcome(self):
+        """Decide whether the next request fails.
+
+        Returns:
+            'throttled', 'errors' or None.
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            x = self.random.random()
+            if x < self.throttlerate:
+                outcome = 'throttled'
+            elif x < self.throttlerate + self.errorrate:
+                outcome = 'errors'
+            else:
+                return None
+            self.stats[outcome] += 1
+            return outcome
+
+    def get_base(self):
+        """Return the base URL under which objects are served."""
+        (host, port) = self.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def get_stats(self):
+        """Return the request counters of the server."""
+        with self.lock:
+            return dict(self.stats)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever,
+                args=(POLLINTERVAL,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving requests and close the listening socket."""
+        if self.thread:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+
+def load_corpus(path):
+    """Load an object store from a JSON corpus file.
+
+    Args:
+        path (str): The path to a JSON file laid out as
+                    {ctype: {idstr: object}}.
+
+    Returns:
+        The object store as a dict.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="mock_arin")
+    parser.add_argument("corpus", help="JSON file of objects indexed by collection type and ID string")
+    parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+    parser.add_argument("--host", help="Address to listen on", default='127.0.0.1')
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("--latency", help="Delay in seconds before each response", type=float, default=0.0)
+    parser.add_argument("--errorrate", help="Fraction of requests answered with a 503 error", type=float, default=0.0)
+    parser.add_argument("--throttlerate", help="Fraction of requests answered with a 429 error", type=float, default=0.0)
+    parser.add_argument("--retryafter", help="Retry-After value sent with 429 errors", type=int, default=1)
+    p = parser.parse_args(argv)
+    if p.verbose:
+        global verbose
+        verbose = True
+
+    server = MockArinServer(load_corpus(p.corpus), p.host, p.port,
+            p.latency, p.errorrate, p.throttlerate, p.retryafter)
+    print "Serving on " + server.get_base()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    pprint(server.get_stats())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -8,11 +8,13 @@ corresponding to given object handles.
 """
 
 from map_resources.analyze import WhoisOptParser, WhoisObjectFormatter
+from map_resources.fetch_whois import expand_result
 
 from collections import defaultdict
 from pprint import pprint
 import argparse
 import sys
+import json
 from bson import json_util
 
 ap = WhoisOptParser("query_resources")
@@ -30,31 +32,50 @@ def main(argv):
     f = WhoisObjectFormatter(store)
 
     # Get the various resource types and URIs 
+    locs = []
     for k in objlist.keys():
         typepfx = objlist[k]
         (r_handle, idstrlist) = store.get_idstr(typepfx, k)
         for (ctype, loc) in idstrlist:
-            obj = {}
-            # Check if we need to fetch extended info
-            if opts['extended']:
-                if ctype == 'net':
-                    obj = f.get_netinfo(loc)
-                elif ctype == 'org':
-                    obj = f.get_orginfo(loc)
-                elif ctype == 'poc':
-                    obj = f.get_pocinfo(loc)
-                elif ctype == 'asn':
-                    obj = f.get_asninfo(loc)
-                else:
-                    obj = h
+            locs.append((k, ctype, loc))
+
+    # Without extended info resolve all objects of a type at once
+    fetched = defaultdict(dict)
+    if not opts['extended']:
+        bytype = defaultdict(list)
+        for (k, ctype, loc) in locs:
+            bytype[ctype].append(loc)
+        for ctype in bytype.keys():
+            fetched[ctype] = store.fetch_many(ctype, bytype[ctype])
+
+    for (k, ctype, loc) in locs:
+        obj = {}
+        # Check if we need to fetch extended info
+        if opts['extended']:
+            if ctype == 'net':
+                obj = f.get_netinfo(loc)
+            elif ctype == 'org':
+                obj = f.get_orginfo(loc)
+            elif ctype == 'poc':
+                obj = f.get_pocinfo(loc)
+            elif ctype == 'asn':
+                obj = f.get_asninfo(loc)
             else:
-                obj = store.fetch(ctype, loc)
-            res_json = json_util.dumps(obj)
-            outstr = k + "|" + res_json + "\n"
-            if opts['verbose']:
-                print outstr
-            if jsonfile:
-                jsonfile.write(outstr)
+                obj = h
+        else:
+            obj = expand_result(fetched[ctype][loc])
+        res_json = json_util.dumps(obj)
+        outstr = k + "|" + res_json + "\n"
+        if opts['verbose']:
+            print outstr
+        if jsonfile:
+            jsonfile.write(outstr)
+
+    if opts['verbose']:
+        pprint(store.get_session_stats())
+
+    if opts['metricsfile']:
+        json.dump(store.get_metrics(), opts['metricsfile'], indent=2)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
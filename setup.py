@@ -17,7 +17,7 @@ setup(name='MapResources',
       license='See LICENSE',
       long_description=long_description,
       packages=['map_resources'],
-      scripts=['map_whois.py', 'query_resources.py'],
+      scripts=['map_whois.py', 'query_resources.py', 'import_whois.py'],
       platforms='any',
       install_requires=[
 #          'pymongo',
@@ -1,9 +1,16 @@
 import sys
 import os
+import time
+import shutil
+import tempfile
+import threading
+import requests
 from StringIO import StringIO
 import unittest
 import map_resources.fetch_whois as fetch_whois
 import map_resources.analyze as analyze
+import map_resources.mock_arin as mock_arin
+from pymongo import errors
 from pprint import pprint
 
 TEST_BASE = ""
@@ -161,6 +168,129 @@ class DummyStore(fetch_whois.GenericStore):
     def dump(self):
         pprint(self.store)
 
+class ScriptedStore(fetch_whois.HashStore):
+    """Hash store whose lookups fail with the given status codes."""
+
+    def __init__(self, statuses, negttl):
+        fetch_whois.HashStore.__init__(self, TEST_BASE, negttl=negttl,
+                clock=lambda: self.now)
+        self.statuses = statuses
+        self.queries = 0
+        self.now = 1000.0
+
+    def query(self, idstr, ctype=None):
+        self.queries += 1
+        return fetch_whois.empty_result(idstr, self.statuses.pop(0),
+                self.clock())
+
+class SlowStore(DummyStore):
+    """Dummy store that counts lookups and answers them slowly."""
+
+    def __init__(self, store, delay):
+        DummyStore.__init__(self, store)
+        self.delay = delay
+        self.lookups = []
+
+    def fetch(self, ctype, idstr):
+        self.lookups.append(idstr)
+        time.sleep(self.delay)
+        return DummyStore.fetch(self, ctype, idstr)
+
+class FailingStore(DummyStore):
+    """Dummy store that fails after a given number of lookups."""
+
+    def __init__(self, store, limit):
+        DummyStore.__init__(self, store)
+        self.limit = limit
+
+    def fetch(self, ctype, idstr):
+        if self.limit == 0:
+            raise IOError("Lookup failed")
+        self.limit -= 1
+        return DummyStore.fetch(self, ctype, idstr)
+
+class FakeCollection:
+    """In-memory stand-in for the mongoDB collection methods DBStore uses."""
+
+    def __init__(self, name, docs=None):
+        self.name = name
+        self.docs = list(docs or [])
+        self.unique = False
+        self.reads = 0
+        self.finds = []
+        # Objects that someone else stores right after our next query
+        self.racing = []
+
+    def ids(self):
+        return [d['objID'] for d in self.docs]
+
+    def create_index(self, key, unique=False):
+        if unique and len(set(self.ids())) != len(self.docs):
+            raise errors.OperationFailure("E11000 duplicate key")
+        self.unique = self.unique or unique
+
+    def find_one(self, spec):
+        self.reads += 1
+        for d in self.docs:
+            if d['objID'] == spec['objID']:
+                return dict(d)
+        return None
+
+    def find(self, spec):
+        self.finds.append(spec['objID']['$in'])
+        found = [dict(d) for d in self.docs if d['objID'] in spec['objID']['$in']]
+        self.docs.extend(self.racing)
+        self.racing = []
+        return found
+
+    def insert(self, doc):
+        if self.unique and doc['objID'] in self.ids():
+            raise errors.DuplicateKeyError("E11000 duplicate key")
+        self.docs.append(dict(doc))
+
+    def insert_many(self, docs, ordered=True):
+        failed = []
+        for doc in docs:
+            try:
+                self.insert(doc)
+            except errors.DuplicateKeyError:
+                failed.append(doc['objID'])
+        if failed:
+            raise errors.BulkWriteError({'writeErrors': failed})
+
+    def replace_one(self, spec, doc, upsert=False):
+        for (i, d) in enumerate(self.docs):
+            if d['objID'] == spec['objID']:
+                self.docs[i] = dict(doc)
+                return
+        if upsert:
+            self.docs.append(dict(doc))
+
+    def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self.replace_one(op._filter, op._doc, op._upsert)
+
+class FakeDBStore(fetch_whois.DBStore):
+    """DBStore over fake collections whose lookups return dummy objects."""
+
+    def __init__(self, cols, missing=(), **kwargs):
+        fetch_whois.DBStore.__init__(self, 'localhost', 27017, **kwargs)
+        self.fakes = cols
+        self.missing = missing
+        self.queries = []
+
+    def find_collection(self, ctype):
+        if ctype not in self.cols:
+            self.ensure_index(self.fakes[ctype])
+            self.cols[ctype] = self.fakes[ctype]
+        return self.cols[ctype]
+
+    def query(self, idstr, ctype=None):
+        self.queries.append(idstr)
+        if idstr in self.missing:
+            return fetch_whois.empty_result(idstr, 404)
+        return {'objID': idstr, ctype: {'handle': idstr.split('/')[-1]}}
+
 class Cluster():
     def __init__(self):
         self.store = {'asn':{}, 'poc':{}, 'net':{}, 'org':{}}
@@ -239,6 +369,27 @@ class MapResourceTests(unittest.TestCase):
         c.add_elements([o1, a1, n1, p1, o2, a2, n2, p2, p3])
         return c
 
+    def _get_rest_store(self, store):
+        # Single-entry association lists are dicts in REST responses
+        rest = {}
+        for ctype in store.keys():
+            rest[ctype] = {}
+            for (idstr, obj) in store[ctype].items():
+                obj = dict(obj)
+                refs = obj.get(ctype + 's')
+                if idstr.endswith('s') and isinstance(refs, dict):
+                    obj[ctype + 's'] = dict((k, v[0] if len(v) == 1 else v)
+                            for (k, v) in refs.items())
+                rest[ctype][idstr] = obj
+        return rest
+
+    def _get_crawl_state(self, o):
+        r = dict((k, sorted(v)) for (k, v) in o.get_resources(recurse=True).items() if v)
+        l = dict((k, sorted(set(v))) for (k, v) in o.get_links(recurse=True).items() if v)
+        x = sorted(set(o.get_filtered(recurse=True)))
+        t = dict((k, sorted(set(v))) for (k, v) in o.get_tooltip(recurse=True).items() if v)
+        return (r, l, x, t)
+
     # All structures should be empty if the search handle does not exist
     def test_nonex(self):
         c = self._create_cluster_1()
@@ -347,6 +498,783 @@ class MapResourceTests(unittest.TestCase):
         self.assertGreater(oh.len, terselen)
 #        print oh.getvalue()
 
+    # A concurrent crawl should find the same structures as a sequential one
+    def test_concurrent_crawl(self):
+        for (threshold, seed) in ((None, 'AS64512'), (1, 'AS64512'), (None, 'AS64513')):
+            c = self._create_cluster_4()
+            asc = fetch_whois.ASNCollection(seed, store=c.get_store(), threshold=threshold)
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            asc = fetch_whois.ASNCollection(seed, store=c.get_store(), threshold=threshold,
+                    crawler=fetch_whois.WhoisCrawler(4))
+            asc.do_slurp()
+            self.assertEqual(self._get_crawl_state(asc), expected)
+
+    # Only one of several racing lookups fills the cache and is fresh
+    def test_cache_race(self):
+        c = self._create_cluster_1()
+        store = SlowStore(c.store, 0.05)
+        asc = fetch_whois.ASNCollection('AS64512', store=store)
+        results = []
+        def load():
+            results.append(asc.load('/asn/AS64512', True, store.fetch,
+                    'asn', '/asn/AS64512'))
+        threads = [threading.Thread(target=load) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(fresh for (fresh, r) in results),
+                [False, False, False, True])
+        self.assertEqual(asc.get_cache().keys(), ['/asn/AS64512'])
+
+    # A worklist crawl should find the same structures as a recursive one
+    def test_worklist_crawl(self):
+        for (threshold, seed) in ((None, 'AS64512'), (1, 'AS64512'), (None, 'AS64513')):
+            c = self._create_cluster_4()
+            asc = fetch_whois.ASNCollection(seed, store=c.get_store(), threshold=threshold)
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            wlc = fetch_whois.WorklistCollection(seed, 'asn', store=c.get_store(), threshold=threshold)
+            wlc.do_slurp()
+            self.assertEqual(self._get_crawl_state(wlc), expected)
+            self.assertEqual(sorted(wlc.get_collections().keys()),
+                    sorted(asc.get_collections().keys()))
+        # A chain too long for the recursive crawl
+        orgs = [OrgElement("ORG-%d" % i) for i in range(400)]
+        elms = list(orgs)
+        for i in range(len(orgs) - 1):
+            elms.append(POCElement("POC-%d" % i, orgs[i]))
+            elms.append(POCElement("POC-%d" % i, orgs[i + 1]))
+        c = Cluster()
+        c.add_elements(elms)
+        wlc = fetch_whois.WorklistCollection('ORG-0', 'org', store=c.get_store())
+        wlc.do_slurp()
+        (r, l, x, t) = self._get_crawl_state(wlc)
+        self.assertEqual(len(r['org']), 400)
+        self.assertEqual(len(r['poc']), 399)
+
+    # Collections write into one index; subsuming a crawl merges its index
+    def test_graph_index(self):
+        c = self._create_cluster_4()
+        asc = fetch_whois.ASNCollection('AS64512', store=c.get_store(), threshold=1)
+        asc.do_slurp()
+        self.assertEqual(asc.get_links(), asc.get_index().get_links())
+        # Callers get copies they may change
+        asc.get_links()['AS64512'].append('AS64999')
+        asc.get_filtered().append('AS64999')
+        self.assertNotIn('AS64999', asc.get_links()['AS64512'])
+        self.assertEqual(asc.get_filtered(), ['ORG-1'])
+        self.assertEqual(len(asc.get_tooltip()['ORG-1']), 1)
+        other = fetch_whois.ASNCollection('AS64513', store=c.get_store())
+        other.do_slurp()
+        self.assertIsNot(other.get_index(), asc.get_index())
+        asc.subsume(other)
+        (r, l, x, t) = self._get_crawl_state(asc)
+        self.assertEqual(r['asn'], [('AS64512', '/asn/AS64512'), ('AS64513', '/asn/AS64513')])
+        self.assertEqual(l['AS64513'], ['ORG-2', 'POC-2'])
+        self.assertIn('AS64513', asc.get_collections())
+
+    # Collections below the crawl root only see their own subtree
+    def test_subtree_views(self):
+        c = self._create_cluster_4()
+        asc = fetch_whois.ASNCollection('AS64512', store=c.get_store())
+        asc.do_slurp()
+        r = asc.get_resources()
+        for v in r.values():
+            self.assertEqual(v, sorted(v))
+        self.assertEqual(len(r['asn']), 2)
+        [col] = [o for o in asc.get_collections()['AS64513'] if o.get_type() == 'poc']
+        self.assertEqual(col.get_links(), {'AS64513': ['POC-2']})
+        self.assertEqual(col.get_resources(), {'poc': [('POC-2', '/poc/POC-2')]})
+        self.assertEqual(col.get_collections(), {})
+        # Resources found out of order are sorted when gathered
+        org = fetch_whois.OrgCollection('ORG-9', origin=asc, crawler=asc.get_crawler())
+        org.add_resource('net', 'NET-9', '/net/NET-9')
+        org.add_resource('net', 'NET-3', '/net/NET-3')
+        self.assertEqual(org.get_resources(False)['net'][0][0], 'NET-9')
+        self.assertEqual(org.get_resources()['net'],
+                [('NET-3', '/net/NET-3'), ('NET-9', '/net/NET-9')])
+
+    # Crawls stop within their budgets and mark what was not followed
+    def test_crawl_budget(self):
+        c = self._create_cluster_4()
+        for worklist in (False, True):
+            a = analyze.WhoisAnalyzer(store=c.get_store(), worklist=worklist)
+            resob = a.analyze({'AS64512': 'asn'}, maxdepth=0)
+            (r, l, x, t) = self._get_crawl_state(resob)
+            self.assertEqual(r.keys(), ['asn'])
+            self.assertEqual(x, ['ORG-1'])
+            self.assertEqual(t['ORG-1'], ['Crawl budget exhausted: depth'])
+            self.assertEqual(t['AS64512'], ['Crawl budget exhausted: depth'])
+            a = analyze.WhoisAnalyzer(store=c.get_store(), worklist=worklist)
+            resob = a.analyze({'AS64512': 'asn'}, maxqueries=3)
+            self.assertEqual(a.crawler.get_budget().get_stats()['queries'], 3)
+            self.assertTrue(resob.get_filtered())
+            self.assertIn("queries", a.get_messages()[0])
+            self.assertTrue(a.generate_clusters()[0])
+
+    # A crawl that died resumes from its checkpoint to the same result
+    def test_checkpoint(self):
+        c = self._create_cluster_4()
+        objlist = {'AS64512': 'asn', 'AS64513': 'asn'}
+        a = analyze.WhoisAnalyzer(store=c.get_store(), worklist=True)
+        expected = self._get_crawl_state(a.analyze(objlist))
+        queries = a.crawler.get_budget().get_stats()['queries']
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "crawl.ckpt")
+            for limit in (2, 7, 12):
+                if os.path.exists(path):
+                    os.remove(path)
+                a = analyze.WhoisAnalyzer(store=FailingStore(c.store, limit),
+                        checkpoint=fetch_whois.CrawlCheckpoint(path, 0))
+                self.assertRaises(IOError, a.analyze, objlist)
+                a = analyze.WhoisAnalyzer(store=c.get_store(),
+                        checkpoint=fetch_whois.CrawlCheckpoint(path, 0))
+                resob = a.analyze(objlist, resume=True)
+                self.assertEqual(self._get_crawl_state(resob), expected)
+                self.assertLess(a.crawler.get_budget().get_stats()['queries'], queries)
+                self.assertEqual(sorted(a.starthandles), sorted(objlist.keys()))
+                self.assertIn('AS64512', resob.get_collections())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # Seeds crawled in worker processes merge into the sequential result
+    def test_parallel_seeds(self):
+        for c in (self._create_cluster_3(), self._create_cluster_4()):
+            objlist = {'AS64512': 'asn', 'AS64513': 'asn', 'ORG-2': 'org'}
+            a = analyze.WhoisAnalyzer(store=c.get_store(), worklist=True)
+            expected = self._get_crawl_state(a.analyze(objlist))
+            clusters = a.generate_clusters()[0]
+            a = analyze.WhoisAnalyzer(store=c.get_store(), procs=2,
+                    storespec=(DummyStore, (c.store,)))
+            resob = a.analyze(objlist)
+            self.assertEqual(self._get_crawl_state(resob), expected)
+            self.assertEqual(len(a.generate_clusters()[0]), len(clusters))
+            self.assertEqual(sorted(a.starthandles), sorted(objlist.keys()))
+
+    # Worker processes share the per-host request rate
+    def test_parallel_rate(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'whois.db')
+            ap = analyze.AnalyzeOptExtension(analyze.WhoisOptParser("test"))
+            opts = ap.parse(['-a', 'AS64512', '-F', path, '--procs', '4',
+                    '--rate', '8', '--maxrate', '20'])
+            (fn, args) = opts['storespec']
+            self.assertEqual((args[0].rate, args[0].maxrate), (2.0, 5.0))
+            limiter = fn(*args).get_session().get_limiter()
+            self.assertEqual((limiter.rate, limiter.maxrate), (2.0, 5.0))
+            opts = ap.parse(['-a', 'AS64512', '-F', path, '--rate', '8'])
+            self.assertEqual(opts['storespec'][1][0].rate, 8.0)
+            # Workers with private stores would not share any objects
+            stderr = sys.stderr
+            sys.stderr = StringIO()
+            try:
+                self.assertRaises(SystemExit, ap.parse,
+                        ['-a', 'AS64512', '-H', '--procs', '4'])
+            finally:
+                sys.stderr = stderr
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # Each cluster lists the first resource of each type of its nodes
+    def test_cluster_resources(self):
+        c = self._create_cluster_3()
+        a = analyze.WhoisAnalyzer(store=c.get_store())
+        a.analyze({'AS64512': 'asn'})
+        byhandle = a.index_resources({'asn': [('AS1', '/asn/AS1'), ('AS1', '/asn/AS1/x')],
+                'net': [('NET-1', '/net/NET-1'), ('NET-1', '/net/NET-2')]})
+        self.assertEqual(byhandle['AS1'], [('asn', ('AS1', '/asn/AS1'))])
+        clusters = a.generate_clusters()[0]
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(dict((t, sorted(v)) for (t, v) in clusters[0].items()), {
+            'asn': [('AS64512', '/asn/AS64512')], 'org': [('ORG-1', '/org/ORG-1')],
+            'net': [('NET-1', '/net/NET-1')], 'poc': [('POC-1', '/poc/POC-1')]})
+
+    # Clusters are tracked as links are found
+    def test_union_find(self):
+        ds = fetch_whois.DisjointSet()
+        ds.union('a', 'b')
+        ds.union('c', 'd')
+        self.assertEqual(ds.get_count(), 2)
+        ds.union('b', 'd')
+        self.assertEqual(ds.get_count(), 1)
+        self.assertEqual(ds.get_size('a'), 4)
+        c = self._create_cluster_3()
+        a = analyze.WhoisAnalyzer(store=c.get_store())
+        resob = a.analyze({'AS64512': 'asn', 'AS64513': 'asn'})
+        stats = resob.get_index().get_cluster_stats()
+        self.assertEqual(stats['clusters'], 2)
+        self.assertEqual(stats['largest'], 4)
+        self.assertEqual(len(a.generate_clusters()[0]), 2)
+        # Links to no handle do not merge unrelated clusters
+        resob.get_index().add_link('AS64512', None)
+        resob.get_index().add_link('AS64513', None)
+        self.assertEqual(resob.get_index().get_cluster_stats()['clusters'], 2)
+        self.assertEqual(len(a.generate_clusters()[0]), 2)
+
+    # Communities are only computed on request and cached per component
+    def test_communities(self):
+        c = self._create_cluster_3()
+        a = analyze.WhoisAnalyzer(store=c.get_store())
+        a.analyze({'AS64512': 'asn', 'AS64513': 'asn'})
+        self.assertEqual(len(a.generate_clusters()[3]), 0)
+        a = analyze.WhoisAnalyzer(store=c.get_store(), communities=True)
+        a.analyze({'AS64512': 'asn', 'AS64513': 'asn'})
+        (resources, links, x, communities) = a.generate_clusters()
+        for (s, ds) in links.items():
+            self.assertIn(s, communities)
+            for d in ds:
+                self.assertIn(d, communities)
+        partitions = dict(a.partitions)
+        self.assertEqual(a.generate_clusters()[3], communities)
+        self.assertEqual(a.partitions, partitions)
+
+    # Batched DBStore lookups mix hits, misses and stale entries
+    def test_dbstore_batch(self):
+        stale = fetch_whois.empty_result('/poc/P2', 404)
+        stale['objTime'] = 0
+        col = FakeCollection('poc', [{'objID': '/poc/P1', 'poc': {}}, stale])
+        col.racing = [{'objID': '/poc/P4', 'poc': {'handle': 'other'}}]
+        store = FakeDBStore({'poc': col}, missing=['/poc/P3'])
+        res = store.fetch_many('poc', ['/poc/P1', '/poc/P2', '/poc/P3',
+                '/poc/P1', '/poc/P4', '/poc/P3'])
+        self.assertEqual(col.finds, [['/poc/P1', '/poc/P2', '/poc/P3', '/poc/P4']])
+        self.assertEqual(store.queries, ['/poc/P2', '/poc/P3', '/poc/P4'])
+        self.assertEqual(sorted(res.keys()), ['/poc/P1', '/poc/P2', '/poc/P3', '/poc/P4'])
+        self.assertEqual(res['/poc/P1'], {'objID': '/poc/P1', 'poc': {}})
+        self.assertEqual(res['/poc/P2']['poc'], {'handle': 'P2'})
+        self.assertEqual(res['/poc/P3']['objStatus'], 404)
+        # The stale entry is replaced; the racing insert is kept
+        self.assertTrue(col.unique)
+        self.assertEqual(sorted(col.ids()), ['/poc/P1', '/poc/P2', '/poc/P3', '/poc/P4'])
+        self.assertEqual(col.find_one({'objID': '/poc/P2'})['poc'], {'handle': 'P2'})
+        self.assertEqual(col.find_one({'objID': '/poc/P4'})['poc'], {'handle': 'other'})
+        counters = store.get_metrics()['ctypes']['poc']['counters']
+        self.assertEqual((counters['storehits'], counters['storemisses']), (2, 2))
+        # Local stores only answer from the database
+        store = FakeDBStore({'poc': col}, local=True)
+        res = store.fetch_many('poc', ['/poc/P1', '/poc/P5'])
+        self.assertEqual(res['/poc/P5'], {'objID': '/poc/P5'})
+        self.assertEqual(store.queries, [])
+        # Caches with duplicate entries get a non-unique index
+        col = FakeCollection('org', [{'objID': '/org/O1'}, {'objID': '/org/O1'}])
+        store = FakeDBStore({'org': col}, local=True)
+        self.assertEqual(store.fetch('org', '/org/O1'), {'objID': '/org/O1'})
+        self.assertFalse(col.unique)
+
+    # The in-memory tier answers repeated DBStore lookups
+    def test_dbstore_tier(self):
+        col = FakeCollection('poc', [{'objID': '/poc/P%d' % i, 'poc': {}}
+                for i in range(1, 4)])
+        store = FakeDBStore({'poc': col}, maxentries=2)
+        for idstr in ('/poc/P1', '/poc/P1', '/poc/P2', '/poc/P3'):
+            self.assertEqual(store.fetch('poc', idstr), {'objID': idstr, 'poc': {}})
+        self.assertEqual(col.reads, 3)
+        # P1 was evicted and is read from the database again
+        store.fetch('poc', '/poc/P1')
+        self.assertEqual(col.reads, 4)
+        counters = store.get_metrics()['ctypes']['poc']['counters']
+        self.assertEqual((counters['hits'], counters['evictions']), (1, 2))
+        # Batched lookups only query the database for tier misses
+        res = store.fetch_many('poc', ['/poc/P1', '/poc/P4'])
+        self.assertEqual(col.finds, [['/poc/P4']])
+        self.assertEqual(store.queries, ['/poc/P4'])
+        self.assertEqual(res['/poc/P1'], {'objID': '/poc/P1', 'poc': {}})
+        self.assertEqual(store.fetch('poc', '/poc/P4'), res['/poc/P4'])
+        self.assertEqual(col.finds, [['/poc/P4']])
+        self.assertEqual(col.reads, 4)
+
+    # Queued DBStore writes are served like stored objects
+    def test_dbstore_write_behind(self):
+        col = FakeCollection('poc')
+        store = FakeDBStore({'poc': col}, maxentries=10, writebehind=True)
+        store.set_compact()
+        store.save_many('poc', [{'objID': '/poc/P1', 'poc': {'handle': 'P1'}}])
+        res = store.fetch_many('poc', ['/poc/P1', '/poc/P2'])
+        for idstr in ('/poc/P1', '/poc/P2'):
+            self.assertTrue(isinstance(res[idstr]['poc'], fetch_whois.POCRecord))
+            self.assertEqual(store.tier.get(('poc', idstr)), (True, res[idstr]))
+        self.assertEqual(col.finds, [['/poc/P2']])
+        self.assertEqual(store.queries, ['/poc/P2'])
+        store.flush()
+        self.assertEqual(sorted(col.ids()), ['/poc/P1', '/poc/P2'])
+        store.writer.close()
+
+    # The request rate backs off on throttling and recovers on success
+    def test_rate_limiter(self):
+        now = [0.0]
+        sleeps = []
+        def sleep(delay):
+            sleeps.append(delay)
+            now[0] += delay
+        rl = fetch_whois.RateLimiter(rate=8.0, maxrate=10.0, minrate=1.0,
+                clock=lambda: now[0], sleep=sleep)
+        rl.update('host', 200, 0.1)
+        self.assertGreater(rl.get_stats()['host']['rate'], 8.0)
+        now[0] += 1.0
+        rl.update('host', 429, 0.1)
+        rate = rl.get_stats()['host']['rate']
+        self.assertLess(rate, 8.0)
+        self.assertEqual(rl.get_stats()['host']['throttled'], 1)
+        for i in range(100):
+            rl.update('host', 200, 0.1)
+        self.assertEqual(rl.get_stats()['host']['rate'], 10.0)
+        # Tokens are handed out at the configured rate
+        for i in range(4):
+            rl.acquire('other')
+        self.assertEqual(sleeps, [0.125, 0.125, 0.125])
+        self.assertEqual(rl.get_stats()['other']['waited'], 0.375)
+
+    # A local file store serves the same crawl as the in-memory store
+    def test_filestore(self):
+        c = self._create_cluster_4()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "whois.db")
+            fs = fetch_whois.FileStore(path)
+            for ctype in c.store.keys():
+                fs.save_many(ctype, c.store[ctype].values())
+            fs.close()
+            fs = fetch_whois.FileStore(path, local=True)
+            fs.base = TEST_BASE
+            self.assertEqual(fs.fetch('asn', '/asn/AS64512'), c.store['asn']['/asn/AS64512'])
+            res = fs.fetch_many('org', ['/org/ORG-1', '/org/ORG-3'])
+            self.assertEqual(res['/org/ORG-1'], c.store['org']['/org/ORG-1'])
+            self.assertEqual(res['/org/ORG-3'], {'objID': '/org/ORG-3'})
+            asc = fetch_whois.ASNCollection('AS64512', store=c.get_store())
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            asc = fetch_whois.ASNCollection('AS64512', store=fs)
+            asc.do_slurp()
+            self.assertEqual(self._get_crawl_state(asc), expected)
+            fs.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # A bulk whois dump serves the same crawl as the REST objects
+    def test_bulk_import(self):
+        c = self._create_cluster_1()
+        dump = """<?xml version="1.0"?>
+<bulkwhois>
+<org><handle>ORG-1</handle><name>ORG-1</name>
+<pocLinks><pocLinkRef function="AD" handle="POC-1"/></pocLinks></org>
+<asn><handle>AS64512</handle><startAsNumber>64512</startAsNumber>
+<endAsNumber>64512</endAsNumber><orgHandle>ORG-1</orgHandle>
+<pocLinks><pocLinkRef function="AD" handle="POC-1"/></pocLinks></asn>
+<net><handle>NET-1</handle><orgHandle>ORG-1</orgHandle>
+<pocLinks><pocLinkRef function="AD" handle="POC-1"/></pocLinks></net>
+<poc><handle>POC-1</handle><lastName>Lastname</lastName></poc>
+</bulkwhois>
+"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            dumpfile = os.path.join(tmpdir, "arin_db.xml")
+            with open(dumpfile, 'w') as f:
+                f.write(dump)
+            fs = fetch_whois.FileStore(os.path.join(tmpdir, "whois.db"), local=True)
+            fs.base = TEST_BASE
+            importer = fetch_whois.BulkImporter(fs, batchsize=2)
+            importer.load(dumpfile)
+            stats = importer.finish()
+            self.assertEqual(stats['poc'], 1)
+            self.assertEqual(stats['links'], 8)
+            self.assertEqual(fs.fetch('org', '/poc/POC-1/orgs')['orgs'],
+                    {'orgPocLinkRef': {'@function': 'AD', '@handle': 'ORG-1'}})
+            asc = fetch_whois.ASNCollection('AS64512', store=c.get_store())
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            asc = fetch_whois.ASNCollection('AS64512', store=fs)
+            asc.do_slurp()
+            self.assertEqual(self._get_crawl_state(asc), expected)
+            # Blacklisted handles crawl as they would over the REST API
+            rest = DummyStore(self._get_rest_store(c.store))
+            asc = fetch_whois.ASNCollection('AS64512', store=rest,
+                    blacklist=['ORG-1'])
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            asc = fetch_whois.ASNCollection('AS64512', store=fs,
+                    blacklist=['ORG-1'])
+            asc.do_slurp()
+            self.assertEqual(self._get_crawl_state(asc), expected)
+            fs.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    # Crawls through the mock REST server survive errors and throttling
+    def test_mock_server(self):
+        c = self._create_cluster_4()
+        asc = fetch_whois.ASNCollection('AS64512', store=c.get_store())
+        asc.do_slurp()
+        (r, l, x, t) = self._get_crawl_state(asc)
+        expected = (dict((k, [h for (h, i) in v]) for (k, v) in r.items()), l)
+        for wireformat in ('json', 'xml'):
+            server = mock_arin.MockArinServer(c.store, latency=0.01,
+                    errorrate=0.2, throttlerate=0.1, retryafter=0, seed=1)
+            server.start()
+            try:
+                sleeps = []
+                session = fetch_whois.WhoisSession(retries=10, backoff=0.01,
+                        wireformat=wireformat, sleep=sleeps.append)
+                store = fetch_whois.HashStore(server.get_base(), session)
+                asc = fetch_whois.ASNCollection('AS64512', store=store,
+                        crawler=fetch_whois.WhoisCrawler(4))
+                asc.do_slurp()
+                (r, l, x, t) = self._get_crawl_state(asc)
+                r = dict((k, [h for (h, i) in v]) for (k, v) in r.items())
+                self.assertEqual((r, l), expected)
+                stats = server.get_stats()
+                self.assertGreater(stats['errors'] + stats['throttled'], 0)
+                self.assertEqual(store.get_session_stats()['retries'],
+                        stats['errors'] + stats['throttled'])
+                self.assertEqual(len(sleeps), stats['errors'] + stats['throttled'])
+                session.close()
+                # JSON is served in ARIN's layout, not the xmltodict one
+                if wireformat == 'json':
+                    server.errorrate = server.throttlerate = 0.0
+                    obj = requests.get(server.get_base() + '/asn/AS64512',
+                            headers={'Accept': 'application/json'}).json()
+                    self.assertEqual(obj['asn']['handle'], {'$': 'AS64512'})
+                    self.assertEqual(obj['asn']['orgRef'], {'@handle': 'ORG-1'})
+            finally:
+                server.stop()
+
+    # New connections are credited to the requests that set them up
+    def test_session_stats(self):
+        c = self._create_cluster_1()
+        server = mock_arin.MockArinServer(c.store)
+        server.start()
+        try:
+            session = fetch_whois.WhoisSession(poolsize=4)
+            url = server.get_base() + '/asn/AS64512'
+            for i in range(3):
+                session.get(url)
+            stats = session.get_stats()
+            self.assertEqual((stats['connections'], stats['reused']), (1, 2))
+            threads = [threading.Thread(target=lambda: [session.get(url)
+                    for i in range(3)]) for j in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = session.get_stats()
+            self.assertEqual(stats['requests'], 15)
+            self.assertEqual(stats['connections'],
+                    stats['requests'] - stats['reused'])
+            self.assertLessEqual(stats['connections'], 5)
+            session.close()
+        finally:
+            server.stop()
+
+    # A long Retry-After fails the lookup instead of blocking the worker
+    def test_retry_after(self):
+        c = self._create_cluster_1()
+        server = mock_arin.MockArinServer(c.store, throttlerate=1.0,
+                retryafter=86400)
+        server.start()
+        try:
+            store = fetch_whois.HashStore(server.get_base())
+            result = store.fetch('asn', server.get_base() + '/asn/AS64512')
+            self.assertEqual(result['objStatus'], 429)
+            self.assertTrue(fetch_whois.is_transient(result))
+            self.assertEqual(store.get_session_stats()['retries'], 0)
+            self.assertEqual(server.get_stats()['requests'], 1)
+            # A shorter Retry-After is waited for before each retry
+            server.retryafter = 5
+            sleeps = []
+            session = fetch_whois.WhoisSession(retries=2, sleep=sleeps.append)
+            self.assertEqual(session.get(server.get_base() + '/asn/AS64512').status_code, 429)
+            self.assertEqual(sleeps, [5.0, 5.0])
+            session.close()
+        finally:
+            server.stop()
+
+    # A recorded crawl is replayed without the server
+    def test_cassette(self):
+        c = self._create_cluster_4()
+        tmpdir = tempfile.mkdtemp()
+        server = mock_arin.MockArinServer(c.store, latency=0.05)
+        server.start()
+        try:
+            path = os.path.join(tmpdir, "crawl.cassette")
+            session = fetch_whois.CassetteSession(path, record=True)
+            store = fetch_whois.GenericStore(server.get_base(), session)
+            asc = fetch_whois.ASNCollection('AS64512', store=store)
+            asc.do_slurp()
+            expected = self._get_crawl_state(asc)
+            session.close()
+            server.stop()
+            for realtime in (False, True):
+                sleeps = []
+                session = fetch_whois.CassetteSession(path,
+                        realtime=realtime, sleep=sleeps.append)
+                store = fetch_whois.GenericStore(server.get_base(), session)
+                asc = fetch_whois.ASNCollection('AS64512', store=store)
+                asc.do_slurp()
+                self.assertEqual(self._get_crawl_state(asc), expected)
+                stats = store.get_session_stats()
+                self.assertEqual(stats['replayed'], server.get_stats()['requests'])
+                self.assertEqual(stats['missing'], 0)
+                # Only real-time replays wait, as long as the recordings
+                self.assertEqual(len(sleeps), realtime and stats['replayed'])
+            self.assertGreaterEqual(min(sleeps), 0.05)
+            result = store.fetch('asn', server.get_base() + '/asn/AS1')
+            self.assertTrue(fetch_whois.is_transient(result))
+        finally:
+            server.stop()
+            shutil.rmtree(tmpdir)
+
+    # Stores account for lookups, cache hits and latencies per type
+    def test_store_metrics(self):
+        h = fetch_whois.LatencyHistogram([0.01, 0.1])
+        for d in (0.005, 0.005, 0.05, 0.5):
+            h.add(d)
+        self.assertEqual(h.percentile(50), 0.01)
+        self.assertEqual(h.percentile(75), 0.1)
+        self.assertEqual(h.percentile(99), 0.5)
+        self.assertEqual(h.to_dict()['buckets'].values(), [2, 1, 1])
+        c = self._create_cluster_1()
+        server = mock_arin.MockArinServer(c.store)
+        server.start()
+        try:
+            store = fetch_whois.HashStore(server.get_base())
+            for i in range(2):
+                store.fetch('asn', server.get_base() + '/asn/AS64512')
+            store.fetch('poc', server.get_base() + '/poc/POC-9')
+            metrics = store.get_metrics()
+            asn = metrics['ctypes']['asn']
+            self.assertEqual(asn['counters']['fetches'], 1)
+            self.assertEqual(asn['counters']['hits'], 1)
+            self.assertGreater(asn['counters']['bytes'], 0)
+            self.assertEqual(asn['latency']['fetch']['count'], 1)
+            self.assertEqual(asn['latency']['parse']['count'], 1)
+            self.assertEqual(metrics['ctypes']['poc']['counters']['empty'], 1)
+            self.assertEqual(metrics['http']['requests'], 2)
+            self.assertEqual(store.get_cache_stats()['asn'], {'hits': 1, 'misses': 1})
+        finally:
+            server.stop()
+
+    # Prefetched association lists are consumed by the crawl
+    def test_prefetch(self):
+        c = self._create_cluster_4()
+        server = mock_arin.MockArinServer(c.store, latency=0.02)
+        server.start()
+        try:
+            states = []
+            requests = []
+            for prefetch in (0, 3):
+                store = fetch_whois.HashStore(server.get_base())
+                crawler = fetch_whois.WhoisCrawler(prefetch=prefetch)
+                asc = fetch_whois.ASNCollection('AS64512', store=store,
+                        crawler=crawler)
+                asc.do_slurp()
+                states.append(self._get_crawl_state(asc))
+                requests.append(server.get_stats()['requests'] - sum(requests))
+            self.assertEqual(states[0], states[1])
+            self.assertEqual(requests[0], requests[1])
+            stats = crawler.get_prefetcher().get_stats()
+            self.assertGreater(stats['used'], 0)
+            self.assertEqual(stats['unused'], 0)
+            self.assertEqual(crawler.get_prefetcher().pool, None)
+            # Nothing is prefetched beyond the crawl budget
+            for prefetch in (0, 3):
+                store = fetch_whois.HashStore(server.get_base())
+                crawler = fetch_whois.WhoisCrawler(prefetch=prefetch,
+                        budget=fetch_whois.CrawlBudget(maxdepth=0))
+                asc = fetch_whois.ASNCollection('AS64512', store=store,
+                        crawler=crawler)
+                asc.do_slurp()
+                requests.append(server.get_stats()['requests'] - sum(requests))
+            self.assertEqual(requests[2], requests[3])
+            self.assertEqual(crawler.get_prefetcher().get_stats()['issued'], 0)
+            # Lookups left parked when the crawl ends are unused
+            p = fetch_whois.Prefetcher(2)
+            p.prefetch('a', lambda: 1)
+            p.prefetch('b', lambda: 2)
+            self.assertEqual(p.take('a', None), 1)
+            p.close()
+            self.assertEqual(p.get_stats(), {'issued': 2, 'used': 1, 'unused': 1})
+            self.assertEqual(p.take('b', lambda: 3), 3)
+        finally:
+            server.stop()
+
+    # Queued writes are visible and flushed in batches
+    def test_write_behind(self):
+        written = []
+        done = threading.Event()
+        def write(ctype, results):
+            written.append((ctype, len(results)))
+            done.set()
+        wb = fetch_whois.WriteBehind(write, batchsize=2, interval=60)
+        wb.put('poc', {'objID': '/poc/POC-1'})
+        self.assertEqual(wb.get('poc', '/poc/POC-1'), {'objID': '/poc/POC-1'})
+        self.assertEqual(wb.get('org', '/poc/POC-1'), None)
+        wb.put('poc', {'objID': '/poc/POC-2'})
+        # A full batch wakes up the background flush
+        done.wait(10)
+        self.assertEqual(written, [('poc', 2)])
+        self.assertEqual(wb.get('poc', '/poc/POC-1'), None)
+        wb.put('org', {'objID': '/org/ORG-1'})
+        wb.close()
+        self.assertEqual(written, [('poc', 2), ('org', 1)])
+        self.assertEqual(wb.get_stats()['pending'], 0)
+        # Failed batches are queued again behind newer objects
+        failures = [IOError("down")] * 2
+        def write(ctype, results):
+            if failures:
+                raise failures.pop()
+            written.append((ctype, sorted(r['v'] for r in results)))
+        sleeps = []
+        wb = fetch_whois.WriteBehind(write, batchsize=100, interval=60,
+                retries=2, backoff=1.0, sleep=sleeps.append)
+        wb.put('poc', {'objID': '/poc/POC-1', 'v': 1})
+        wb.put('poc', {'objID': '/poc/POC-2', 'v': 2})
+        self.assertFalse(wb.flush())
+        wb.put('poc', {'objID': '/poc/POC-2', 'v': 3})
+        self.assertEqual(wb.get('poc', '/poc/POC-1')['v'], 1)
+        self.assertEqual(wb.get('poc', '/poc/POC-2')['v'], 3)
+        self.assertEqual(wb.get_stats()['pending'], 2)
+        self.assertFalse(wb.flush())
+        self.assertTrue(wb.flush())
+        self.assertEqual(written[-1], ('poc', [1, 3]))
+        # The final flush is retried, then the objects are dropped
+        wb.put('poc', {'objID': '/poc/POC-3', 'v': 4})
+        failures.extend([IOError("down")] * 3)
+        self.assertTrue(wb in fetch_whois.writers)
+        self.assertEqual(fetch_whois.close_writers(), 1)
+        self.assertEqual(sleeps, [1.0, 2.0])
+        stats = wb.get_stats()
+        self.assertEqual((stats['pending'], stats['dropped']), (0, 1))
+        self.assertFalse(wb in fetch_whois.writers)
+        self.assertEqual(wb.close(), 0)
+
+    # Compact records serve the same crawl as the parsed objects
+    def test_compact_records(self):
+        c = self._create_cluster_4()
+        result = c.store['net']['/net/NET-1']
+        compact = fetch_whois.compact_result(result)
+        net = compact['net']
+        self.assertFalse(hasattr(net, '__dict__'))
+        self.assertEqual(net['handle'], 'NET-1')
+        self.assertEqual(net['orgRef']['@handle'], 'ORG-1')
+        self.assertTrue('startAddress' in net.keys())
+        self.assertFalse('netBlocks' in net)
+        self.assertLess(fetch_whois.sizeof(compact), fetch_whois.sizeof(result))
+        compact = fetch_whois.compact_result(result, keepraw=True)
+        self.assertEqual(fetch_whois.expand_result(compact), result)
+        server = mock_arin.MockArinServer(c.store)
+        server.start()
+        try:
+            states = []
+            for compacting in (False, True):
+                store = fetch_whois.HashStore(server.get_base())
+                if compacting:
+                    store.set_compact()
+                asc = fetch_whois.ASNCollection('AS64512', store=store)
+                asc.do_slurp()
+                states.append(self._get_crawl_state(asc))
+            self.assertEqual(states[0], states[1])
+        finally:
+            server.stop()
+
+    # The bounded cache evicts the least recently used entries
+    def test_lru_cache(self):
+        lru = fetch_whois.LRUCache(maxentries=2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(lru.get('a'), (True, 1))
+        self.assertEqual(lru.put('c', 3), ['b'])
+        self.assertFalse('b' in lru)
+        self.assertEqual(len(lru), 2)
+        lru = fetch_whois.LRUCache(maxbytes=20)
+        lru.put('a', {'x': 'y'})
+        lru.put('b', {'x': 'z'})
+        self.assertEqual(lru.put('c', {'x': 'w'}), ['a'])
+        self.assertLessEqual(lru.get_size()[1], 20)
+
+    # Transient failures are retried while missing objects are cached
+    def test_negative_cache(self):
+        store = ScriptedStore([503, 404, 404], 0.2)
+        store.fetch('poc', '/poc/POC-9')
+        store.fetch('poc', '/poc/POC-9')
+        self.assertEqual(store.queries, 2)
+        store.fetch('poc', '/poc/POC-9')
+        self.assertEqual(store.queries, 2)
+        store.now += 0.1
+        store.fetch('poc', '/poc/POC-9')
+        self.assertEqual(store.queries, 2)
+        store.now += 0.2
+        store.fetch('poc', '/poc/POC-9')
+        self.assertEqual(store.queries, 3)
+        # Legacy results without a lookup time are refreshed
+        self.assertTrue(store.is_stale({'objID': '/poc/POC-9'}))
+        self.assertFalse(store.is_stale({'objID': '/poc/POC-9', 'poc': {}}))
+
+    # JSON responses are normalized to the same layout as parsed XML
+    def test_normalize_json(self):
+        import json
+        import xmltodict
+        xml = ('<net><handle>NET-1</handle><startAddress>192.168.100.0</startAddress>'
+               '<orgRef handle="ORG-1" name="Org One">https://whois.arin.net/rest/org/ORG-1</orgRef>'
+               '<netBlocks><netBlock><cidrLength>24</cidrLength></netBlock></netBlocks>'
+               '<originASes><originAS>AS64512</originAS><originAS>AS64513</originAS></originASes>'
+               '</net>')
+        js = ('{"net": {"handle": {"$": "NET-1"}, "startAddress": {"$": "192.168.100.0"},'
+              ' "orgRef": {"@handle": "ORG-1", "@name": "Org One", "$": "https://whois.arin.net/rest/org/ORG-1"},'
+              ' "netBlocks": {"netBlock": {"cidrLength": {"$": 24}}},'
+              ' "originASes": {"originAS": [{"$": "AS64512"}, {"$": "AS64513"}]}}}')
+        expected = json.loads(json.dumps(xmltodict.parse(xml)))
+        self.assertEqual(fetch_whois.normalize_json(json.loads(js)), expected)
+
+    # Objects reached through several parents at once are fetched once
+    def test_single_flight(self):
+        c = self._create_cluster_4()
+        store = SlowStore(c.store, 0.05)
+        crawler = fetch_whois.WhoisCrawler(8)
+        asc = fetch_whois.ASNCollection('AS64512', store=store, crawler=crawler)
+        asc.do_slurp()
+        self.assertEqual(len(store.lookups), len(set(store.lookups)))
+        # Concurrent lookups of one key share the first lookup
+        sf = fetch_whois.SingleFlight()
+        calls = []
+        gate = threading.Event()
+        def lookup():
+            calls.append(1)
+            gate.wait()
+            return 42
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(sf.do('k', lookup)))
+                for i in range(5)]
+        for t in threads:
+            t.start()
+        # Release the lookup only once every other thread has joined it
+        while sf.get_saved() < 4:
+            time.sleep(0.001)
+        gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [(False, 42)] * 4 + [(True, 42)])
+        self.assertEqual(sf.get_saved(), 4)
+        # Lookups that bypass the cache are not repeated either
+        store = SlowStore(c.store, 0.05)
+        asc = fetch_whois.ASNCollection('AS64512', store=store,
+                crawler=fetch_whois.WhoisCrawler(4))
+        idstr = TEST_BASE + '/org/ORG-1'
+        results = []
+        threads = [threading.Thread(target=lambda:
+                results.append(asc.get_data('org', idstr)[0])) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        results.append(asc.get_data('org', idstr)[0])
+        self.assertEqual(store.lookups, [idstr])
+        self.assertEqual(sorted(results), [False] * 4 + [True])
+        self.assertFalse(idstr in asc.cache)
+
 
 if __name__ == '__main__':
     unittest.main()